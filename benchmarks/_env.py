@@ -0,0 +1,29 @@
+import os
+import tempfile
+import time
+
+
+def setup(name):
+    """
+    使用tests/settings.py初始化django，数据库为临时目录下的sqlite文件(可通过LU_TEST_DB指定)，并建表
+    设置DJANGO_SETTINGS_MODULE可改用其他数据库
+    """
+    os.environ.setdefault('LU_TEST_DB', os.path.join(tempfile.gettempdir(), 'lucommon_bench_{}.sqlite3'.format(name)))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def timeit(func, repeat=5):
+    """
+    :return: 多次执行中最短的耗时(毫秒)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
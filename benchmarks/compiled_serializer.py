@@ -0,0 +1,43 @@
+"""
+编译输出(lu_compiled / SERIALIZER_COMPILED)与DRF标准to_representation的耗时对比
+python -m benchmarks.compiled_serializer --rows 5000
+"""
+import argparse
+from benchmarks._env import setup, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    setup('compiled_serializer')
+    from lucommon.serializers import LuModelSerializer
+    from lucommon.settings import lu_settings
+    from tests.models import Book
+
+    lu_settings.SAVE_HISTORY = False
+
+    class PlainSerializer(LuModelSerializer):
+        class Meta:
+            model = Book
+            fields = ('id', 'title', 'status', 'author', 'version', 'created_by', 'updated_by')
+
+    class CompiledSerializer(PlainSerializer):
+        lu_compiled = True
+
+    if Book.objects.count() != args.rows:
+        Book.objects.all().delete()
+        Book.objects.bulk_create([Book(title='b{:08d}'.format(i), status=i % 10) for i in range(args.rows)],
+                                 batch_size=5000)
+
+    print('{:>10} {:>12} {:>14} {:>8}'.format('source', 'plain(ms)', 'compiled(ms)', 'ratio'))
+    for source, rows in (('instance', list(Book.objects.all())), ('values', list(Book.objects.values()))):
+        plain = timeit(lambda: PlainSerializer(rows, many=True).data, args.repeat)
+        compiled = timeit(lambda: CompiledSerializer(rows, many=True).data, args.repeat)
+        print('{:>10} {:>12.2f} {:>14.2f} {:>8.2f}'.format(source, plain, compiled, plain / compiled))
+
+
+if __name__ == '__main__':
+    main()
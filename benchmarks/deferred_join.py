@@ -0,0 +1,42 @@
+"""
+延迟关联分页(PAGINATION_DEFERRED_JOIN_OFFSET)与普通偏移分页的耗时对比
+python -m benchmarks.deferred_join --rows 200000 --limit 20
+"""
+import argparse
+from benchmarks._env import setup, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--body-size', type=int, default=500, help='每条记录大字段的长度')
+    parser.add_argument('--offsets', default='0,1000,10000,50000,150000')
+    args = parser.parse_args()
+
+    setup('deferred_join')
+    from lucommon.paginations import fetch_by_deferred_join
+    from lucommon.settings import lu_settings
+    from tests.models import Book
+
+    lu_settings.SAVE_HISTORY = False
+
+    if Book.objects.count() != args.rows:
+        Book.objects.all().delete()
+        body = 'x' * args.body_size
+        Book.objects.bulk_create(
+            [Book(title='b{:08d}'.format(i), status=i % 10, body=body) for i in range(args.rows)],
+            batch_size=5000
+        )
+
+    queryset = Book.objects.order_by('title')
+    print('{:>10} {:>12} {:>14} {:>8}'.format('offset', 'offset(ms)', 'deferred(ms)', 'ratio'))
+    for offset in [int(offset) for offset in args.offsets.split(',')]:
+        stop = offset + args.limit
+        plain = timeit(lambda: list(queryset[offset:stop]))
+        deferred = timeit(lambda: fetch_by_deferred_join(queryset, offset, stop))
+        print('{:>10} {:>12.2f} {:>14.2f} {:>8.2f}'.format(offset, plain, deferred, plain / deferred))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
 __all__ = [
+    "budgets",
+    "bulk",
+    "caches",
+    "executors",
+    "exports",
     "filters",
+    "guards",
+    "history",
+    "snapshots",
+    "testing",
+    "timings",
     "logger",
     "models",
     "paginations",
+    "renderers",
     "response",
     "serializers",
     "utils",
@@ -0,0 +1,139 @@
+import re
+import threading
+from collections import Counter
+from contextlib import ExitStack, contextmanager, nullcontext
+from django.db import connections
+from .logger import lu_logger
+from .settings import lu_settings
+
+_WHITESPACE = re.compile(r'\s+')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN \((?:%s|\?)(?:, (?:%s|\?))*\)', re.IGNORECASE)
+_READ = re.compile(r'^\(?\s*(?:SELECT|WITH)\b', re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """
+    SQL形状: 合并空白，字面量替换为?，IN列表合并为IN (...)，参数不同的同一语句形状相同
+    """
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _IN_LIST.sub('IN (...)', sql)
+
+
+def is_read(sql):
+    return bool(_READ.match(sql))
+
+
+class LuQueryCollector:
+    """
+    记录执行的SQL形状，track()期间当前线程的所有数据库连接执行的SQL均被记录，可在多个线程中使用
+    1、shapes: 所有语句，用于统计条数
+    2、read_shapes: 只有查询语句(不含executemany)，用于检查N+1；批量写入分批执行的INSERT、UPDATE及历史记录写入不视为N+1
+    """
+
+    def __init__(self):
+        self.shapes = Counter()
+        self.read_shapes = Counter()
+        self._lock = threading.Lock()
+
+    def _execute(self, execute, sql, params, many, context):
+        shape = normalize_sql(sql)
+        read = not many and is_read(shape)
+        with self._lock:
+            self.shapes[shape] += 1
+            if read:
+                self.read_shapes[shape] += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def track(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self._execute))
+            yield self
+
+    @property
+    def count(self):
+        return sum(self.shapes.values())
+
+    def repeated(self, threshold=None):
+        """
+        重复执行的同一查询语句(N+1)，threshold默认为QUERY_REPEAT_THRESHOLD，0表示不检查；写入语句不检查
+        :return: [(SQL形状, 次数), ...]
+        """
+        if threshold is None:
+            threshold = lu_settings.QUERY_REPEAT_THRESHOLD
+        if not threshold:
+            return []
+        return [(shape, count) for shape, count in self.read_shapes.most_common() if count >= threshold]
+
+    def report(self, limit=10):
+        """
+        按SQL形状分组统计，按次数从多到少输出
+        """
+        lines = ['  {} x {}'.format(count, shape) for shape, count in self.shapes.most_common(limit)]
+        if len(self.shapes) > limit:
+            lines.append('  ...其余{}种SQL'.format(len(self.shapes) - limit))
+        return '\n'.join(lines)
+
+
+def get_query_budget(view, action):
+    """
+    视图中lu_query_budget定义的SQL条数上限
+    lu_query_budget = {'list': 3, 'retrieve': 2}  按action指定
+    lu_query_budget = 3  所有action相同
+    :return: 未定义时返回None
+    """
+    budget = getattr(view, 'lu_query_budget', None)
+    if isinstance(budget, dict):
+        return budget.get(action)
+    return budget
+
+
+def check_query_budget(view, action, collector, repeat_threshold=None):
+    """
+    :param repeat_threshold: 同一语句重复执行的次数上限，默认为QUERY_REPEAT_THRESHOLD
+    :return: 问题描述列表: 超出预算、重复执行的语句，无问题时为空
+    """
+    problems = []
+    budget = get_query_budget(view, action)
+    if budget is not None and collector.count > budget:
+        problems.append('执行{}条SQL，超出预算{}'.format(collector.count, budget))
+    for shape, count in collector.repeated(repeat_threshold):
+        problems.append('同一语句重复执行{}次，可能存在N+1查询: {}'.format(count, shape))
+    return problems
+
+
+def track_queries(view):
+    """
+    在其他线程中(如并行的COUNT)执行查询时，计入视图的SQL统计
+    """
+    collector = getattr(view, 'lu_query_collector', None)
+    if collector is None:
+        return nullcontext()
+    return collector.track()
+
+
+@contextmanager
+def query_budget_guard(view):
+    """
+    QUERY_BUDGET_CHECK开启时统计视图执行的SQL，超出lu_query_budget或存在重复语句时通过lu_logger记录，按SQL形状分组输出
+    """
+    if not lu_settings.QUERY_BUDGET_CHECK:
+        yield
+        return
+    collector = view.lu_query_collector = LuQueryCollector()
+    try:
+        with collector.track():
+            yield
+    finally:
+        view.lu_query_collector = None
+    action = getattr(view, 'action', None)
+    problems = check_query_budget(view, action, collector)
+    if problems:
+        lu_logger.warning('lu query budget {}.{} {}\n{}'.format(
+            view.__class__.__name__, action, '；'.join(problems), collector.report()
+        ))
@@ -0,0 +1,354 @@
+from collections import OrderedDict
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, transaction
+from django.db.models import AutoField
+from rest_framework import status
+from rest_framework.exceptions import MethodNotAllowed, ValidationError
+from rest_framework.mixins import CreateModelMixin, UpdateModelMixin, DestroyModelMixin
+from rest_framework.response import Response
+from rest_framework.serializers import ModelSerializer
+from .caches import bump_table_version
+from .settings import lu_settings
+
+# 请求方法 -> (lu_bulk_actions中的名称, 对应的单条操作action, 不能被重写的单条操作方法)
+BULK_ACTIONS = {
+    'POST': ('create', 'create', (CreateModelMixin, 'create')),
+    'PUT': ('update', 'update', (UpdateModelMixin, 'update')),
+    'PATCH': ('update', 'partial_update', (UpdateModelMixin, 'update', 'partial_update')),
+    'DELETE': ('delete', 'destroy', (DestroyModelMixin, 'destroy')),
+}
+
+
+def get_bulk_action(view, request):
+    """
+    校验批量操作是否可用，不可用时返回405
+    1、视图需在lu_bulk_actions中声明，如 lu_bulk_actions = ('create', 'update', 'delete')
+    2、视图重写了对应的单条操作(create、update、partial_update、destroy)时不可用，批量操作无法保留其中的逻辑
+    :return: 对应的单条操作action，批量操作以其校验权限、选择序列化器
+    """
+    name, single_action, (mixin, *methods) = BULK_ACTIONS[request.method]
+    if name not in getattr(view, 'lu_bulk_actions', ()):
+        raise MethodNotAllowed(request.method, detail='视图未开启批量{}'.format(name))
+    for method in methods:
+        if getattr(type(view), method) is not getattr(mixin, method):
+            raise MethodNotAllowed(request.method, detail='视图重写了{}，不支持批量{}'.format(method, name))
+    return single_action
+
+
+def _get_payload(view, request):
+    """
+    校验批量请求的数据为列表，且条数不超过lu_bulk_max_size(默认BULK_MAX_SIZE)
+    """
+    payload = request.data
+    if not isinstance(payload, list):
+        raise ValidationError('批量操作的数据必须为列表')
+    if not payload:
+        raise ValidationError('批量操作的数据不能为空')
+    max_size = getattr(view, 'lu_bulk_max_size', lu_settings.BULK_MAX_SIZE)
+    if len(payload) > max_size:
+        raise ValidationError('批量操作的数据不能超过{}条'.format(max_size))
+    return payload
+
+
+def _get_version_field(model):
+    if not lu_settings.OPTIMISTIC_LOCK_CHECK:
+        return
+    try:
+        return model._meta.get_field(lu_settings.OPTIMISTIC_LOCK_FIELD).attname
+    except FieldDoesNotExist:
+        return
+
+
+def _failed(results):
+    """
+    存在失败的记录时不做任何修改，返回每条记录的结果；只有版本冲突时返回409
+    """
+    failed = [result for result in results if result['status'] != 'ok']
+    if not failed:
+        return
+    conflict = all(result['status'] == 'conflict' for result in failed)
+    return Response({'data': results}, status=status.HTTP_409_CONFLICT if conflict else status.HTTP_400_BAD_REQUEST)
+
+
+def _split_values(model, validated_data):
+    """
+    拆分序列化器校验后的数据: 具体字段、多对多字段、其他属性
+    """
+    values, many_to_many, others = {}, {}, {}
+    for attr, value in validated_data.items():
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            others[attr] = value
+            continue
+        if field.many_to_many:
+            many_to_many[attr] = value
+        elif field.concrete and not field.primary_key:
+            values[attr] = value
+        else:
+            others[attr] = value
+    return values, many_to_many, others
+
+
+def _has_custom_save(view, serializer_class, action):
+    """
+    视图重写了perform_create/perform_update，或序列化器重写了create/update时，批量操作逐条调用以保留其中的逻辑
+    :param action: create、update
+    """
+    mixin = CreateModelMixin if action == 'create' else UpdateModelMixin
+    perform = 'perform_{}'.format(action)
+    return getattr(type(view), perform) is not getattr(mixin, perform) or \
+        getattr(serializer_class, action) is not getattr(ModelSerializer, action)
+
+
+def _bulk_insert(queryset, objs):
+    """
+    批量插入并获取主键
+    1、数据库支持批量返回主键时(postgresql)，直接bulk_create
+    2、否则逐条插入，单条INSERT由数据库返回主键，不依赖自增id连续分配
+    已知限制: mysql、sqlite不支持批量返回主键，每条记录一条INSERT(在同一事务内)，不是批量SQL；
+    多对多字段的中间表仍批量写入
+    """
+    connection = connections[queryset.db]
+    if connection.features.can_return_rows_from_bulk_insert:
+        queryset.bulk_create(objs, batch_size=lu_settings.BULK_BATCH_SIZE)
+        return
+
+    opts = queryset.model._meta
+    for obj in objs:
+        fields = [field for field in opts.concrete_fields if obj.pk is not None or not isinstance(field, AutoField)]
+        returning_fields = opts.db_returning_fields
+        rows = queryset._insert([obj], fields=fields, returning_fields=returning_fields, using=queryset.db)
+        for value, field in zip(rows[0] if rows else (), returning_fields):
+            setattr(obj, field.attname, value)
+        obj._state.adding = False
+        obj._state.db = queryset.db
+
+
+def _get_m2m_columns(field):
+    """
+    :return: (中间表model, 中间表中指向当前model的列, 指向关联model的列)，中间表非自动生成或为对称的自关联时返回None
+    """
+    forward = field if field.concrete else field.remote_field
+    through = forward.remote_field.through
+    if not through._meta.auto_created or forward.remote_field.symmetrical:
+        return
+    source, target = forward.m2m_field_name(), forward.m2m_reverse_field_name()
+    if not field.concrete:
+        source, target = target, source
+    return through, through._meta.get_field(source).attname, through._meta.get_field(target).attname
+
+
+def _set_many_to_many(model, relations, using):
+    """
+    批量设置多对多字段，与逐条调用set()的结果一致
+    1、每个字段: 一次查询已有的关联，一次删除多余的关联，一次bulk_create新增的关联
+    2、不发送m2m_changed信号，关联两端及中间表的版本号直接更新(见caches)
+    3、中间表非自动生成、对称的自关联时逐条调用set()
+    :param relations: [(obj, {字段: 值}), ...]
+    """
+    values_by_attr = OrderedDict()
+    for obj, many_to_many in relations:
+        for attr, value in many_to_many.items():
+            values_by_attr.setdefault(attr, []).append((obj, value))
+
+    for attr, items in values_by_attr.items():
+        field = model._meta.get_field(attr)
+        columns = _get_m2m_columns(field)
+        if columns is None:
+            for obj, value in items:
+                getattr(obj, attr).set(value)
+            continue
+        through, source, target = columns
+        wanted = OrderedDict.fromkeys((obj.pk, getattr(value, 'pk', value)) for obj, values in items for value in values)
+        existing = {
+            (source_pk, target_pk): pk for source_pk, target_pk, pk in through._base_manager.using(using).filter(
+                **{'{}__in'.format(source): [obj.pk for obj, _ in items]}
+            ).values_list(source, target, 'pk')
+        }
+        removed = [pk for key, pk in existing.items() if key not in wanted]
+        added = [through(**{source: source_pk, target: target_pk})
+                 for source_pk, target_pk in wanted if (source_pk, target_pk) not in existing]
+        if removed:
+            through._base_manager.using(using).filter(pk__in=removed).delete()
+        if added:
+            through._base_manager.using(using).bulk_create(added, batch_size=lu_settings.BULK_BATCH_SIZE)
+        if removed or added:
+            for db_table in {through._meta.db_table, model._meta.db_table, field.related_model._meta.db_table}:
+                bump_table_version(db_table, using=using)
+
+
+def _validation_results(errors):
+    return [{'index': i, 'status': 'error' if item else 'ok', 'errors': item} for i, item in enumerate(errors)]
+
+
+def bulk_create(view, request):
+    """
+    批量新增: 序列化器以many模式校验，全部通过后在同一事务内bulk_create，多对多字段批量设置
+    视图重写了perform_create或序列化器重写了create时，逐条校验并在同一事务内逐条调用perform_create
+    """
+    payload = _get_payload(view, request)
+    queryset = view.get_queryset()
+    if _has_custom_save(view, view.get_serializer_class(), 'create'):
+        return _bulk_create_each(view, queryset, payload)
+
+    serializer = view.get_serializer(data=payload, many=True)
+    if not serializer.is_valid():
+        return _failed(_validation_results(serializer.errors))
+
+    model = queryset.model
+    objs, relations = [], []
+    for data in serializer.validated_data:
+        values, many_to_many, others = _split_values(model, data)
+        obj = model(**values)
+        for attr, value in others.items():
+            setattr(obj, attr, value)
+        objs.append(obj)
+        relations.append((obj, many_to_many))
+
+    with transaction.atomic(using=queryset.db):
+        _bulk_insert(queryset, objs)
+        _set_many_to_many(model, relations, queryset.db)
+
+    data = view.get_serializer(objs, many=True).data
+    results = [{'index': i, 'id': obj.pk, 'status': 'ok', 'data': item} for i, (obj, item) in enumerate(zip(objs, data))]
+    return Response({'data': results}, status=status.HTTP_201_CREATED)
+
+
+def _bulk_create_each(view, queryset, payload):
+    serializers = [view.get_serializer(data=item) for item in payload]
+    errors = [{} if serializer.is_valid() else serializer.errors for serializer in serializers]
+    if any(errors):
+        return _failed(_validation_results(errors))
+    with transaction.atomic(using=queryset.db):
+        for serializer in serializers:
+            view.perform_create(serializer)
+    results = [
+        {'index': i, 'id': serializer.instance.pk, 'status': 'ok', 'data': serializer.data}
+        for i, serializer in enumerate(serializers)
+    ]
+    return Response({'data': results}, status=status.HTTP_201_CREATED)
+
+
+def _get_pk(item):
+    if isinstance(item, dict):
+        return item.get(lu_settings.PRIMARY_KEY)
+    return item
+
+
+def _lock_instances(view, request, payload):
+    """
+    在事务内以select_for_update读取并锁定待修改的记录，校验主键、对象权限及乐观锁版本
+    :return: 每条记录的结果，记录实例列表(与payload一一对应，失败的为None)
+    """
+    queryset = view.get_queryset()
+    version_field = _get_version_field(queryset.model)
+    pks = [_get_pk(item) for item in payload]
+    instances = queryset.select_for_update().in_bulk([pk for pk in pks if pk is not None])
+    instances = {str(pk): obj for pk, obj in instances.items()}
+
+    results, objs, seen = [], [], set()
+    for i, (item, pk) in enumerate(zip(payload, pks)):
+        result = {'index': i, 'id': pk, 'status': 'ok'}
+        results.append(result)
+        objs.append(None)
+        if pk is None:
+            result.update(status='error', errors={lu_settings.PRIMARY_KEY: '不能为空'})
+            continue
+        if str(pk) in seen:
+            result.update(status='error', errors={lu_settings.PRIMARY_KEY: '重复的记录'})
+            continue
+        seen.add(str(pk))
+        obj = instances.get(str(pk))
+        if obj is None:
+            result.update(status='not_found')
+            continue
+        view.check_object_permissions(request, obj)
+        request_version = item.get(version_field) if version_field and isinstance(item, dict) else None
+        if request_version is not None and str(request_version) != str(getattr(obj, version_field)):
+            result.update(status='conflict', errors='数据已经被修改，请尝试刷新页面后重试')
+            continue
+        objs[i] = obj
+    return results, objs
+
+
+def bulk_update(view, request, partial=False):
+    """
+    批量修改: 每条数据须包含主键，包含乐观锁字段时校验版本
+    1、在同一事务内锁定记录，逐条以序列化器校验，全部通过后bulk_update，版本号加1，多对多字段批量设置
+    2、视图重写了perform_update或序列化器重写了update时，校验通过后逐条调用perform_update
+    3、任一记录失败时不做修改，返回每条记录的结果
+    """
+    payload = _get_payload(view, request)
+    queryset = view.get_queryset()
+    model = queryset.model
+    version_field = _get_version_field(model)
+
+    with transaction.atomic(using=queryset.db):
+        results, objs = _lock_instances(view, request, payload)
+        serializers = []
+        for item, result, obj in zip(payload, results, objs):
+            if obj is None:
+                continue
+            if not isinstance(item, dict):
+                result.update(status='error', errors='数据格式错误')
+                continue
+            serializer = view.get_serializer(obj, data=item, partial=partial)
+            if not serializer.is_valid():
+                result.update(status='error', errors=serializer.errors)
+                continue
+            serializers.append(serializer)
+
+        failed = _failed(results)
+        if failed is not None:
+            return failed
+
+        if _has_custom_save(view, view.get_serializer_class(), 'update'):
+            for serializer in serializers:
+                view.perform_update(serializer)
+            for result, serializer in zip(results, serializers):
+                result['data'] = serializer.data
+            return Response({'data': results})
+
+        fields = set()
+        relations = []
+        for serializer in serializers:
+            obj = serializer.instance
+            values, many_to_many, others = _split_values(model, serializer.validated_data)
+            for attr, value in dict(values, **others).items():
+                setattr(obj, attr, value)
+            fields.update(values)
+            if version_field:
+                setattr(obj, version_field, getattr(obj, version_field) + 1)
+                fields.add(version_field)
+            relations.append((obj, many_to_many))
+
+        objs = [serializer.instance for serializer in serializers]
+        if fields:
+            queryset.bulk_update(objs, fields, batch_size=lu_settings.BULK_BATCH_SIZE)
+        _set_many_to_many(model, relations, queryset.db)
+
+    data = view.get_serializer(objs, many=True).data
+    for result, item in zip(results, data):
+        result['data'] = item
+    return Response({'data': results})
+
+
+def bulk_delete(view, request):
+    """
+    批量删除: 数据为主键列表，或包含主键及乐观锁字段的列表
+    在同一事务内锁定记录并校验，全部通过后一次性删除；视图重写了perform_destroy(如软删除)时逐条调用
+    """
+    payload = _get_payload(view, request)
+    queryset = view.get_queryset()
+    with transaction.atomic(using=queryset.db):
+        results, objs = _lock_instances(view, request, payload)
+        failed = _failed(results)
+        if failed is not None:
+            return failed
+        if type(view).perform_destroy is not DestroyModelMixin.perform_destroy:
+            for obj in objs:
+                view.perform_destroy(obj)
+        else:
+            queryset.filter(pk__in=[obj.pk for obj in objs]).delete()
+    return Response({'data': results})
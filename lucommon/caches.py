@@ -0,0 +1,229 @@
+import hashlib
+import time
+from django.apps import apps
+from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.signals import m2m_changed
+from django.http import HttpResponse
+from rest_framework.response import Response
+from rest_framework.serializers import BaseSerializer, ListSerializer
+from .settings import lu_settings
+from .serializers import get_expand_serializer_class, get_expand_tree, get_response_fields
+
+_VERSION_KEY = 'lu_table_version:{}'
+_RESPONSE_KEY = 'lu_response:{}'
+_CACHED_HEADERS = ('Content-Type', 'Content-Encoding', 'Vary')
+
+
+def _get_cache():
+    return caches[lu_settings.RESPONSE_CACHE_ALIAS]
+
+
+def _new_version():
+    # 版本被淘汰后重新生成，不能与淘汰前用过的版本重复
+    return time.time_ns()
+
+
+def get_table_versions(tables):
+    """
+    批量获取表的版本号，不存在时初始化
+    """
+    cache = _get_cache()
+    keys = [_VERSION_KEY.format(table) for table in tables]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version(), None)
+            versions[key] = cache.get(key)
+    return tuple(versions[key] for key in keys)
+
+
+def bump_table_version(db_table, using=None):
+    """
+    表数据变更后更新版本号，使依赖该表的响应缓存失效
+    在事务中时，提交后才更新，避免其他请求在提交前以新版本缓存旧数据
+    """
+    if not lu_settings.RESPONSE_CACHE:
+        return
+
+    def bump():
+        cache = _get_cache()
+        key = _VERSION_KEY.format(db_table)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), None)
+
+    transaction.on_commit(bump, using=using)
+
+
+def bump_deleted_versions(deleted, using=None):
+    """
+    :param deleted: delete()返回的 {app_label.Model: 删除数量}，包含级联删除的model
+    """
+    for label, count in deleted.items():
+        if count:
+            bump_table_version(apps.get_model(label)._meta.db_table, using=using)
+
+
+def _on_m2m_changed(sender, instance, action, model, pk_set, using, **kwargs):
+    # 多对多关系的变更不经过LuQuerySet，两端的表都更新版本号
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        for db_table in {sender._meta.db_table, instance._meta.db_table, model._meta.db_table}:
+            bump_table_version(db_table, using=using)
+
+
+m2m_changed.connect(_on_m2m_changed, dispatch_uid='lucommon_response_cache')
+
+
+def _walk_relations(model, names, tables):
+    """
+    沿关联路径收集经过的表
+    :return: 路径末端的model，路径中断(非关联字段)时返回None
+    """
+    current = model
+    for name in names:
+        try:
+            relation = current._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not relation.is_relation or relation.related_model is None:
+            return None
+        current = relation.related_model
+        tables.add(current._meta.db_table)
+    return current
+
+
+def _collect_depth_tables(model, depth, tables):
+    # Meta.depth大于0时，所有关联字段均输出为嵌套的序列化器
+    if depth <= 0:
+        return
+    for field in model._meta.get_fields():
+        if field.is_relation and field.related_model is not None:
+            tables.add(field.related_model._meta.db_table)
+            _collect_depth_tables(field.related_model, depth - 1, tables)
+
+
+def _collect_tables(model, serializer, tables):
+    """
+    按序列化器类声明的字段收集依赖的表，不实例化序列化器
+    嵌套的序列化器、跨关联的source(如 author.name)依赖关联model的表
+    """
+    if isinstance(serializer, ListSerializer):
+        serializer = serializer.child
+    serializer_class = serializer if isinstance(serializer, type) else type(serializer)
+    _collect_depth_tables(model, getattr(getattr(serializer_class, 'Meta', None), 'depth', 0), tables)
+    for name, field in getattr(serializer_class, '_declared_fields', {}).items():
+        source = getattr(field, 'source', None) or name
+        if source == '*':
+            continue
+        names = source.split('.')
+        nested = isinstance(field, BaseSerializer)
+        current = _walk_relations(model, names if nested else names[:-1], tables)
+        if nested and current is not None:
+            _collect_tables(current, field, tables)
+
+
+def get_dependent_tables(view, model):
+    """
+    响应依赖的表，只由视图及请求参数确定，不实例化序列化器
+    1、视图的model，序列化器中声明的嵌套及跨关联的字段
+    2、lu_response_field中跨关联的路径(如 author__name)，lu_expand展开的关联及其序列化器
+    3、视图声明的lu_cache_tables
+    """
+    tables = {model._meta.db_table}
+    _collect_tables(model, view.get_serializer_class(), tables)
+    for path in get_response_fields(view.request):
+        _walk_relations(model, path.split(LOOKUP_SEP)[:-1], tables)
+    _collect_expand_tables(view, model, get_expand_tree(view.request, view), '', tables)
+    tables.update(getattr(view, 'lu_cache_tables', ()))
+    return sorted(tables)
+
+
+def _collect_expand_tables(view, model, tree, prefix, tables):
+    for name, node in tree.items():
+        related_model = _walk_relations(model, [name], tables)
+        if related_model is None:
+            continue
+        path = prefix + name
+        _collect_tables(related_model, get_expand_serializer_class(view, path, related_model), tables)
+        _collect_expand_tables(view, related_model, node, path + '.', tables)
+
+
+def get_cache_scope(request):
+    """
+    缓存的用户范围: 已认证用户的主键，或认证凭据(token)、lts_user的摘要
+    :return: 无法识别用户时返回None，不缓存
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated and user.pk is not None:
+        return 'user:{}'.format(user.pk)
+    token = getattr(request, 'auth', None)
+    token = getattr(token, 'key', token)
+    if token:
+        return 'token:{}'.format(hashlib.md5(str(token).encode()).hexdigest())
+    lts_user = getattr(request, 'lts_user', None)
+    if lts_user:
+        return 'lts_user:{}'.format(lts_user)
+    return None
+
+
+def get_response_cache_key(view, request):
+    """
+    :return: 由视图及请求确定的key，lu_cache_scope为user且无法识别用户时返回None
+    """
+    scope = ''
+    if getattr(view, 'lu_cache_scope', 'user') == 'user':
+        scope = get_cache_scope(request)
+        if scope is None:
+            return None
+    gzip = lu_settings.RENDERER_GZIP and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    parts = (
+        view.__class__.__module__, view.__class__.__qualname__, view.action, sorted(view.kwargs.items()),
+        sorted((k, tuple(v)) for k, v in request.query_params.lists()),
+        scope, request.accepted_media_type, gzip,
+    )
+    return _RESPONSE_KEY.format(hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+def cache_response(view, request, get_response):
+    """
+    响应缓存，开启RESPONSE_CACHE且视图定义了lu_cache_timeout时生效
+    1、key由视图、action、url参数、查询参数(排序后)及用户(lu_cache_scope为user时)组成，无法识别用户时不缓存
+    2、缓存值中保存写入时依赖表的版本号，与响应一次取出，版本号不一致时不命中；
+       LuQuerySet、LuModel写入后更新表的版本号，旧的缓存由缓存过期时间清理
+    3、只缓存渲染后的200响应，流式响应不缓存
+    4、retrieve在调用前已取出记录并检查对象权限(见LuModelViewSet.retrieve)
+    """
+    timeout = getattr(view, 'lu_cache_timeout', None)
+    if not lu_settings.RESPONSE_CACHE or not timeout or request.method != 'GET':
+        return get_response()
+    key = get_response_cache_key(view, request)
+    if key is None:
+        return get_response()
+
+    cache = _get_cache()
+    tables = get_dependent_tables(view, view.get_queryset().model)
+    version_keys = [_VERSION_KEY.format(table) for table in tables]
+    values = cache.get_many([key] + version_keys)
+    versions = tuple(values.get(version_key) for version_key in version_keys)
+    cached = values.get(key)
+    if cached is not None and cached[0] == versions and None not in versions:
+        _, status, content, headers = cached
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+        return response
+
+    if None in versions:
+        # 版本号须在查询数据前初始化，否则期间的写入无法使该缓存失效
+        versions = get_table_versions(tables)
+    response = get_response()
+    if isinstance(response, Response) and response.status_code == 200:
+        def store(rendered):
+            headers = [(header, rendered[header]) for header in _CACHED_HEADERS if rendered.has_header(header)]
+            cache.set(key, (versions, rendered.status_code, rendered.content, headers), timeout)
+        response.add_post_render_callback(store)
+    return response
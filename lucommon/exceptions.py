@@ -1,2 +1,12 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
 class LuLockError(Exception):
     pass
+
+
+class LuQueryGuardError(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = '查询条件开销过大，请缩小查询范围'
+    default_code = 'query_rejected'
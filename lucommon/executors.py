@@ -0,0 +1,281 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from asgiref.sync import sync_to_async
+from crum import set_current_request
+from django.db import close_old_connections, connections
+from django.http import JsonResponse
+from .logger import lu_logger
+from .settings import lu_settings
+from .utils import get_cur_request
+
+ASYNC_ACTIONS = ('list', 'retrieve')
+
+
+class LuExecutorFull(Exception):
+    pass
+
+
+class LuExecutor:
+    """
+    有界线程池，与django默认的同步线程池相互独立
+    1、排队的任务超过max_queue时拒绝提交，抛出LuExecutorFull，0表示不限
+    2、每个任务执行前后调用close_old_connections，与django请求的数据库连接管理方式一致，每个线程持有各自的连接
+    3、任务在提交线程的当前请求(crum)下执行，get_cur_user()照常可用
+    4、记录排队、执行中的任务数及排队等待时间，见stats()
+    """
+
+    def __init__(self, name, max_workers, max_queue=0):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, func, *args, **kwargs):
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise LuExecutorFull('{} 排队任务数已达上限{}'.format(self.name, self.max_queue))
+            self.queued += 1
+            self.submitted += 1
+        request = get_cur_request()
+        enqueued = time.monotonic()
+
+        def run():
+            wait = time.monotonic() - enqueued
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            if lu_settings.ASYNC_QUEUE_WAIT_WARNING and wait > lu_settings.ASYNC_QUEUE_WAIT_WARNING:
+                lu_logger.warning('lu executor {} 排队等待{:.3f}s {}'.format(self.name, wait, self.stats()))
+            set_current_request(request)
+            close_old_connections()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                close_old_connections()
+                set_current_request(None)
+                with self._lock:
+                    self.active -= 1
+
+        return self._pool.submit(run)
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'active': self.active,
+            'queued': self.queued,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'wait_avg': self.wait_total / self.submitted if self.submitted else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(name, max_workers, max_queue=0):
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = _executors[name] = LuExecutor(name, max_workers, max_queue)
+    return executor
+
+
+def get_view_executor():
+    """
+    执行异步视图中list、retrieve的线程池
+    """
+    return _get_executor('lu_view', lu_settings.ASYNC_EXECUTOR_WORKERS, lu_settings.ASYNC_EXECUTOR_QUEUE_SIZE)
+
+
+def get_count_executor():
+    """
+    执行分页COUNT的线程池，与视图线程池分开，视图线程等待COUNT时不会因线程池占满而互相等待
+    排队已满时抛出LuExecutorFull，COUNT改在视图线程中执行(见LuPagination.submit_count)
+    """
+    return _get_executor('lu_count', lu_settings.ASYNC_COUNT_WORKERS, lu_settings.ASYNC_COUNT_QUEUE_SIZE)
+
+
+def get_executor_stats():
+    """
+    各线程池的并发上限、当前排队及执行中的任务数、排队等待时间(秒)
+    """
+    return {name: executor.stats() for name, executor in _executors.items()}
+
+
+def can_run_parallel(using):
+    """
+    其他线程使用独立的数据库连接，事务中(读取不到未提交的数据)及内存数据库下不能并行查询
+    """
+    connection = connections[using]
+    if connection.in_atomic_block:
+        return False
+    is_in_memory_db = getattr(connection, 'is_in_memory_db', None)
+    return not (is_in_memory_db and is_in_memory_db())
+
+
+def has_atomic_requests():
+    # django不允许ATOMIC_REQUESTS与异步视图同时使用
+    return any(connection.settings_dict.get('ATOMIC_REQUESTS') for connection in connections.all())
+
+
+_STREAM_END = object()
+# 迭代线程等待开始发送、队列空位时检查是否已停止的间隔(秒)
+_STREAM_POLL_INTERVAL = 1
+
+
+class LuStreamParts:
+    """
+    在线程池中迭代流式响应，事件循环中以async for读取(见ws.LuASGIHandler)
+    1、视图返回流式响应后，同一个线程池任务继续迭代响应，整个请求只占用一个线程及数据库连接
+    2、响应中间件执行完成、开始发送后(start())才开始迭代，迭代的是中间件替换后的streaming_content(如GZipMiddleware)；
+    中间件替换了整个响应时调用stop()，不再迭代
+    3、每段内容放入有界队列(ASYNC_STREAM_QUEUE_SIZE)，队列已满时迭代线程等待，客户端读取慢时内容不会堆积在内存中
+    4、发送结束或失败(如客户端断开)时调用stop()，等待中的迭代线程退出并关闭响应；事件循环关闭时同样退出
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(max(lu_settings.ASYNC_STREAM_QUEUE_SIZE, 1))
+        self.response = loop.create_future()
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+
+    def drain(self, response):
+        """
+        在线程池中执行: 将响应交给事件循环，开始发送后逐段迭代
+        """
+        self.loop.call_soon_threadsafe(_set_result, self.response, response)
+        end = _STREAM_END
+        try:
+            if not self._wait_started():
+                return
+            for part in response:
+                if not self._put(part):
+                    return
+        except Exception as e:
+            end = e
+        finally:
+            response.close()
+        self._put(end)
+
+    def _wait_started(self):
+        while not self._started.wait(_STREAM_POLL_INTERVAL):
+            if self.loop.is_closed():
+                return False
+        return not self._stopped.is_set()
+
+    def _put(self, item):
+        """
+        :return: 是否放入队列，stop()后或事件循环关闭时返回False
+        """
+        if self._stopped.is_set() or self.loop.is_closed():
+            return False
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop)
+        while True:
+            try:
+                future.result(_STREAM_POLL_INTERVAL)
+                return True
+            except FutureTimeoutError:
+                if self._stopped.is_set() or self.loop.is_closed():
+                    future.cancel()
+                    return False
+
+    def start(self):
+        """
+        事件循环中调用: 开始迭代
+        """
+        self._started.set()
+
+    def stop(self):
+        # 清空队列，唤醒等待中的迭代线程
+        self._stopped.set()
+        self._started.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is _STREAM_END:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def as_async_view(sync_view, executor_view, actions):
+    """
+    将视图包装为异步视图，LuASGIHandler下不再占用django默认的同步线程池
+    1、list、retrieve对应的请求交由get_view_executor()执行，包括渲染响应
+    2、LuASGIHandler下流式响应(导出等)也在该线程池任务中迭代，见LuStreamParts；
+    LuStreamParts保存在request.lu_stream_parts，由LuASGIHandler在响应中间件执行完成后开始或停止
+    3、其他请求与同步视图相同，通过sync_to_async执行
+    4、线程池排队已满时返回503
+    :param executor_view: 在线程池中执行的视图，视图实例带有lu_async=True
+    """
+    methods = {method for method, action in actions.items() if action in ASYNC_ACTIONS}
+    if 'get' in methods:
+        methods.add('head')
+
+    def run(enqueued, stream, request, *args, **kwargs):
+        # 请求由事件循环提交，crum的当前请求需在执行线程中设置
+        set_current_request(request)
+        request.lu_queue_wait = time.monotonic() - enqueued
+        response = executor_view(request, *args, **kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        if stream is not None and response.streaming:
+            stream.drain(response)
+            return
+        return response
+
+    async def view(request, *args, **kwargs):
+        if request.method.lower() not in methods:
+            return await sync_to_async(sync_view)(request, *args, **kwargs)
+        # 只有LuASGIHandler能以async for发送流式响应
+        stream = LuStreamParts(asyncio.get_running_loop()) if getattr(request, 'scope', {}).get('lu_sync_streaming') else None
+        try:
+            future = get_view_executor().submit(run, time.monotonic(), stream, request, *args, **kwargs)
+        except LuExecutorFull as e:
+            lu_logger.warning('lu executor {} {}'.format(e, get_executor_stats()))
+            return JsonResponse({'detail': '服务繁忙，请稍后重试'}, status=503)
+        future = asyncio.wrap_future(future)
+        if stream is None:
+            return await future
+        try:
+            await asyncio.wait({future, stream.response}, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            stream.stop()
+            raise
+        if not stream.response.done():
+            return future.result()
+        request.lu_stream_parts = stream
+        return stream.response.result()
+
+    functools.update_wrapper(view, sync_view)
+    return view
@@ -0,0 +1,207 @@
+import csv
+import json
+from crum import set_current_request
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connections
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
+from .paginations import get_keyset_ordering, get_seek_q, annotate_cursor_values, pop_cursor_values
+from .settings import lu_settings
+from .utils import get_cur_request
+
+EXPORT_CONTENT_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def _dumps(data):
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+def get_chunk_ordering(queryset):
+    """
+    分批读取时的唯一排序
+    1、一般查询: 当前排序追加主键(见get_keyset_ordering)
+    2、去重的values()查询、分组查询: 结果在所选列(分组列)上唯一，按当前排序中属于所选列的字段，再追加其余所选列(分组列)
+    3、随机排序、表达式排序等无法定位的查询按主键排序
+    :return: [(字段路径, 是否倒序)]，DISTINCT ON查询返回None
+    """
+    query = queryset.query
+    if query.distinct_fields:
+        return
+    values_select = list(query.values_select)
+    pk_names = ('pk', queryset.model._meta.pk.name, queryset.model._meta.pk.attname)
+    if values_select and (query.distinct or query.group_by is not None) and \
+            not any(name in pk_names for name in values_select):
+        # 分组查询在分组列上唯一，去重查询在所有输出列上唯一
+        selected = values_select + list(query.annotation_select)
+        unique = values_select if query.group_by is not None else selected
+        order_by = query.order_by or (queryset.model._meta.ordering if query.default_ordering else ())
+        ordering = []
+        for field in order_by:
+            if isinstance(field, str) and field.lstrip('-') in selected:
+                ordering.append((field.lstrip('-'), field.startswith('-')))
+        used = {field for field, _ in ordering}
+        return ordering + [(field, False) for field in unique if field not in used]
+    ordering = get_keyset_ordering(queryset)
+    if ordering is None:
+        return [('pk', False)]
+    return ordering
+
+
+def iterate_chunks(queryset, chunk_size, offset=0):
+    """
+    分批读取queryset，每批最多chunk_size条，内存占用与结果总数无关
+    按get_chunk_ordering的唯一排序以keyset方式逐批定位，每批为一次独立的有界查询，不依赖数据库驱动的流式游标
+    (mysqlclient的iterator()会在客户端缓存全部结果)
+    :param offset: 跳过的记录数，仅作用于第一批
+    """
+    ordering = get_chunk_ordering(queryset)
+    if ordering is None:
+        # DISTINCT ON与附加的排序列冲突，按偏移量分批
+        queryset = queryset if queryset.ordered else queryset.order_by(*queryset.query.distinct_fields)
+        while True:
+            rows = list(queryset[offset:offset + chunk_size])
+            if rows:
+                yield rows
+            if len(rows) < chunk_size:
+                return
+            offset += chunk_size
+
+    connection = connections[queryset.db]
+    queryset = annotate_cursor_values(queryset, ordering).order_by(
+        *[('-' if descending else '') + field for field, descending in ordering]
+    )
+    values = None
+    while True:
+        if values is None:
+            rows = list(queryset[offset:offset + chunk_size])
+        else:
+            rows = list(queryset.filter(get_seek_q(ordering, values, connection))[:chunk_size])
+        if not rows:
+            return
+        keys = [pop_cursor_values(row, len(ordering)) for row in rows]
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        values = keys[-1]
+
+
+def bind_request(stream, request):
+    """
+    流式响应在视图返回、中间件处理完成后才被迭代，此时crum的当前请求已被清除
+    每次取下一段内容时重新设置当前请求，get_cur_user()等照常可用
+    """
+    iterator = iter(stream)
+    while True:
+        previous = get_cur_request()
+        set_current_request(request)
+        try:
+            part = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            set_current_request(previous)
+        yield part
+
+
+def _stream_response(request, stream, content_type):
+    """
+    1、ASGI下django 3.2在事件循环中迭代流式响应，查询数据库会抛出SynchronousOnlyOperation；
+    LuASGIHandler(见ws)在线程中迭代，其他ASGI handler下退回为非流式响应(全部内容在视图线程中生成)
+    2、WSGI下直接以流的方式输出
+    """
+    django_request = getattr(request, '_request', request)
+    stream = bind_request(stream, django_request)
+    if isinstance(django_request, ASGIRequest) and not django_request.scope.get('lu_sync_streaming'):
+        return HttpResponse(''.join(stream), content_type=content_type)
+    return StreamingHttpResponse(stream, content_type=content_type)
+
+
+def stream_json(chunks, serialize):
+    yield '['
+    first = True
+    for chunk in chunks:
+        data = serialize(chunk)
+        if not data:
+            continue
+        yield ('' if first else ',') + ','.join(_dumps(item) for item in data)
+        first = False
+    yield ']'
+
+
+def stream_ndjson(chunks, serialize):
+    for chunk in chunks:
+        data = serialize(chunk)
+        if data:
+            yield ''.join(_dumps(item) + '\n' for item in data)
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def stream_csv(chunks, serialize):
+    """
+    表头取第一条记录的字段，嵌套的值以json格式输出
+    """
+    writer = csv.writer(_Echo())
+    header = None
+    for chunk in chunks:
+        data = serialize(chunk)
+        if not data:
+            continue
+        lines = []
+        if header is None:
+            header = list(data[0].keys())
+            lines.append(writer.writerow(header))
+        for item in data:
+            lines.append(writer.writerow([
+                _dumps(value) if isinstance(value, (dict, list)) else value
+                for value in (item.get(key) for key in header)
+            ]))
+        yield ''.join(lines)
+
+
+def stream_paginated(chunks, serialize):
+    """
+    与LuPagination相同的响应格式，count为实际输出的记录数
+    """
+    count = 0
+    yield '{"data":['
+    for chunk in chunks:
+        data = serialize(chunk)
+        if not data:
+            continue
+        yield (',' if count else '') + ','.join(_dumps(item) for item in data)
+        count += len(data)
+    yield '],"pagination":{"next":null,"previous":null,"count":%d}}' % count
+
+
+def export_response(view, queryset, export_format, offset=0):
+    """
+    以流的方式输出queryset，逐批序列化，lu_response_field等过滤条件照常生效
+    :param export_format: json、ndjson、csv，或paginated(LuPagination格式的json)
+    """
+    if export_format != 'paginated' and export_format not in EXPORT_CONTENT_TYPES:
+        raise ValidationError({lu_settings.EXPORT_FIELD: '仅支持{}'.format('、'.join(EXPORT_CONTENT_TYPES))})
+
+    def serialize(rows):
+        if getattr(view, 'lu_aggregated', False):
+            return rows
+        return view.get_serializer(rows, many=True).data
+
+    chunks = iterate_chunks(queryset, lu_settings.EXPORT_CHUNK_SIZE, offset)
+    if export_format == 'paginated':
+        return _stream_response(view.request, stream_paginated(chunks, serialize), 'application/json')
+
+    stream = {'json': stream_json, 'ndjson': stream_ndjson, 'csv': stream_csv}[export_format]
+    response = _stream_response(view.request, stream(chunks, serialize), EXPORT_CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+        queryset.model._meta.model_name, export_format
+    )
+    return response
@@ -1,6 +1,19 @@
 import django_filters
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+from django.core.exceptions import FieldError, FieldDoesNotExist
+from django.db.models import Q, Value, IntegerField, Count, Sum, Avg, Min, Max
+from django.db.models.expressions import Col
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.sql.query import Query
 from django_filters.constants import EMPTY_VALUES as _EMPTY_VALUES
+from rest_framework.exceptions import ValidationError
 from .settings import lu_settings
+from .utils import LuLRUCache
+from .guards import check_search, check_order, check_distinct, is_indexed_field
+from .serializers import get_response_fields, resolve_field_path, get_projection, get_expand_tree, \
+    build_expand_prefetches
 
 __FILTER__ = "__FILTER__"
 __EXCLUDE__ = "__EXCLUDE__"
@@ -50,6 +63,121 @@ class _LookUp:
         self.desc = desc
 
 
+def _resolve_lookup(model, path, lookup, annotations=()):
+    """
+    解析查询字段路径及查找方式，支持跨关联字段及transform链，如 user__name、created_at__date__year
+    依次校验路径中的每个transform及最终的查找方式是否适用于前一步的输出字段
+    :return: (校验失败的原因，是否可使用索引)，校验通过时原因为None
+    """
+    names = path.split(LOOKUP_SEP)
+    if names[0] in annotations:
+        return None, False
+    try:
+        _, final_field, targets, rest = Query(model).names_to_path(names, model._meta, allow_many=True)
+    except FieldError:
+        return '字段 {} 不存在'.format(path), False
+    lhs = Col(model._meta.db_table, targets[-1], final_field)
+    for i, name in enumerate(rest):
+        transform = lhs.get_transform(name)
+        if transform is None:
+            return '字段 {} 不支持 {}'.format(LOOKUP_SEP.join(names[:len(names) - len(rest) + i]), name), False
+        lhs = transform(lhs)
+    if lhs.get_lookup(lookup) is None:
+        return '字段 {} 不支持 {} 查询'.format(path, lookup), False
+    return None, is_indexed_field(final_field, rest)
+
+
+def _get_multi_valued_prefix(model, path):
+    """
+    获取字段路径中第一个多值关联(多对多、反向外键)及之前的部分，如 tags__name -> tags
+    :return: 路径不经过多值关联时返回None
+    """
+    opts = model._meta
+    names = path.split(LOOKUP_SEP)
+    for i, name in enumerate(names):
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return
+        if not field.is_relation:
+            return
+        if field.many_to_many or field.one_to_many:
+            return LOOKUP_SEP.join(names[:i + 1])
+        opts = field.related_model._meta
+    return
+
+
+class _SearchPlan:
+    """
+    编译后的查询计划
+    同一model、同一组查询字段及查询类型只编译一次：解析字段路径、transform链及查找方式，
+    结果(查找名、是否可使用索引、多值关联前缀)随计划缓存，每次请求只绑定查询值
+    """
+
+    def __init__(self, model, fields, lookups, annotations=()):
+        self.model = model
+        self.conditions = []
+        self.filters = []
+        self.excludes = []
+        self.multi_valued_prefix = {}
+        errors = []
+        for i, (field, lookup) in enumerate(zip(fields, lookups)):
+            error, indexed = _resolve_lookup(model, field, lookup.lookup, annotations)
+            if error:
+                errors.append(error)
+                continue
+            self.conditions.append((field, lookup.lookup, indexed))
+            lookup_name = '{}__{}'.format(field, lookup.lookup)
+            item = (i, lookup_name, lookup.lookup in ['in'])
+            if lookup.filter_type == __FILTER__:
+                self.filters.append(item)
+            if lookup.filter_type == __EXCLUDE__:
+                self.excludes.append(item)
+                self.multi_valued_prefix[lookup_name] = _get_multi_valued_prefix(model, field)
+        if errors:
+            raise ValidationError({lu_settings.SEARCH_FIELD: errors})
+
+    @staticmethod
+    def _bind(items, values, value_delimiter):
+        lookups = {}
+        for i, lookup_name, is_in in items:
+            value = values[i]
+            value = None if value == lu_settings.FILTER_NULL_VALUE else value
+            if is_in:
+                value = value.split(value_delimiter) if value else []
+            lookups[lookup_name] = value
+        return lookups
+
+    def bind(self, values, value_delimiter):
+        """
+        :param values: 查询值，与编译时的查询字段一一对应
+        :return: (filters_lookups, excludes_lookups)
+        """
+        return self._bind(self.filters, values, value_delimiter), self._bind(self.excludes, values, value_delimiter)
+
+    def build_exclude_q(self, excludes_lookups):
+        """
+        将所有exclude条件合并为一个Q：not cond1 and not cond2 and ...
+        经过同一多值关联的条件合并为一个子查询: not (pk in (select pk where cond1 or cond2))，
+        与逐个exclude生成多个 not in 子查询含义相同；查询值为空(None)或空列表的条件涉及空值语义，仍单独取反
+        """
+        q = Q()
+        groups = OrderedDict()
+        for lookup_name, value in excludes_lookups.items():
+            prefix = self.multi_valued_prefix.get(lookup_name)
+            if prefix is None or value is None or value == []:
+                q &= ~Q(**{lookup_name: value})
+            else:
+                groups.setdefault(prefix, []).append(Q(**{lookup_name: value}))
+
+        for conditions in groups.values():
+            if len(conditions) == 1:
+                q &= ~conditions[0]
+            else:
+                q &= ~Q(pk__in=self.model._base_manager.filter(reduce(or_, conditions)).values('pk'))
+        return q
+
+
 class LuSearchFilterBackend:
     SearchField = lu_settings.SEARCH_FIELD
     SearchValue = lu_settings.SEARCH_VALUE
@@ -68,6 +196,8 @@ class LuSearchFilterBackend:
         '8': _LookUp("in", __FILTER__, "在"),
         '9': _LookUp("in", __EXCLUDE__, "不在"),
     }
+    # 查询计划LRU缓存，key为 (model, 查询字段, 查询类型, queryset中的annotation)
+    PlanCache = LuLRUCache(lu_settings.SEARCH_PLAN_CACHE_SIZE)
 
     def _get_search_info(self, request, search_category):
         category = request.query_params.get(search_category)
@@ -81,53 +211,46 @@ class LuSearchFilterBackend:
             result.append(lookup if lookup else self.DefaultSearchType)
         return result
 
-    def _generate_search_set(self, request):
-        # return generator as (search_field,search_value,search_lookup)
-        return zip(
-            self._get_search_info(request, self.SearchField),
-            self._get_search_info(request, self.SearchValue),
-            self._trans_search_type_to_lookup(self._get_search_info(request, self.SearchType))
-        )
-
-    def _get_lookups_dict(self, search_set):
-        filters_lookup = {}
-        excludes_lookup = {}
-        for (field, value, lookup) in search_set:
-            value = None if value == lu_settings.FILTER_NULL_VALUE else value
-            if lookup.lookup in ['in']:
-                value = value.split(self.SearchValueDelimiter) if value else []
-            lookup_name = '{}__{}'.format(field, lookup.lookup)
-            if lookup.filter_type == __FILTER__:
-                filters_lookup[lookup_name] = value
-            if lookup.filter_type == __EXCLUDE__:
-                excludes_lookup[lookup_name] = value
-
-        return filters_lookup, excludes_lookup
-
-    def _render_queryset(self, queryset, filters_lookups, excludes_lookups):
+    def _get_search_plan(self, request, queryset):
+        """
+        编译(或从缓存获取)本次请求的查询计划
+        查询字段、查询值、查询类型按位置一一对应，以三者中最短的为准
+        :return: (plan, values)
+        """
+        fields = self._get_search_info(request, self.SearchField)
+        values = self._get_search_info(request, self.SearchValue)
+        lookups = self._trans_search_type_to_lookup(self._get_search_info(request, self.SearchType))
+        size = min(len(fields), len(values), len(lookups))
+        fields, lookups = fields[:size], tuple(lookups[:size])
+        annotations = tuple(sorted(queryset.query.annotations))
+        key = (queryset.model, fields, tuple((lookup.lookup, lookup.filter_type) for lookup in lookups), annotations)
+        plan = self.PlanCache.get(key)
+        if plan is None:
+            plan = _SearchPlan(queryset.model, fields, lookups, annotations)
+            self.PlanCache.set(key, plan)
+        return plan, values[:size]
+
+    def _render_queryset(self, queryset, plan, filters_lookups, excludes_lookups):
         queryset = queryset.filter(**filters_lookups) if filters_lookups else queryset
 
         """
-        这里exclude两种实现方式
-        1、exclude(**excludes_lookups)
-        对应SQL：where not (cond1 and cond2 and ...)
-        逻辑：每个条件是 或 连接
-        
-        2、遍历excludes_lookups，每次插入一条excludes_lookup，生成新的queryset
-        对应SQL：where not cond1 and not cond2 and ...
-        逻辑：每个条件是 与 连接
+        exclude条件之间是 与 连接，对应SQL：where not cond1 and not cond2 and ...
+        所有exclude条件合并为一个Q，只调用一次filter()，见_SearchPlan.build_exclude_q()
+        filter条件单独调用filter()：同一次filter()中，取反条件会复用filter条件的多值关联join，改变查询含义
         """
-        # queryset = queryset.exclude(**excludes_lookups) if excludes_lookups else queryset
-        for k, v in excludes_lookups.items():
-            queryset = queryset.exclude(**{k: v})
+        if excludes_lookups:
+            queryset = queryset.filter(plan.build_exclude_q(excludes_lookups))
 
         return queryset
 
     def filter_queryset(self, request, queryset, view):
-        search_set = self._generate_search_set(request)
-        filters_lookups, excludes_lookups = self._get_lookups_dict(search_set)
+        plan, values = self._get_search_plan(request, queryset)
+        if not values:
+            return queryset
+        check_search(view, plan.conditions)
+        filters_lookups, excludes_lookups = plan.bind(values, self.SearchValueDelimiter)
 
-        queryset = self._render_queryset(queryset, filters_lookups, excludes_lookups)
+        queryset = self._render_queryset(queryset, plan, filters_lookups, excludes_lookups)
 
         return queryset
 
@@ -142,7 +265,15 @@ class LuOrderFilterBackend:
         return fields
 
     def filter_queryset(self, request, queryset, view):
+        """
+        未指定排序字段时保留queryset原有的排序；分组统计的排序由LuAggregateFilterBackend校验并设置
+        """
+        if getattr(view, 'lu_aggregated', False):
+            return queryset
         order_fields = self.get_order_fields(request)
+        if not order_fields:
+            return queryset
+        check_order(view, queryset.model, order_fields)
         queryset = queryset.order_by(*order_fields)
         return queryset
 
@@ -159,31 +290,156 @@ class LuDistinctFilterBackend:
 
     def filter_queryset(self, request, queryset, view):
         if self.is_distinct(request):
+            check_distinct(view)
             return queryset.distinct()
         return queryset
 
 
+class LuAggregateFilterBackend:
+    """
+    分组统计: lu_group_by=author,status&lu_aggregate=count,sum:price,avg:price
+    1、结果为 {分组字段: 值, 字段__函数: 统计值, count: 记录数} 的列表，可按分组字段、统计结果排序，经LuPagination分页
+    2、只允许视图中声明的字段
+        lu_group_by_fields = (字段, ...)  允许分组的字段
+        lu_aggregate_fields = {字段: (函数, ...)}  允许统计的字段及函数，函数为None表示不限
+    3、未指定lu_group_by时对所有记录统计，结果只有一条
+    """
+    GroupByField = lu_settings.GROUP_BY_FIELD
+    AggregateField = lu_settings.AGGREGATE_FIELD
+    Delimiter = lu_settings.AGGREGATE_DELIMITER
+    FuncDelimiter = lu_settings.AGGREGATE_FUNC_DELIMITER
+    Functions = OrderedDict((
+        ('count', Count),
+        ('sum', Sum),
+        ('avg', Avg),
+        ('min', Min),
+        ('max', Max),
+    ))
+    CountAll = 'count'
+
+    def _get_values(self, request, param):
+        values = request.query_params.get(param)
+        return [value for value in values.split(self.Delimiter) if value] if values else []
+
+    def get_group_by(self, request, view):
+        group_by = self._get_values(request, self.GroupByField)
+        allowed = getattr(view, 'lu_group_by_fields', None) or ()
+        for field in group_by:
+            if field not in allowed:
+                raise ValidationError({self.GroupByField: '字段 {} 不允许分组'.format(field)})
+        return group_by
+
+    def get_aggregates(self, request, view):
+        """
+        :return: OrderedDict({别名: 统计表达式})
+        """
+        allowed = getattr(view, 'lu_aggregate_fields', None) or {}
+        aggregates = OrderedDict()
+        for item in self._get_values(request, self.AggregateField):
+            if item == self.CountAll:
+                aggregates[self.CountAll] = Count('pk')
+                continue
+            func, _, field = item.partition(self.FuncDelimiter)
+            if func not in self.Functions or not field:
+                raise ValidationError({self.AggregateField: '无效的统计 {}'.format(item)})
+            if field not in allowed or (allowed[field] is not None and func not in allowed[field]):
+                raise ValidationError({self.AggregateField: '字段 {} 不允许 {} 统计'.format(field, func)})
+            aggregates[field + LOOKUP_SEP + func] = self.Functions[func](field)
+        return aggregates
+
+    def get_order_fields(self, request, allowed):
+        """
+        分组后只能按分组字段、统计结果排序，其他字段会被加入GROUP BY
+        """
+        value = request.query_params.get(lu_settings.ORDER_FILED)
+        fields = value.split(lu_settings.ORDER_FILED_DELIMITER) if value else []
+        for field in fields:
+            if field.lstrip('-') not in allowed:
+                raise ValidationError({lu_settings.ORDER_FILED: '分组统计时不允许按 {} 排序'.format(field)})
+        return fields
+
+    def filter_queryset(self, request, queryset, view):
+        group_by = self.get_group_by(request, view)
+        aggregates = self.get_aggregates(request, view)
+        if not group_by and not aggregates:
+            return queryset
+        if not aggregates:
+            aggregates[self.CountAll] = Count('pk')
+
+        order_fields = self.get_order_fields(request, set(group_by) | set(aggregates))
+        view.lu_aggregated = True
+        if group_by:
+            return queryset.values(*group_by).annotate(**aggregates).order_by(*(order_fields or group_by))
+        # 按常量分组，即对所有记录统计，结果仍为queryset，可以分页
+        queryset = queryset.annotate(_lu_all=Value(1, output_field=IntegerField())).values('_lu_all')
+        return queryset.annotate(**aggregates).values(*aggregates).order_by()
+
+
 class LuResponseFieldFilterBackend:
+    """
+    按lu_response_field只查询需要输出的列
+    1、默认使用only()保留model实例，序列化器方法等照常可用；跨外键的路径(如 author__name)自动select_related
+       需要查询的列由序列化器过滤后的字段推断，SerializerMethodField等字段需在视图中声明依赖
+       lu_response_field_requires = {字段名: (字段路径, ...)}，未声明时不做限制
+    2、RESPONSE_FIELD_VALUES开启时使用values()，返回字典
+    """
     SearchField = lu_settings.RESPONSE_FIELD
     SearchValueDelimiter = lu_settings.RESPONSE_FIELD_DELIMITER
 
     def _get_fields(self, request):
-        values = request.query_params.get(self.SearchField)
-        values_list = values.split(self.SearchValueDelimiter) if values else []
-        return tuple(values_list)
+        return get_response_fields(request)
 
     def _get_model_fields(self, view):
         model = getattr(view, 'model', view.queryset.model)
         valid_fields = [field.name for field in model._meta.fields]
         return tuple(valid_fields)
 
-    def filter_queryset(self, request, queryset, view):
-        response_fields = self._get_fields(request)
-        model_fields = self._get_model_fields(view)
-        valid_response_fields = tuple(set(model_fields) & set(response_fields))
-
+    def _filter_values(self, queryset, view, response_fields):
+        model = queryset.model
+        valid_response_fields = tuple(
+            f for f in response_fields
+            if f in self._get_model_fields(view) or (LOOKUP_SEP in f and resolve_field_path(model, f))
+        )
         if valid_response_fields:
             return queryset.values(*valid_response_fields)
-        # todo 仅查询
-        # todo 如果涉及到 methodSerializerField 字段的展示，返回原生queryset
         return queryset
+
+    def _filter_only(self, queryset, view):
+        serializer = view.get_serializer()
+        projection = get_projection(
+            queryset.model, serializer.fields, getattr(view, 'lu_response_field_requires', None)
+        )
+        if not projection:
+            return queryset
+        only, related = projection
+        if related:
+            queryset = queryset.select_related(*related)
+        return queryset.only(*only)
+
+    def filter_queryset(self, request, queryset, view):
+        if getattr(view, 'lu_aggregated', False):
+            # 分组统计的结果字段由lu_group_by、lu_aggregate决定
+            return queryset
+        response_fields = self._get_fields(request)
+        if not response_fields:
+            return queryset
+        if lu_settings.RESPONSE_FIELD_VALUES or queryset.query.values_select:
+            return self._filter_values(queryset, view, response_fields)
+        return self._filter_only(queryset, view)
+
+
+class LuExpandFilterBackend:
+    """
+    lu_expand=author,tags,author.books 展开关联字段
+    1、只允许视图lu_expand_fields中声明的路径，{路径: 序列化器}，序列化器为None时使用关联model的全部字段
+    2、展开层级不超过lu_expand_max_depth或EXPAND_MAX_DEPTH
+    3、关联数据通过Prefetch按页批量查询，并只查询需要输出的列
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        tree = get_expand_tree(request, view)
+        if not tree:
+            return queryset
+        if getattr(view, 'lu_aggregated', False) or queryset.query.values_select:
+            raise ValidationError({lu_settings.EXPAND_FIELD: '分组统计、values查询不支持展开'})
+        return queryset.prefetch_related(*build_expand_prefetches(view, queryset.model, tree))
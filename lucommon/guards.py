@@ -0,0 +1,236 @@
+import json
+from django.core.exceptions import EmptyResultSet, FieldError
+from django.db import connections
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.sql.query import Query
+from .exceptions import LuQueryGuardError
+from .logger import lu_logger
+from .settings import lu_settings
+from .utils import LuLRUCache
+
+# 无法使用索引的查找方式
+EXPENSIVE_LOOKUPS = frozenset(['contains', 'icontains', 'regex', 'iregex', 'endswith', 'iendswith'])
+# 支持EXPLAIN估算扫描行数的数据库
+EXPLAIN_VENDORS = ('mysql', 'postgresql')
+
+_INDEXED_FIELDS = {}
+# 按(数据库, 带占位符的SQL)缓存EXPLAIN估算的扫描行数
+_EXPLAIN_CACHE = LuLRUCache(lu_settings.QUERY_GUARD_EXPLAIN_CACHE_SIZE, lu_settings.QUERY_GUARD_EXPLAIN_CACHE_TTL)
+
+
+def get_indexed_fields(model):
+    """
+    获取model中可以使用索引的字段(主键、唯一键、db_index、外键、Meta.indexes等索引的第一个字段)，每个model只计算一次
+    """
+    model = model._meta.concrete_model
+    fields = _INDEXED_FIELDS.get(model)
+    if fields is not None:
+        return fields
+
+    opts = model._meta
+    names = set()
+    for field in opts.concrete_fields:
+        if field.primary_key or field.unique or field.db_index:
+            names.add(field.name)
+    for index in opts.indexes:
+        if index.fields:
+            names.add(index.fields[0].lstrip('-'))
+    for together in list(opts.unique_together) + list(opts.index_together):
+        if together:
+            names.add(together[0])
+    for constraint in opts.constraints:
+        fields = getattr(constraint, 'fields', None)
+        if fields:
+            names.add(fields[0])
+    fields = frozenset(names | {opts.get_field(name).attname for name in names})
+    _INDEXED_FIELDS[model] = fields
+    return fields
+
+
+def is_indexed(model, path):
+    """
+    判断字段路径的最终字段是否可以使用索引，路径中包含transform(如 created_at__date)时无法使用索引
+    """
+    names = path.split(LOOKUP_SEP)
+    try:
+        _, final_field, _, rest = Query(model).names_to_path(names, model._meta, allow_many=True)
+    except FieldError:
+        return False
+    return is_indexed_field(final_field, rest)
+
+
+def is_indexed_field(final_field, transforms=()):
+    """
+    判断names_to_path解析得到的最终字段是否可以使用索引
+    :param transforms: 字段之后的transform，不为空时无法使用索引
+    """
+    if transforms or not getattr(final_field, 'concrete', False):
+        return False
+    return final_field.name in get_indexed_fields(final_field.model)
+
+
+def _is_enabled(view, attr):
+    return lu_settings.QUERY_GUARD or getattr(view, attr, None) is not None
+
+
+def check_search(view, conditions):
+    """
+    校验查询条件
+    1、视图定义了 lu_search_fields = {字段: (查找方式, ...)} 时，只允许其中的字段及查找方式，查找方式为None表示不限
+    2、未定义时，开启QUERY_GUARD后只允许在可使用索引的字段上使用非模糊查找
+    :param conditions: [(字段路径, 查找方式, 是否可使用索引)]，见filters._SearchPlan
+    """
+    if not _is_enabled(view, 'lu_search_fields'):
+        return
+    allowed = getattr(view, 'lu_search_fields', None)
+    for field, lookup, indexed in conditions:
+        if allowed is not None:
+            if field not in allowed:
+                raise LuQueryGuardError('字段 {} 不允许查询'.format(field))
+            if allowed[field] is not None and lookup not in allowed[field]:
+                raise LuQueryGuardError('字段 {} 不允许使用 {} 查询'.format(field, lookup))
+        elif lookup in EXPENSIVE_LOOKUPS or not indexed:
+            raise LuQueryGuardError('字段 {} 不允许使用 {} 查询'.format(field, lookup))
+
+
+def check_order(view, model, order_fields):
+    """
+    校验排序字段
+    1、视图定义了 lu_order_fields = (字段, ...) 时，只允许其中的字段
+    2、未定义时，开启QUERY_GUARD后只允许可使用索引的字段
+    """
+    if not _is_enabled(view, 'lu_order_fields'):
+        return
+    allowed = getattr(view, 'lu_order_fields', None)
+    for order_field in order_fields:
+        field = order_field.lstrip('-')
+        if allowed is not None:
+            if field not in allowed:
+                raise LuQueryGuardError('字段 {} 不允许排序'.format(field))
+        elif field == '?' or not is_indexed(model, field):
+            raise LuQueryGuardError('字段 {} 不允许排序'.format(field))
+
+
+def check_distinct(view):
+    """
+    校验去重，开启QUERY_GUARD或视图定义了lu_distinct_allowed时，只有lu_distinct_allowed为True才允许去重
+    """
+    if not _is_enabled(view, 'lu_distinct_allowed'):
+        return
+    if not getattr(view, 'lu_distinct_allowed', False):
+        raise LuQueryGuardError('不允许去重查询')
+
+
+def _collect(data, key):
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == key:
+                yield v
+            else:
+                yield from _collect(v, key)
+    elif isinstance(data, list):
+        for item in data:
+            yield from _collect(item, key)
+
+
+def estimate_rows(queryset):
+    """
+    通过EXPLAIN估算查询需要扫描的记录数(各表扫描行数之和)，仅支持mysql、postgresql
+    :return: 估算行数，不支持的数据库返回None
+    """
+    vendor = connections[queryset.db].vendor
+    if vendor == 'mysql':
+        plan = json.loads(queryset.explain(format='json'))
+        return sum(int(rows) for rows in _collect(plan, 'rows_examined_per_scan'))
+    if vendor == 'postgresql':
+        plan = json.loads(queryset.explain(format='json'))
+        return sum(int(rows) for rows in _collect(plan, 'Plan Rows'))
+    return
+
+
+def _get_page_queryset(view, queryset):
+    """
+    列表实际执行的查询: 偏移分页为当前页的切片，游标分页为首页的切片；不分页、lu_limit=-1及导出时为完整查询
+    """
+    paginator = getattr(view, 'paginator', None)
+    request = getattr(view, 'request', None)
+    if request is None or not hasattr(paginator, 'get_limit') or not hasattr(paginator, 'get_offset'):
+        return queryset
+    if request.query_params.get(lu_settings.EXPORT_FIELD):
+        return queryset
+    limit = paginator.get_limit(request)
+    if limit is None or limit == getattr(paginator, 'un_limit_value', None):
+        return queryset
+    cursor_query_param = getattr(paginator, 'cursor_query_param', None)
+    if cursor_query_param and cursor_query_param in request.query_params:
+        return queryset[:limit + 1]
+    offset = paginator.get_offset(request)
+    return queryset[offset:offset + limit]
+
+
+def estimate_page_rows(view, queryset):
+    """
+    对列表实际执行的(分页后的)查询估算扫描行数，结果按查询形状(带占位符的SQL)缓存
+    QUERY_GUARD_EXPLAIN_CACHE_TTL秒内相同形状的查询不再执行EXPLAIN
+    :return: 估算行数，不支持的数据库返回None
+    """
+    if connections[queryset.db].vendor not in EXPLAIN_VENDORS:
+        return
+    page_queryset = _get_page_queryset(view, queryset)
+    try:
+        sql, _ = page_queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    key = (page_queryset.db, sql)
+    rows = _EXPLAIN_CACHE.get(key)
+    if rows is None:
+        rows = estimate_rows(page_queryset)
+        _EXPLAIN_CACHE.set(key, rows)
+    return rows
+
+
+def _has_client_ordering(view):
+    """
+    请求中是否指定了排序或去重，降级会改变客户端要求的结果，只能拒绝
+    """
+    params = view.request.query_params
+    return bool(params.get(lu_settings.ORDER_FILED)) or params.get(lu_settings.DISTINCT_FIELD) == lu_settings.IS_DISTINCT_VALUE
+
+
+def _downgrade(queryset):
+    """
+    去掉排序及去重，避免filesort和临时表
+    """
+    queryset = queryset.order_by()
+    queryset.query.distinct = False
+    queryset.query.distinct_fields = ()
+    return queryset
+
+
+def check_explain(view, queryset):
+    """
+    对列表实际执行的分页查询执行EXPLAIN(见estimate_page_rows)，估算扫描行数超过限制时
+    1、QUERY_GUARD_EXPLAIN_ACTION为reject: 拒绝查询
+    2、QUERY_GUARD_EXPLAIN_ACTION为downgrade: 排序、去重来自默认设置时，去掉排序及去重后重新估算，仍超过限制则拒绝；
+    请求中指定了排序(lu_order_field)或去重时不降级，直接拒绝
+    限制由视图的lu_explain_max_rows或QUERY_GUARD_EXPLAIN_MAX_ROWS指定，0表示不检查
+    :return: 检查通过的queryset
+    """
+    max_rows = getattr(view, 'lu_explain_max_rows', None) or lu_settings.QUERY_GUARD_EXPLAIN_MAX_ROWS
+    if not max_rows:
+        return queryset
+    rows = estimate_page_rows(view, queryset)
+    if rows is None or rows <= max_rows:
+        return queryset
+    if lu_settings.QUERY_GUARD_EXPLAIN_ACTION == 'downgrade':
+        if _has_client_ordering(view):
+            raise LuQueryGuardError('查询预计扫描{}行，超过限制{}行，请去掉排序、去重或缩小查询范围'.format(rows, max_rows))
+        downgraded = _downgrade(queryset)
+        downgraded_rows = estimate_page_rows(view, downgraded)
+        if downgraded_rows <= max_rows:
+            lu_logger.warning('lu query guard downgrade {}: estimated rows {} -> {}'.format(
+                view.__class__.__name__, rows, downgraded_rows
+            ))
+            return downgraded
+        rows = downgraded_rows
+    raise LuQueryGuardError('查询预计扫描{}行，超过限制{}行，请缩小查询范围'.format(rows, max_rows))
@@ -0,0 +1,491 @@
+import atexit
+import base64
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from django.apps import apps
+from django.db import models, transaction, connections, DEFAULT_DB_ALIAS
+from django.utils import timezone
+from .settings import lu_settings
+from .logger import lu_logger
+from .snapshots import get_snapshot_fields, take_snapshot, calculate_diff
+
+CHECKPOINT = 'checkpoint'
+FIELDS = 'fields'
+INTERNAL_OPERATIONS = (CHECKPOINT, FIELDS)
+_COMPRESSED_PREFIX = 'z:'
+_TABLE_MODELS = {}
+_FIELD_MAPS = {}
+
+
+class LuHistory(models.Model):
+    """
+    CREATE TABLE `lu_history` (
+      `id` bigint(20) NOT NULL AUTO_INCREMENT,
+      `type_id` bigint(20) NOT NULL,
+      `type` varchar(255) NOT NULL,
+      `diff` text NOT NULL,
+      `operation` varchar(255) NOT NULL,
+      `created_at` datetime(6) NOT NULL,
+      `created_by` varchar(255) DEFAULT NULL,
+      PRIMARY KEY (`id`),
+      KEY `idx_type_type_id_created_at` (`type`, `type_id`, `created_at`),
+      KEY `idx_created_by` (`created_by`)
+    ) ENGINE=InnoDB AUTO_INCREMENT=1;
+    """
+    type_id = models.BigIntegerField()
+    type = models.CharField(max_length=255)
+    diff = models.TextField()
+    operation = models.CharField(max_length=255)
+    # 非auto_now_add: 取构造时间(写操作发生的时间)，异步批量写入、检查点可指定时间，一次INSERT写入
+    created_at = models.DateTimeField(default=timezone.now)
+    created_by = models.CharField(max_length=255)
+
+    class Meta:
+        db_table = lu_settings.HISTORY_TABLE
+        indexes = [
+            models.Index(fields=['type', 'type_id', 'created_at'], name='idx_type_type_id_created_at'),
+            models.Index(fields=['created_by'], name='idx_created_by'),
+        ]
+
+    def get_diff(self):
+        """
+        解码diff字段，兼容json、紧凑、压缩格式
+        字段映射记录返回各字段在紧凑格式中的序号
+        :return: {attname: {'new': str, 'old': str}}
+        """
+        if not hasattr(self, '_lu_diff'):
+            if self.operation == FIELDS:
+                self._lu_diff = {attr: {'new': i, 'old': None} for i, attr in enumerate(json.loads(self.diff))}
+            else:
+                self._lu_diff = decode_diff(self.type, self.diff, self._state.db)
+        return self._lu_diff
+
+
+def get_model_by_table(db_table):
+    """
+    根据表名获取model类
+    :return: model类，不存在时返回None
+    """
+    if db_table not in _TABLE_MODELS:
+        for model in apps.get_models():
+            _TABLE_MODELS.setdefault(model._meta.db_table, model)
+        _TABLE_MODELS.setdefault(db_table, None)
+    return _TABLE_MODELS[db_table]
+
+
+def _fields_signature(fields):
+    return zlib.crc32(','.join(fields).encode())
+
+
+def _get_field_map(db_table, signature, using=None):
+    """
+    读取字段签名对应的字段列表，已提交的字段映射缓存在进程内
+    :return: 字段列表，不存在时返回None
+    """
+    key = (db_table, signature)
+    fields = _FIELD_MAPS.get(key)
+    if fields is not None:
+        return fields
+    using = using or lu_settings.HISTORY_DATABASE
+    row = LuHistory.objects.using(using).filter(
+        type=db_table, type_id=signature, operation=FIELDS
+    ).order_by('id').first()
+    if row is None:
+        return
+    fields = tuple(json.loads(row.diff))
+    _remember_field_map(key, fields, using)
+    return fields
+
+
+def _remember_field_map(key, fields, using):
+    # 事务中读取、写入的字段映射可能随事务回滚，提交后才缓存
+    transaction.on_commit(lambda: _FIELD_MAPS.setdefault(key, fields), using=using)
+
+
+def _save_field_map(db_table, fields, signature):
+    """
+    紧凑格式依赖的字段映射: 每个表的每个字段签名在历史记录表中保存一条operation为fields的记录，
+    type_id为字段签名，diff为字段名列表；model字段变化后，旧的历史记录仍可按签名找到当时的字段列表
+    映射与历史记录在同一数据库的同一事务中写入，回滚时一同撤销
+    :return: 映射可用时返回True，签名冲突(字段列表不同)时返回False
+    """
+    key = (db_table, signature)
+    if _FIELD_MAPS.get(key) == fields:
+        return True
+    using = lu_settings.HISTORY_DATABASE
+    stored = _get_field_map(db_table, signature, using)
+    if stored is None:
+        LuHistory.objects.using(using).create(
+            type_id=signature, type=db_table, diff=json.dumps(fields), operation=FIELDS, created_by=''
+        )
+        _remember_field_map(key, fields, using)
+        return True
+    return stored == fields
+
+
+def encode_diff(db_table, diff):
+    """
+    将差异编码为字符串
+    1、默认: {"attname": {"new": ..., "old": ...}}
+    2、HISTORY_DIFF_COMPACT: [字段签名, [字段序号, new, old], ...]，字段序号为该字段在model具体字段中的位置，
+    字段签名对应的字段列表保存在历史记录表中(见_save_field_map)，非model字段以字段名代替序号
+    3、HISTORY_DIFF_COMPRESS: 编码结果不小于HISTORY_DIFF_COMPRESS_MIN_SIZE时，zlib压缩并base64编码，以"z:"开头
+    """
+    model = get_model_by_table(db_table) if lu_settings.HISTORY_DIFF_COMPACT else None
+    fields = get_snapshot_fields(model) if model is not None else ()
+    signature = _fields_signature(fields) if model is not None else None
+    if model is not None and _save_field_map(db_table, fields, signature):
+        index = {attname: i for i, attname in enumerate(fields)}
+        payload = [signature]
+        for attr, value in diff.items():
+            payload.append([index.get(attr, attr), value['new'], value['old']])
+        text = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+    else:
+        text = json.dumps(diff)
+
+    if lu_settings.HISTORY_DIFF_COMPRESS and len(text) >= lu_settings.HISTORY_DIFF_COMPRESS_MIN_SIZE:
+        text = _COMPRESSED_PREFIX + base64.b64encode(zlib.compress(text.encode())).decode()
+    return text
+
+
+def decode_diff(db_table, text, using=None):
+    """
+    解码encode_diff的结果
+    紧凑格式的字段签名与当前model不一致时(model字段已变化)，按签名读取写入时的字段列表；
+    字段映射不存在时(早期版本写入的记录)，无法还原的字段名以"#序号"表示
+    """
+    if text.startswith(_COMPRESSED_PREFIX):
+        text = zlib.decompress(base64.b64decode(text[len(_COMPRESSED_PREFIX):])).decode()
+    payload = json.loads(text)
+    if isinstance(payload, dict):
+        return payload
+
+    model = get_model_by_table(db_table)
+    fields = get_snapshot_fields(model) if model is not None else ()
+    if _fields_signature(fields) != payload[0]:
+        fields = _get_field_map(db_table, payload[0], using) or ()
+    diff = {}
+    for attr, new, old in payload[1:]:
+        if isinstance(attr, int):
+            attr = fields[attr] if attr < len(fields) else '#{}'.format(attr)
+        diff[attr] = {'new': new, 'old': old}
+    return diff
+
+
+def _get_table(model_or_table):
+    if isinstance(model_or_table, str):
+        return model_or_table
+    return model_or_table._meta.db_table
+
+
+def get_object_history(model_or_table, pk, since=None, until=None, using=None):
+    """
+    查询某条记录的历史记录，使用(type, type_id, created_at)索引
+    :param model_or_table: model类、model实例或表名
+    :param pk: 记录主键
+    :param since: 起始时间(包含)
+    :param until: 截止时间(包含)
+    :return: 按时间倒序的queryset，不包含检查点、字段映射
+    """
+    queryset = LuHistory.objects.using(using or lu_settings.HISTORY_DATABASE).filter(
+        type=_get_table(model_or_table), type_id=pk
+    ).exclude(operation__in=INTERNAL_OPERATIONS)
+    return _filter_time_range(queryset, since, until).order_by('-created_at', '-id')
+
+
+def get_user_history(user, since=None, until=None, using=None):
+    """
+    查询某个用户产生的历史记录，使用created_by索引
+    :return: 按时间倒序的queryset，不包含检查点、字段映射
+    """
+    queryset = LuHistory.objects.using(using or lu_settings.HISTORY_DATABASE).filter(
+        created_by=user
+    ).exclude(operation__in=INTERNAL_OPERATIONS)
+    return _filter_time_range(queryset, since, until).order_by('-created_at', '-id')
+
+
+def _filter_time_range(queryset, since, until):
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lte=until)
+    return queryset
+
+
+def create_checkpoint(obj, created_by=None, using=None):
+    """
+    以model实例的当前字段值写入一个检查点，get_state_as_of()从最近的检查点开始回放
+    通过history_writer写入，HISTORY_ASYNC开启时在using(默认为obj所在数据库)的事务提交后写入
+    """
+    fields = get_snapshot_fields(obj)
+    db_table = obj._meta.db_table
+    checkpoint = LuHistory(
+        type_id=obj.pk,
+        type=db_table,
+        diff=encode_diff(db_table, calculate_diff(fields, new=take_snapshot(obj, fields))),
+        operation=CHECKPOINT,
+        created_by=created_by or ''
+    )
+    history_writer.save([checkpoint], using=using or obj._state.db)
+    return checkpoint
+
+
+def _replay(db_table, pk, at, using):
+    """
+    从指定时间前最近的检查点开始，按时间顺序回放之后的差异；没有检查点时从第一条历史记录开始回放
+    :return: (状态，回放条数，最后一条差异)
+    """
+    queryset = LuHistory.objects.using(using).filter(type=db_table, type_id=pk, created_at__lte=at)
+
+    checkpoint = queryset.filter(operation=CHECKPOINT).order_by('-created_at', '-id').first()
+    state = None
+    changes = queryset.exclude(operation__in=INTERNAL_OPERATIONS).order_by('created_at', 'id')
+    if checkpoint is not None:
+        state = {attr: value['new'] for attr, value in checkpoint.get_diff().items()}
+        changes = changes.filter(created_at__gt=checkpoint.created_at)
+
+    replayed = 0
+    last_change = None
+    for change in changes.iterator():
+        diff = change.get_diff()
+        if change.operation == 'create':
+            state = {attr: value['new'] for attr, value in diff.items()}
+        elif change.operation == 'delete':
+            state = None
+        else:
+            state = dict(state or {}, **{attr: value['new'] for attr, value in diff.items()})
+        replayed += 1
+        last_change = change
+    return state, replayed, last_change
+
+
+def get_state_as_of(model_or_table, pk, at, using=None):
+    """
+    还原某条记录在指定时间的状态，只读取不写入；检查点由lu_history_checkpoint、lu_history_archive命令写入
+    :return: {attname: str}，指定时间记录不存在或已删除时返回None
+    """
+    state, _, _ = _replay(_get_table(model_or_table), pk, at, using or lu_settings.HISTORY_DATABASE)
+    return state
+
+
+def save_checkpoint(model_or_table, pk, at=None, min_changes=1, created_at=None, using=None):
+    """
+    以回放得到的指定时间的状态写入检查点，直接写入回放所读取的数据库，不经过history_writer缓冲
+    :param at: 还原状态的时间，默认为当前时间
+    :param min_changes: 自上一个检查点以来回放的差异少于该条数时不写入
+    :param created_at: 检查点的时间，默认为最后一条回放差异的时间
+    :param using: 读取历史记录、写入检查点的数据库，默认为HISTORY_DATABASE
+    :return: 检查点实例，未写入(记录不存在、已删除或差异条数不足)时返回None
+    """
+    db_table = _get_table(model_or_table)
+    at = at or timezone.now()
+    using = using or lu_settings.HISTORY_DATABASE
+    state, replayed, last_change = _replay(db_table, pk, at, using)
+    if state is None or replayed < min_changes:
+        return
+    if created_at is None:
+        created_at = last_change.created_at if last_change is not None else at
+    checkpoint = LuHistory(
+        type_id=pk,
+        type=db_table,
+        diff=encode_diff(db_table, {attr: {'new': value, 'old': None} for attr, value in state.items()}),
+        operation=CHECKPOINT,
+        created_at=created_at,
+        created_by=''
+    )
+    # 归档命令在检查点写入后才删除历史记录，需同步写入
+    checkpoint.save(using=using)
+    return checkpoint
+
+
+class _PendingHistories:
+    """
+    等待事务提交的历史记录，同一事务、同一保存点内的记录合并为一个on_commit回调
+    """
+
+    def __init__(self, writer, sids):
+        self.writer = writer
+        self.sids = sids
+        self.histories = []
+
+    def __call__(self):
+        if self.histories:
+            self.writer._put(self.histories)
+
+
+class LuHistoryWriter:
+    """
+    历史记录写入器
+    I、同步模式(HISTORY_ASYNC=False)
+        写操作完成后立即写入历史记录
+    II、异步模式(HISTORY_ASYNC=True)
+        1、历史记录在写操作所在事务提交后才进入缓冲区，事务回滚则丢弃
+        2、缓冲区达到 HISTORY_BATCH_SIZE 条，或距上次写入超过 HISTORY_FLUSH_INTERVAL 秒，由后台线程通过 bulk_create 批量写入
+        3、进程退出时写入缓冲区内剩余记录
+        4、同一事务中等待提交的记录达到 HISTORY_ASYNC_MAX_PENDING 条，且历史记录与写操作在同一数据库时，
+        直接在事务内写入，随事务(保存点)回滚，大批量更新的内存占用有上限
+    III、stats()返回队列深度、写入耗时等统计信息
+    """
+
+    def __init__(self, batch_size, flush_interval, using='default'):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.using = using
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._worker = None
+        self._worker_pid = None
+
+        self._flushed = 0
+        self._failed = 0
+        self._flush_count = 0
+        self._last_flush_latency = 0.0
+        self._max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    @property
+    def is_async(self):
+        return lu_settings.HISTORY_ASYNC
+
+    def save(self, histories, using=None):
+        """
+        :param histories: LuHistory实例列表
+        :param using: 产生历史记录的写操作所使用的数据库，异步模式下在该数据库的事务提交后写入
+        """
+        if not histories:
+            return
+        if not self.is_async:
+            LuHistory.objects.using(self.using).bulk_create(histories, batch_size=self.batch_size)
+            return
+
+        using = using or DEFAULT_DB_ALIAS
+        connection = connections[using]
+        if not connection.in_atomic_block:
+            self._put(histories)
+            return
+        pending = self._get_pending(connection)
+        pending.histories.extend(histories)
+        max_pending = lu_settings.HISTORY_ASYNC_MAX_PENDING
+        if max_pending and using == self.using and len(pending.histories) >= max_pending:
+            # 写入当前保存点，回滚时与数据一同撤销
+            LuHistory.objects.using(self.using).bulk_create(pending.histories, batch_size=self.batch_size)
+            pending.histories = []
+
+    def _get_pending(self, connection):
+        """
+        当前保存点的_PendingHistories，不存在时注册on_commit回调
+        提交、回滚后django会替换run_on_commit列表，据此判断缓存是否失效，避免每次遍历回调列表
+        """
+        sids = frozenset(connection.savepoint_ids)
+        cache = getattr(connection, '_lu_pending_histories', None)
+        if cache is None or cache[0] is not connection.run_on_commit:
+            cache = connection._lu_pending_histories = (connection.run_on_commit, {
+                frozenset(hook_sids): hook for hook_sids, hook in connection.run_on_commit
+                if isinstance(hook, _PendingHistories) and hook.writer is self
+            })
+        pending = cache[1].get(sids)
+        if pending is None:
+            pending = cache[1][sids] = _PendingHistories(self, sids)
+            connection.on_commit(pending)
+        return pending
+
+    def _put(self, histories):
+        with self._lock:
+            self._buffer.extend(histories)
+            is_full = len(self._buffer) >= self.batch_size
+        self._ensure_worker()
+        if is_full:
+            self._wakeup.set()
+
+    def _ensure_worker(self):
+        # fork出的子进程不会继承父进程的线程，需要重新启动
+        pid = os.getpid()
+        if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+                return
+            self._stopped = False
+            self._worker_pid = pid
+            self._worker = threading.Thread(target=self._run, name='lu-history-writer', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                connections[self.using].close_if_unusable_or_obsolete()
+
+    def _bulk_create(self, histories):
+        start = time.perf_counter()
+        try:
+            LuHistory.objects.using(self.using).bulk_create(histories, batch_size=self.batch_size)
+        except Exception:
+            self._failed += len(histories)
+            lu_logger.exception('lu history 写入失败，丢弃{}条记录'.format(len(histories)))
+            return 0
+        latency = (time.perf_counter() - start) * 1000
+        self._flushed += len(histories)
+        self._flush_count += 1
+        self._last_flush_latency = latency
+        self._max_flush_latency = max(self._max_flush_latency, latency)
+        self._total_flush_latency += latency
+        return len(histories)
+
+    def flush(self):
+        """
+        写入缓冲区内的所有历史记录
+        :return: 写入条数
+        """
+        with self._flush_lock:
+            with self._lock:
+                histories, self._buffer = self._buffer, []
+            if not histories:
+                return 0
+            result = self._bulk_create(histories)
+            lu_logger.debug('lu history flush {} rows in {:.2f}ms, queue depth {}'.format(
+                result, self._last_flush_latency, self.queue_depth
+            ))
+            return result
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        worker = self._worker
+        if worker is not None and worker.is_alive() and worker is not threading.current_thread():
+            worker.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    @property
+    def queue_depth(self):
+        return len(self._buffer)
+
+    def stats(self):
+        return OrderedDict(
+            queue_depth=self.queue_depth,
+            flushed=self._flushed,
+            failed=self._failed,
+            flush_count=self._flush_count,
+            last_flush_latency_ms=round(self._last_flush_latency, 3),
+            max_flush_latency_ms=round(self._max_flush_latency, 3),
+            avg_flush_latency_ms=round(self._total_flush_latency / self._flush_count, 3) if self._flush_count else 0.0,
+        )
+
+
+history_writer = LuHistoryWriter(
+    batch_size=lu_settings.HISTORY_BATCH_SIZE,
+    flush_interval=lu_settings.HISTORY_FLUSH_INTERVAL,
+    using=lu_settings.HISTORY_DATABASE
+)
+atexit.register(history_writer.close)
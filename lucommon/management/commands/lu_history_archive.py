@@ -0,0 +1,74 @@
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from lucommon.history import FIELDS, LuHistory, save_checkpoint
+from lucommon.settings import lu_settings
+
+
+class Command(BaseCommand):
+    """
+    归档历史记录
+    1、按(type, type_id, created_at)索引顺序分批读取created_at早于保留期限的记录，写入gzip压缩的jsonl文件，diff字段解码后写入
+    2、每批写入文件后再删除该批记录，每批单独提交，避免长时间锁表；已删除的记录不会再被读取，每批都从头读取
+    3、紧凑格式依赖的字段映射(operation为fields)不归档，保留的历史记录仍可解码
+    4、删除某条记录的历史前，以其在保留期限时的状态写入检查点，get_state_as_of()仍可还原保留期内的状态
+    同一条记录的历史相邻，(type, type_id)变化时写入检查点，只需保存上一条记录的键
+    """
+    help = '将超出保留期限的历史记录归档到本地压缩文件并删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=lu_settings.HISTORY_RETENTION_DAYS, help='保留天数')
+        parser.add_argument('--dir', default=lu_settings.HISTORY_ARCHIVE_DIR, help='归档目录')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批归档条数')
+        parser.add_argument('--sleep', type=float, default=0, help='每批之间的间隔（秒）')
+        parser.add_argument('--database', default=lu_settings.HISTORY_DATABASE, help='历史记录表所在数据库')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        if not os.path.isdir(options['dir']):
+            os.makedirs(options['dir'])
+        file_name = os.path.join(options['dir'], '{}_{}.jsonl.gz'.format(
+            lu_settings.HISTORY_TABLE, timezone.now().strftime('%Y%m%d%H%M%S')
+        ))
+
+        # 检查点的created_at为cutoff，不会被再次读取
+        queryset = LuHistory.objects.using(options['database']).filter(
+            created_at__lt=cutoff
+        ).exclude(operation=FIELDS).order_by('type', 'type_id', 'created_at', 'pk')
+        total = 0
+        last_key = None
+        with gzip.open(file_name, 'wt', encoding='utf-8') as f:
+            while True:
+                rows = list(queryset[:options['batch_size']])
+                if not rows:
+                    break
+                for row in rows:
+                    key = (row.type, row.type_id)
+                    if key != last_key:
+                        last_key = key
+                        save_checkpoint(row.type, row.type_id, at=cutoff, min_changes=0, created_at=cutoff,
+                                        using=options['database'])
+                    f.write(json.dumps({
+                        'id': row.pk,
+                        'type_id': row.type_id,
+                        'type': row.type,
+                        'diff': row.get_diff(),
+                        'operation': row.operation,
+                        'created_at': row.created_at.isoformat(),
+                        'created_by': row.created_by,
+                    }, ensure_ascii=False) + '\n')
+                f.flush()
+                LuHistory.objects.using(options['database']).filter(pk__in=[row.pk for row in rows]).delete()
+                total += len(rows)
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+        if not total:
+            os.remove(file_name)
+        self.stdout.write('archived {} rows older than {} to {}'.format(
+            total, cutoff.isoformat(), file_name if total else '-'
+        ))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from lucommon.history import INTERNAL_OPERATIONS, LuHistory, save_checkpoint
+from lucommon.settings import lu_settings
+
+
+class Command(BaseCommand):
+    """
+    写入历史记录检查点，get_state_as_of()从最近的检查点开始回放，不再在查询时写入
+    1、按(type, type_id)统计差异条数，不少于interval条的记录回放至当前时间
+    2、自上一个检查点以来回放的差异不少于interval条时写入检查点，时间为最后一条差异的时间
+    """
+    help = '为回放差异较多的记录写入历史记录检查点'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=lu_settings.HISTORY_CHECKPOINT_INTERVAL,
+                            help='自上一个检查点以来的差异条数达到该值时写入检查点')
+        parser.add_argument('--type', help='只处理该表的历史记录')
+        parser.add_argument('--database', default=lu_settings.HISTORY_DATABASE, help='历史记录表所在数据库')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval <= 0:
+            self.stdout.write('checkpoint interval is 0, skipped')
+            return
+        queryset = LuHistory.objects.using(options['database']).exclude(operation__in=INTERNAL_OPERATIONS)
+        if options['type']:
+            queryset = queryset.filter(type=options['type'])
+        groups = queryset.values_list('type', 'type_id').annotate(
+            changes=Count('id')
+        ).filter(changes__gte=interval).order_by()
+
+        total = 0
+        for db_table, type_id, _ in list(groups):
+            if save_checkpoint(db_table, type_id, min_changes=interval, using=options['database']) is not None:
+                total += 1
+        self.stdout.write('wrote {} checkpoints'.format(total))
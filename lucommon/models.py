@@ -1,5 +1,7 @@
 from django.db import models
 from .managers import LuManager
+from .settings import lu_settings
+from .caches import bump_deleted_versions
 
 
 class LuModel(models.Model):
@@ -26,3 +28,22 @@ class LuModel(models.Model):
 
         """
         pass
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if lu_settings.OPTIMISTIC_LOCK_ATOMIC:
+            # 只保存读取结果的引用，不做拷贝；更新时作为旧值计算差异，省去更新前的查询(见LuQuerySet._update_with_lock)
+            instance._lu_loaded = (field_names, values)
+        return instance
+
+    def delete(self, using=None, keep_parents=False):
+        # Model.delete()不经过QuerySet.delete()，单独更新表的版本号
+        deleted, rows_count = super().delete(using=using, keep_parents=keep_parents)
+        bump_deleted_versions(rows_count, using=using or self._state.db)
+        return deleted, rows_count
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # 通过hints将当前实例传递给LuQuerySet._update()
+        base_qs._hints = dict(base_qs._hints, instance=self)
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
@@ -1,42 +1,377 @@
+import base64
+import binascii
+import datetime
+import decimal
+import hashlib
+import json
+import uuid
 from rest_framework import pagination
-from rest_framework.response import Response
-from collections import OrderedDict
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import F, Q
+from django.db.models.constants import LOOKUP_SEP
+from .budgets import track_queries
+from .executors import LuExecutorFull, can_run_parallel, get_count_executor
+from .renderers import LuPage
+from .response import LuResponse
 from .settings import lu_settings
+from .timings import timing
+
+_CURSOR_KEY = '_lu_cursor_{}'
+COUNT_MODES = ('exact', 'cached', 'estimate', 'none')
+
+
+def _encode_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    return value
+
+
+def encode_cursor(values, reverse=False):
+    data = json.dumps({'v': [_encode_value(v) for v in values], 'r': int(reverse)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :return: (values, reverse)
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(data.decode())
+        return list(data['v']), bool(data['r'])
+    except (TypeError, ValueError, KeyError, binascii.Error):
+        raise ValidationError({lu_settings.PAGINATION_CURSOR_FIELD: '无效的游标'})
+
+
+def get_keyset_ordering(queryset):
+    """
+    获取keyset分页的排序字段，在LuOrderFilterBackend或model默认排序的基础上追加主键作为唯一排序
+    :return: [(字段路径, 是否倒序)]，不支持的排序(随机、表达式)及分组查询返回None
+    """
+    if queryset.query.group_by is not None:
+        return
+    ordering = list(queryset.query.order_by)
+    if not ordering and queryset.query.default_ordering:
+        ordering = list(queryset.model._meta.ordering)
+    result = []
+    for field in ordering:
+        if not isinstance(field, str) or field == '?':
+            return
+        descending = field.startswith('-')
+        result.append((field.lstrip('-'), descending))
+
+    pk_names = ('pk', queryset.model._meta.pk.name, queryset.model._meta.pk.attname)
+    if not any(field in pk_names for field, _ in result):
+        result.append(('pk', result[-1][1] if result else False))
+    return result
+
+
+def _nulls_first(connection, descending):
+    # mysql、sqlite中NULL最小，postgresql、oracle中NULL最大
+    nulls_small = connection.vendor in ('mysql', 'sqlite')
+    return nulls_small != descending
+
+
+def get_seek_q(ordering, values, connection):
+    """
+    生成keyset分页的定位条件：按排序顺序位于values之后的记录
+    (a, b, pk) > (va, vb, vpk) => a > va or (a = va and b > vb) or (a = va and b = vb and pk > vpk)
+    """
+    # 不引用主键: 分组查询中引用主键会使其加入GROUP BY
+    q = None
+    equal = Q()
+    for (field, descending), value in zip(ordering, values):
+        if value is None:
+            after = Q(**{field + LOOKUP_SEP + 'isnull': False}) if _nulls_first(connection, descending) else None
+            eq = Q(**{field + LOOKUP_SEP + 'isnull': True})
+        else:
+            after = Q(**{field + LOOKUP_SEP + ('lt' if descending else 'gt'): value})
+            if not _nulls_first(connection, descending):
+                after |= Q(**{field + LOOKUP_SEP + 'isnull': True})
+            eq = Q(**{field: value})
+        if after is not None:
+            q = equal & after if q is None else q | (equal & after)
+        equal &= eq
+    return q if q is not None else Q(pk__in=[])
+
+
+def pop_cursor_values(row, size):
+    """
+    取出并移除查询时附加的排序字段值
+    """
+    keys = [_CURSOR_KEY.format(i) for i in range(size)]
+    if isinstance(row, dict):
+        return [row.pop(key) for key in keys]
+    values = [getattr(row, key) for key in keys]
+    for key in keys:
+        delattr(row, key)
+    return values
+
+
+def annotate_cursor_values(queryset, ordering):
+    return queryset.annotate(**{_CURSOR_KEY.format(i): F(field) for i, (field, _) in enumerate(ordering)})
+
+
+def get_cached_count(queryset, timeout):
+    """
+    以编译后的SQL及参数作为key缓存总数
+    """
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    key = 'lu_count:{}'.format(hashlib.md5('{}:{}:{}'.format(queryset.db, sql, params).encode()).hexdigest())
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+def is_unfiltered(queryset):
+    query = queryset.query
+    return not query.where and not query.distinct and not query.combinator and query.group_by is None
+
+
+def estimate_count(queryset):
+    """
+    通过表统计信息估算总数，仅支持mysql(information_schema)、postgresql(pg_class)
+    :return: 估算值，不支持的数据库或无统计信息时返回None
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)'
+    else:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return
+    return int(row[0])
+
+
+def support_deferred_join(queryset):
+    """
+    去重、分组、组合查询的结果与主键不一一对应；values()中不包含主键时无法按主键还原顺序
+    """
+    query = queryset.query
+    if query.distinct or query.combinator or query.group_by is not None:
+        return False
+    if query.values_select and queryset.model._meta.pk.attname not in query.values_select:
+        return False
+    return True
+
+
+def fetch_by_deferred_join(queryset, start, stop):
+    """
+    延迟关联: 先按偏移量只查询主键(可走覆盖索引)，再按主键查询完整记录，避免数据库读取并丢弃大量完整的行
+    结果与queryset[start:stop]一致
+    """
+    pks = list(queryset.values_list('pk', flat=True)[start:stop])
+    if not pks:
+        return []
+    pk_attname = queryset.model._meta.pk.attname
+    rows = {}
+    for row in queryset.order_by().filter(pk__in=set(pks)):
+        rows[row[pk_attname] if isinstance(row, dict) else row.pk] = row
+    return [rows[pk] for pk in pks if pk in rows]
 
 
 class LuPagination(pagination.LimitOffsetPagination):
+    """
+    I、偏移分页(默认): lu_limit、lu_offset
+        总数统计方式由视图的lu_count_mode或PAGINATION_COUNT_MODE指定
+        1、exact: 每次执行COUNT
+        2、cached: 按SQL缓存COUNT结果，缓存时间为PAGINATION_COUNT_CACHE_TTL
+        3、estimate: 未带查询条件的列表使用表统计信息估算总数，其余情况同exact
+        4、none: 不统计总数，count返回None，多查询一条记录判断是否有下一页
+        lu_limit=-1展示所有数据时，cached、estimate均执行精确的COUNT
+        偏移量超过PAGINATION_DEFERRED_JOIN_OFFSET时使用延迟关联查询
+        异步视图中COUNT与分页查询并行执行(见submit_count)
+    II、游标分页: 请求中带有lu_cursor参数时(首页传空值)，按排序字段值定位下一页，不执行COUNT，count返回None
+        1、排序字段来自LuOrderFilterBackend或model默认排序，自动追加主键保证排序唯一
+        2、next、previous中的lu_cursor为不透明的游标，响应格式与偏移分页相同
+    """
     limit_query_param = lu_settings.PAGINATION_LIMIT_FIELD
     offset_query_param = lu_settings.PAGINATION_OFFSET_FIELD
+    cursor_query_param = lu_settings.PAGINATION_CURSOR_FIELD
     default_limit = lu_settings.PAGINATION_DEFAULT_LIMIT
     max_limit = lu_settings.PAGINATION_MAX_LIMIT
     un_limit_value = lu_settings.PAGINATION_UN_LIMIT_VALUE
 
+    cursor_mode = False
+    count_mode = 'exact'
+    count_estimated = False
+    has_next = False
+
     def get_paginated_response(self, data):
-        return Response({
-            'data': data,
-            'pagination': OrderedDict({
-                'next': self.get_next_link(),
-                'previous': self.get_previous_link(),
-                'count': self.count
-            })
-        })
+        return LuResponse(LuPage(data, self.get_next_link(), self.get_previous_link(), self.count))
 
     def paginate_queryset(self, queryset, request, view=None):
-        self.count = self.get_count(queryset)
+        if self.cursor_query_param in request.query_params:
+            return self.paginate_queryset_by_cursor(queryset, request, view)
+
+        self.count_mode = self.get_count_mode(view)
         self.limit = self.get_limit(request)
         if self.limit is None:
             return None
-        if self.limit == self.un_limit_value:
-            self.limit = self.count
-
         self.offset = self.get_offset(request)
         self.request = request
+        if self.count_mode == 'none':
+            return self.paginate_queryset_without_count(queryset)
+        if self.limit == self.un_limit_value and self.count_mode in ('estimate', 'cached'):
+            # 展示所有数据时需要精确的总数，估算值、缓存的总数可能偏小，会丢弃之后新增的记录
+            self.count_mode = 'exact'
+
+        future = None
+        if self.limit != self.un_limit_value:
+            future = self.submit_count(queryset, view)
+        if future is not None:
+            rows = self.fetch_rows(queryset, self.offset, self.offset + self.limit)
+            self.count = future.result()
+        else:
+            self.count = self.get_count(queryset)
+        if self.limit == self.un_limit_value:
+            self.limit = self.count
         if self.count > self.limit and self.template is not None:
             self.display_page_controls = True
 
-        if self.count == 0 or self.offset > self.count:
+        # 估算值可能偏小，不据此提前返回
+        if not self.count_estimated and (self.count == 0 or self.offset > self.count):
             return []
-        return list(queryset[self.offset:self.offset + self.limit])
+        if future is not None:
+            return rows
+        return self.fetch_rows(queryset, self.offset, self.offset + self.limit)
+
+    def paginate_queryset_without_count(self, queryset):
+        self.count = None
+        if self.limit == self.un_limit_value:
+            with timing('fetch'):
+                rows = list(queryset[self.offset:])
+            self.limit = len(rows)
+            self.has_next = False
+            return rows
+        rows = self.fetch_rows(queryset, self.offset, self.offset + self.limit + 1)
+        self.has_next = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def fetch_rows(self, queryset, start, stop):
+        with timing('fetch'):
+            threshold = lu_settings.PAGINATION_DEFERRED_JOIN_OFFSET
+            if threshold and start > threshold and support_deferred_join(queryset):
+                return fetch_by_deferred_join(queryset, start, stop)
+            return list(queryset[start:stop])
+
+    def get_count_mode(self, view):
+        count_mode = getattr(view, 'lu_count_mode', None) or lu_settings.PAGINATION_COUNT_MODE
+        if count_mode not in COUNT_MODES:
+            raise ValueError('lu_count_mode must be one of {}'.format(COUNT_MODES))
+        return count_mode
+
+    def get_count(self, queryset):
+        with timing('count'):
+            if self.count_mode == 'cached':
+                return get_cached_count(queryset, lu_settings.PAGINATION_COUNT_CACHE_TTL)
+            if self.count_mode == 'estimate' and is_unfiltered(queryset):
+                count = estimate_count(queryset)
+                if count is not None and count >= lu_settings.PAGINATION_COUNT_ESTIMATE_MIN:
+                    self.count_estimated = True
+                    return count
+            return super().get_count(queryset)
+
+    def submit_count(self, queryset, view):
+        """
+        异步视图(lu_async)中COUNT提交到独立的线程池，与分页查询并行执行
+        估算总数、事务中、内存数据库下及COUNT线程池排队已满时不并行，返回None
+        """
+        if not getattr(view, 'lu_async', False) or not lu_settings.ASYNC_PARALLEL_COUNT:
+            return
+        if self.count_mode == 'estimate' or not can_run_parallel(queryset.db):
+            return
+
+        def count():
+            with track_queries(view):
+                return self.get_count(queryset)
+        try:
+            return get_count_executor().submit(count)
+        except LuExecutorFull:
+            return
+
+    def paginate_queryset_by_cursor(self, queryset, request, view=None):
+        query = queryset.query
+        if query.distinct and (query.values_select or query.distinct_fields):
+            # 游标需附加排序字段值及主键，会改变values()、DISTINCT ON去重的结果
+            raise ValidationError({self.cursor_query_param: '去重查询不支持游标分页'})
+        ordering = get_keyset_ordering(queryset)
+        if ordering is None:
+            raise ValidationError({self.cursor_query_param: '当前排序不支持游标分页'})
+
+        self.cursor_mode = True
+        self.request = request
+        self.count = None
+        self.limit = self.get_limit(request)
+        if self.limit is None or self.limit == self.un_limit_value:
+            self.limit = self.max_limit
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        values, reverse = decode_cursor(cursor) if cursor else (None, False)
+        if values is not None and len(values) != len(ordering):
+            raise ValidationError({self.cursor_query_param: '无效的游标'})
+
+        # 向前翻页时按相反顺序查询，再将结果反转
+        seek_ordering = [(field, descending != reverse) for field, descending in ordering]
+        queryset = annotate_cursor_values(queryset, ordering).order_by(
+            *[('-' if descending else '') + field for field, descending in seek_ordering]
+        )
+        if values is not None:
+            queryset = queryset.filter(get_seek_q(seek_ordering, values, connections[queryset.db]))
+
+        with timing('fetch'):
+            rows = list(queryset[:self.limit + 1])
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if reverse:
+            rows.reverse()
+        keys = [pop_cursor_values(row, len(ordering)) for row in rows]
+
+        self.next_cursor = self.previous_cursor = None
+        if keys:
+            if has_more or reverse:
+                self.next_cursor = encode_cursor(keys[-1])
+            if (has_more and reverse) or (values is not None and not reverse):
+                self.previous_cursor = encode_cursor(keys[0], reverse=True)
+        return rows
+
+    def _get_cursor_link(self, cursor):
+        if cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        if self.cursor_mode:
+            return self._get_cursor_link(self.next_cursor)
+        if self.count is None:
+            if not self.has_next:
+                return None
+            url = replace_query_param(self.request.build_absolute_uri(), self.limit_query_param, self.limit)
+            return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+        return super().get_next_link()
+
+    def get_previous_link(self):
+        if self.cursor_mode:
+            return self._get_cursor_link(self.previous_cursor)
+        return super().get_previous_link()
 
     def get_limit(self, request):
         if self.limit_query_param:
@@ -1,89 +1,121 @@
-from django.db import models
+from django.db import models, transaction, connections
+from django.db.models import DEFERRED
+from django.core.exceptions import ValidationError
 from .utils import get_cur_user
-from copy import deepcopy
 from .settings import lu_settings
 from .exceptions import LuLockError
-import json
+from .history import LuHistory, history_writer, encode_diff
+from .logger import lu_logger
+from .snapshots import get_snapshot_fields, take_snapshot, calculate_diff, MUTABLE_TYPES
+from .caches import bump_table_version, bump_deleted_versions
+from .timings import timing
 
 VERSION = lu_settings.OPTIMISTIC_LOCK_FIELD
 IS_IDEMPOTENT_CHECK = lu_settings.OPTIMISTIC_LOCK_CHECK
+IS_ATOMIC_LOCK = lu_settings.OPTIMISTIC_LOCK_ATOMIC
 UpdaterField = lu_settings.UPDATER_FIELD
 CreatorField = lu_settings.CREATOR_FIELD
 
 
-class LuHistory(models.Model):
+def _build_history(type_id, type, diff, operation, created_by):
+    if not diff:
+        return
+    return LuHistory(
+        type_id=type_id,
+        type=type,
+        diff=encode_diff(type, diff),
+        operation=operation,
+        created_by=created_by
+    )
+
+
+def _save_histories(histories, using=None):
+    if lu_settings.SAVE_HISTORY:
+        with timing('history'):
+            history_writer.save([history for history in histories if history is not None], using=using)
+
+
+def _save_history(type_id, type, diff, operation, created_by, using=None):
+    if lu_settings.SAVE_HISTORY:
+        _save_histories([_build_history(type_id, type, diff, operation, created_by)], using=using)
+
+
+def _iterate_by_pk(queryset, fields, chunk_size):
     """
-    CREATE TABLE `lu_history` (
-      `id` bigint(20) NOT NULL AUTO_INCREMENT,
-      `type_id` bigint(20) NOT NULL,
-      `type` varchar(255) NOT NULL,
-      `diff` text NOT NULL,
-      `operation` varchar(255) NOT NULL,
-      `created_at` datetime(6) NOT NULL,
-      `created_by` varchar(255) DEFAULT NULL,
-      PRIMARY KEY (`id`)
-    ) ENGINE=InnoDB AUTO_INCREMENT=1;
+    按主键分段读取queryset中的指定字段，每次最多读取chunk_size条，内存占用与匹配记录数无关
+    :return: generator，每次返回一段 (pk, *fields) 元组列表
     """
-    type_id = models.BigIntegerField()
-    type = models.CharField(max_length=255)
-    diff = models.TextField()
-    operation = models.CharField(max_length=255)
-    created_at = models.DateTimeField(auto_now_add=True)
-    created_by = models.CharField(max_length=255)
-
-    class Meta:
-        db_table = lu_settings.HISTORY_TABLE
-
-
-def _filter_private_attr(obj: dict):
-    return {k: v for k, v in obj.items() if not str(k).startswith('_')}
-
-
-def _calculate_diff(new: dict, old: dict):
-    new = _filter_private_attr(new)
-    old = _filter_private_attr(old)
-    diff = {}
-
-    if not old:
-        # insert
-        for attr in new:
-            diff[attr] = {'new': str(new[attr]), 'old': None}
-    elif not new:
-        # delete
-        for attr in old:
-            diff[attr] = {'new': None, 'old': str(old[attr])}
-    else:
-        # update
-        for attr in new:
-            new_value, old_value = new[attr], old[attr]
-            if new_value != old_value:
-                diff[attr] = {'new': str(new_value), 'old': str(old_value)}
-    return diff
-
-
-def _save_history(type_id, type, diff, operation, created_by):
-    # todo async
-    if lu_settings.SAVE_HISTORY:
-        if diff:
-            data = dict(
-                type_id=type_id,
-                type=type,
-                diff=json.dumps(diff),
-                operation=operation,
-                created_by=created_by
-            )
-            LuHistory.objects.using('default').create(**data)
+    queryset = queryset.order_by('pk').values_list('pk', *fields)
+    last_pk = None
+    while True:
+        chunk_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk_queryset[:chunk_size])
+        if not rows:
+            return
+        # 跨多值关联过滤时同一条记录可能出现多次
+        chunk = [row for i, row in enumerate(rows) if i == 0 or row[0] != rows[i - 1][0]]
+        if last_pk is not None and chunk[0][0] == last_pk:
+            chunk = chunk[1:]
+        last_pk = rows[-1][0]
+        if chunk:
+            yield chunk
+        if len(rows) < chunk_size:
+            return
 
 
-def _idempotent_check(model: models.Model, data: dict):
+def _select_for_update(queryset):
+    """
+    读取旧值时锁定待更新的记录，避免并发写入使记录的旧值与实际更新前的值不一致
+    数据库支持时只锁定当前表(FOR UPDATE OF)，去重查询无法加锁
+    """
+    features = connections[queryset.db].features
+    if not features.has_select_for_update or queryset.query.distinct:
+        return queryset
+    if features.has_select_for_update_of:
+        return queryset.select_for_update(of=('self',))
+    return queryset.select_for_update()
+
+
+def _recover_bulk_pks(connection, count):
+    """
+    推算最近一次多行INSERT所生成的自增主键，依赖同一语句的自增id连续分配，仅在开启HISTORY_BULK_RECOVER_PK时使用
+    1、mysql: LAST_INSERT_ID()返回该语句生成的第一个id；auto_increment_increment不为1，或innodb_autoinc_lock_mode为2
+    (mysql8的默认值，并发插入时id交错分配)时无法推算
+    2、sqlite: last_insert_rowid()返回最后一个id，同一时间只有一个写入者
+    :return: 主键列表，无法推算时返回None
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode, LAST_INSERT_ID()')
+            increment, lock_mode, first = cursor.fetchone()
+            if int(increment) != 1 or int(lock_mode) not in (0, 1):
+                return
+            return list(range(first, first + count))
+        if connection.vendor == 'sqlite':
+            cursor.execute('SELECT last_insert_rowid()')
+            last = cursor.fetchone()[0]
+            return list(range(last - count + 1, last + 1))
+    return
+
+
+def _to_python(field, value):
+    if isinstance(value, models.Model):
+        value = value.pk
+    try:
+        return field.to_python(value)
+    except ValidationError:
+        return value
+
+
+def _idempotent_check(old: dict, data: dict):
     """
     幂等校验
-    :param model: 更新前的model
-    :param data:
+    :param old: 更新前的字段值
+    :param data: 待更新的字段值
     :return:
     """
-    if hasattr(model, VERSION) and VERSION in data:
-        current_version = getattr(model, VERSION)
+    if VERSION in old and VERSION in data:
+        current_version = old[VERSION]
         request_version = data[VERSION]
         if current_version != request_version:
             raise LuLockError('数据已经被修改，请尝试刷新页面后重试')
@@ -91,20 +123,47 @@ def _idempotent_check(model: models.Model, data: dict):
     return
 
 
+def _get_loaded_values(instance, fields, version):
+    """
+    从model实例读取时的值(LuModel.from_db)中获取指定字段的旧值
+    以下情况返回None，由调用方查询旧值
+    1、实例未记录读取时的值，或字段未读取(defer/only)
+    2、读取时的版本与请求的版本不一致，读取时的值不是本次更新前的值
+    3、字段值为dict、list等可变值，读取后可能已被原地修改
+    """
+    loaded = getattr(instance, '_lu_loaded', None)
+    if loaded is None:
+        return
+    loaded = dict(zip(*loaded))
+    if loaded.get(VERSION, DEFERRED) != version:
+        return
+    old_values = []
+    for attname in fields:
+        value = loaded.get(attname, DEFERRED)
+        if value is DEFERRED or isinstance(value, MUTABLE_TYPES) or hasattr(value, 'resolve_expression'):
+            return
+        old_values.append(value)
+    return tuple(old_values)
+
+
 class LuQuerySet(models.QuerySet):
     """
     LuQuerySet在QuerySet的基础上做了什么
     I、指定字段默认赋值，如果model中定义了这些字段，且未赋值
         1、每次更新对更新人默认赋值为当前用户
         2、每次新建对创建人默认赋值为当前用户
-    II、对新增、修改操作进行记录留痕
+    II、对新增、修改操作进行记录留痕，差异只计算model的具体字段(见snapshots)
         1、_insert()对新增记录做留痕处理
-        2、bulk_create()不会记录创建历史，因为无法获取批量插入数据的id，也不会造成额外开销
-        3、_update()对修改操作做留痕处理，相比于父类方法，会额外产生一次数据库查询开销
-        4、update()对修改操作做留痕处理，相比于父类方法，会产生两次数据库查询开销
-        5、bulk_update() todo
-    III、更新操作进行幂等校验
-        1、_update()通过乐观锁实现幂等
+        2、bulk_create()->_insert()，每批插入后批量记录创建历史；数据库不返回批量插入的主键时跳过历史并记录警告，
+        可通过HISTORY_BULK_RECOVER_PK开启主键推算(见_recover_bulk_pks)
+        3、_update()对修改操作做留痕处理，相比于父类方法，会额外产生一次查询待更新字段旧值的开销
+        4、update()对修改操作做留痕处理，更新前按主键分段读取并锁定(select_for_update)主键及待更新字段，
+        新值由kwargs计算(表达式由数据库在同一查询中计算)，历史记录按段批量写入，
+        异步模式下等待提交的记录超过HISTORY_ASYNC_MAX_PENDING时在事务内写入，内存占用与匹配记录数无关
+        5、bulk_update()->update()，每批更新前读取旧值，历史记录按批写入
+    III、新增、修改、删除后更新表的版本号，使响应缓存失效(见caches)
+    IV、更新操作进行幂等校验
+        1、_update()通过乐观锁实现幂等；开启OPTIMISTIC_LOCK_ATOMIC后，通过条件UPDATE原子校验版本，并发写入时只有一个能成功
         2、update()不做乐观锁控制,queryset中不同model可能拥有不同的version，但是在执行update方法时，传入的kwargs只能指定
         一个version，这样乐观锁校验必然失败
         3、bulk_update()->update()，同上
@@ -115,37 +174,69 @@ class LuQuerySet(models.QuerySet):
 
     def _insert(self, objs, fields, returning_fields=None, raw=False, using=None, ignore_conflicts=False):
         cur_user = get_cur_user()
-        model = objs[0]
-        if hasattr(model, CreatorField):
-            if not getattr(model, CreatorField):
-                setattr(model, CreatorField, cur_user)
+        if hasattr(objs[0], CreatorField):
+            for obj in objs:
+                if not getattr(obj, CreatorField):
+                    setattr(obj, CreatorField, cur_user)
         insert_result = super()._insert(objs, fields, returning_fields, raw, using, ignore_conflicts)
-        if insert_result:
-            # 批量插入不返回id
-            model_copy = deepcopy(model)  # 不对元数据做修改
-            model_copy.pk = insert_result[0][0]
-            mode_dict = model_copy.__dict__
-            diff = _calculate_diff(new=mode_dict, old={})
-            _save_history(
-                type_id=model_copy.pk, type=model_copy.__class__._meta.db_table,
-                diff=diff, operation='create', created_by=cur_user
-            )
+        bump_table_version(self.model._meta.db_table, using=using or self.db)
+        if not lu_settings.SAVE_HISTORY or ignore_conflicts:
+            # 忽略冲突时无法确定哪些记录被插入
+            return insert_result
+
+        using = using or self.db
+        db_table = self.model._meta.db_table
+        snapshot_fields = get_snapshot_fields(self.model)
+        pk_index = snapshot_fields.index(self.model._meta.pk.attname)
+        histories = []
+        for obj, pk in zip(objs, self._get_inserted_pks(objs, insert_result, using)):
+            if pk is None:
+                continue
+            snapshot = list(take_snapshot(obj, snapshot_fields))
+            snapshot[pk_index] = pk
+            diff = calculate_diff(snapshot_fields, new=snapshot)
+            histories.append(_build_history(
+                type_id=pk, type=db_table, diff=diff, operation='create', created_by=cur_user
+            ))
+        _save_histories(histories, using=using)
         return insert_result
 
+    def _get_inserted_pks(self, objs, insert_result, using):
+        """
+        获取插入记录的主键
+        1、数据库返回了主键(单条插入、支持批量返回的数据库)，直接使用
+        2、插入前已指定主键，直接使用
+        3、批量插入未返回主键时，开启HISTORY_BULK_RECOVER_PK后通过最后插入id推算(见_recover_bulk_pks)，并回填到model上；
+        否则跳过这批记录的历史
+        """
+        if insert_result and len(insert_result) == len(objs):
+            return [row[0] for row in insert_result]
+        pks = [obj.pk for obj in objs]
+        if all(pk is not None for pk in pks):
+            return pks
+
+        pks = _recover_bulk_pks(connections[using], len(objs)) if lu_settings.HISTORY_BULK_RECOVER_PK else None
+        if pks is None:
+            lu_logger.warning('lu history 无法获取{}批量插入记录的主键，跳过{}条历史记录'.format(
+                self.model._meta.db_table, len(objs)
+            ))
+            return [None] * len(objs)
+        for obj, pk in zip(objs, pks):
+            obj.pk = pk
+        return pks
+
     def _update(self, values):
         cur_user = get_cur_user()
-        model = self[0]
-        pk = model.id
-        old_dict = deepcopy(model.__dict__)
+        fields = tuple(v[0].attname for v in values)
         new_dict = {}
         values_index_dict = {}
         for i, v in enumerate(values):
             # 获取values中每个字段的位置
             # 获取待更新的字段值
-            values_index_dict[v[0].name] = i
-            new_dict[v[0].name] = v[2]
+            values_index_dict[v[0].attname] = i
+            new_dict[v[0].attname] = v[2]
 
-        if UpdaterField in old_dict:
+        if UpdaterField in values_index_dict:
             if new_dict.get(UpdaterField) is None:
                 _index = values_index_dict[UpdaterField]
                 tmp = list(values[_index])
@@ -153,32 +244,134 @@ class LuQuerySet(models.QuerySet):
                 values[_index] = tuple(tmp)
                 new_dict[UpdaterField] = cur_user
 
+        if IS_IDEMPOTENT_CHECK and IS_ATOMIC_LOCK and VERSION in values_index_dict:
+            return self._update_with_lock(values, values_index_dict, new_dict, cur_user)
+
+        # 只读取待更新字段的旧值
+        old_row = self.values_list('pk', *fields).first()
+        if old_row is None:
+            return self._bump(super()._update(values))
+        pk = old_row[0]
+        old_dict = dict(zip(fields, old_row[1:]))
+
         if IS_IDEMPOTENT_CHECK:
-            if _idempotent_check(model, new_dict) is True:
+            if _idempotent_check(old_dict, new_dict) is True:
                 _index = values_index_dict[VERSION]
                 tmp = list(values[_index])
                 tmp[2] += 1
                 values[_index] = tuple(tmp)
+                new_dict[VERSION] = tmp[2]
 
-        update_result = super()._update(values)
+        update_result = self._bump(super()._update(values))
         if update_result > 0:
-            diff = _calculate_diff(new=new_dict, old=old_dict)
+            diff = calculate_diff(fields, new=[new_dict[f] for f in fields], old=old_row[1:])
             _save_history(
-                type_id=pk, type=model.__class__._meta.db_table,
-                diff=diff, operation='update', created_by=cur_user
+                type_id=pk, type=self.model._meta.db_table,
+                diff=diff, operation='update', created_by=cur_user, using=self.db
             )
         return update_result
 
-    def update(self, **kwargs):
-        old_models = [model for model in self.order_by('pk')]
-        update_result = super().update(**kwargs)
-        new_models = [model for model in self.order_by('pk')]
-        wait_to_diffs = zip(new_models, old_models)
-        for new, old in wait_to_diffs:
-            pk = new.pk
-            diff = _calculate_diff(new.__dict__, old.__dict__)
+    def _update_with_lock(self, values, values_index_dict, new_dict, cur_user):
+        """
+        原子乐观锁：UPDATE ... SET version = version + 1 WHERE pk = %s AND version = %s
+        1、更新行数为0且记录存在时，说明数据已被修改，抛出LuLockError
+        2、model实例在读取时记录了字段值(LuModel.from_db)且可用时，直接作为旧值计算差异，无需更新前查询；
+        否则只读取待更新字段的旧值，版本不一致时直接抛出LuLockError
+        """
+        fields = tuple(values_index_dict)
+        request_version = new_dict[VERSION]
+        instance = self._hints.get('instance')
+        pk = getattr(instance, 'pk', None)
+        old_values = _get_loaded_values(instance, fields, request_version) if lu_settings.SAVE_HISTORY else None
+        if old_values is None and lu_settings.SAVE_HISTORY:
+            old_row = self.values_list('pk', *fields).first()
+            if old_row is None:
+                return self._bump(super()._update(values))
+            pk, old_values = old_row[0], old_row[1:]
+            _idempotent_check(dict(zip(fields, old_values)), new_dict)
+
+        _index = values_index_dict[VERSION]
+        tmp = list(values[_index])
+        tmp[2] = models.F(VERSION) + 1
+        values[_index] = tuple(tmp)
+        new_dict[VERSION] = request_version + 1
+
+        update_result = self._bump(models.QuerySet._update(self.filter(**{VERSION: request_version}), values))
+        if update_result == 0:
+            if self.exists():
+                raise LuLockError('数据已经被修改，请尝试刷新页面后重试')
+            return update_result
+
+        if instance is not None:
+            setattr(instance, VERSION, new_dict[VERSION])
+            if hasattr(instance, '_lu_loaded'):
+                # 更新后的值作为下次更新的旧值
+                loaded = dict(zip(*instance._lu_loaded), **new_dict)
+                instance._lu_loaded = (tuple(loaded), tuple(loaded.values()))
+        if old_values is not None:
+            diff = calculate_diff(fields, new=[new_dict[f] for f in fields], old=old_values)
             _save_history(
-                type_id=pk, type=new.__class__._meta.db_table,
-                diff=diff, operation='update', created_by=get_cur_user()
+                type_id=pk, type=self.model._meta.db_table,
+                diff=diff, operation='update', created_by=cur_user, using=self.db
             )
         return update_result
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        # 批量更新每一批都会调用update()，在update()中按批记录历史
+        objs = tuple(objs)
+        fields = list(fields)
+        if objs and hasattr(objs[0], UpdaterField):
+            cur_user = get_cur_user()
+            for obj in objs:
+                if not getattr(obj, UpdaterField):
+                    setattr(obj, UpdaterField, cur_user)
+            if UpdaterField not in fields:
+                fields.append(UpdaterField)
+        return super().bulk_update(objs, fields, batch_size)
+
+    def _bump(self, rows):
+        if rows:
+            bump_table_version(self.model._meta.db_table, using=self.db)
+        return rows
+
+    def delete(self):
+        deleted, rows_count = super().delete()
+        bump_deleted_versions(rows_count, using=self.db)
+        return deleted, rows_count
+
+    def update(self, **kwargs):
+        if not lu_settings.SAVE_HISTORY:
+            return self._bump(super().update(**kwargs))
+
+        cur_user = get_cur_user()
+        opts = self.model._meta
+        db_table = opts.db_table
+        fields = [opts.get_field(name) for name in kwargs]
+
+        # 表达式(F()、Case()等)的新值在读取旧值的同一条查询中由数据库计算
+        new_values = {}
+        annotations = {}
+        for field, value in zip(fields, kwargs.values()):
+            if hasattr(value, 'resolve_expression'):
+                annotations['_lu_new_{}'.format(field.attname)] = value
+            else:
+                new_values[field.attname] = _to_python(field, value)
+        queryset = self.annotate(**annotations) if annotations else self
+        old_columns = [field.attname for field in fields]
+        expression_columns = [field.attname for field in fields if field.attname not in new_values]
+
+        with transaction.atomic(using=self.db, savepoint=False), \
+                transaction.atomic(using=lu_settings.HISTORY_DATABASE, savepoint=False):
+            queryset = _select_for_update(queryset)
+            for chunk in _iterate_by_pk(queryset, old_columns + list(annotations), lu_settings.HISTORY_BATCH_SIZE):
+                histories = []
+                for row in chunk:
+                    pk, old_values, expression_values = row[0], row[1:len(fields) + 1], row[len(fields) + 1:]
+                    new = dict(new_values, **dict(zip(expression_columns, expression_values)))
+                    diff = calculate_diff(old_columns, new=[new[f] for f in old_columns], old=old_values)
+                    histories.append(_build_history(
+                        type_id=pk, type=db_table, diff=diff, operation='update', created_by=cur_user
+                    ))
+                _save_histories(histories, using=self.db)
+            update_result = self._bump(super().update(**kwargs))
+        return update_result
@@ -0,0 +1,132 @@
+import datetime
+import decimal
+import gzip
+import uuid
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
+from rest_framework.utils.encoders import JSONEncoder
+from .settings import lu_settings
+from .timings import timing
+
+
+class LuPage(dict):
+    """
+    分页响应 {"data": [...], "pagination": {"next", "previous", "count"}}
+    1、普通字典，视图、中间件可按字典修改
+    2、键未被修改时，LuJSONRenderer分别编码data及pagination后直接拼接外层结构
+    """
+    KEYS = ('data', 'pagination')
+
+    def __init__(self, data, next_link, previous_link, count):
+        super().__init__(data=data, pagination={'next': next_link, 'previous': previous_link, 'count': count})
+
+
+def _encode_datetime(obj):
+    representation = obj.isoformat()
+    if representation.endswith('+00:00'):
+        representation = representation[:-6] + 'Z'
+    return representation
+
+
+class LuJSONEncoder(JSONEncoder):
+    """
+    按类型直接查找常用类型的编码方式，其余类型与DRF的JSONEncoder一致
+    """
+    ENCODERS = {
+        datetime.datetime: _encode_datetime,
+        datetime.date: datetime.date.isoformat,
+        decimal.Decimal: float,
+        uuid.UUID: str,
+    }
+
+    def default(self, obj):
+        encoder = self.ENCODERS.get(type(obj))
+        if encoder is not None:
+            return encoder(obj)
+        return super().default(obj)
+
+
+class LuJSONRenderer(JSONRenderer):
+    """
+    1、复用编码器实例，常用类型按类型直接编码
+    2、LuPage的键未被修改时直接拼接外层结构
+    3、开启RENDERER_GZIP且客户端支持时，超过RENDERER_GZIP_MIN_SIZE的响应使用gzip压缩
+    """
+    encoder_class = LuJSONEncoder
+    _encoders = {}
+
+    def get_encoder(self, indent):
+        key = (self.encoder_class, indent, self.ensure_ascii, self.strict, self.compact)
+        encoder = self._encoders.get(key)
+        if encoder is None:
+            if indent is None:
+                separators = (',', ':') if self.compact else (', ', ': ')
+            else:
+                separators = (',', ': ')
+            encoder = self.encoder_class(
+                indent=indent, ensure_ascii=self.ensure_ascii, allow_nan=not self.strict, separators=separators
+            )
+            self._encoders[key] = encoder
+        return encoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        with timing('render'):
+            renderer_context = renderer_context or {}
+            indent = self.get_indent(accepted_media_type, renderer_context)
+            encoder = self.get_encoder(indent)
+
+            if type(data) is LuPage and indent is None and self.compact and tuple(data) == LuPage.KEYS:
+                ret = '{"data":%s,"pagination":%s}' % (encoder.encode(data['data']), encoder.encode(data['pagination']))
+            else:
+                ret = encoder.encode(data)
+            if '\u2028' in ret or '\u2029' in ret:
+                ret = ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+            ret = ret.encode()
+            return self.compress(ret, renderer_context)
+
+    def compress(self, content, renderer_context):
+        if not lu_settings.RENDERER_GZIP or len(content) < lu_settings.RENDERER_GZIP_MIN_SIZE:
+            return content
+        request = renderer_context.get('request')
+        response = renderer_context.get('response')
+        # 可浏览的API等其他渲染器内部调用时不压缩
+        if request is None or response is None or getattr(response, 'accepted_renderer', None) is not self:
+            return content
+        if 'gzip' not in request.META.get('HTTP_ACCEPT_ENCODING', '') or response.has_header('Content-Encoding'):
+            return content
+        response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return gzip.compress(content, lu_settings.RENDERER_GZIP_LEVEL)
+
+
+def get_renderer_classes(renderer_classes=None):
+    """
+    视图使用的渲染器，请求时调用，不在导入时读取DEFAULT_RENDERER_CLASSES
+    1、开启RENDERER_LU_JSON(默认开启)时，将其中的JSONRenderer原位替换为LuJSONRenderer，JSONRenderer的子类(项目自定义)保持不变，
+    输出与JSONRenderer一致
+    2、未开启时原样返回
+    :param renderer_classes: 视图的renderer_classes，默认为DEFAULT_RENDERER_CLASSES
+    """
+    if renderer_classes is None:
+        renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
+    if not lu_settings.RENDERER_LU_JSON:
+        return tuple(renderer_classes)
+    return tuple(LuJSONRenderer if renderer is JSONRenderer else renderer for renderer in renderer_classes)
+
+
+class LuRendererMixin:
+    """
+    视图混入类，按get_renderer_classes()选择渲染器
+    视图未指定renderer_classes时，请求时读取DEFAULT_RENDERER_CLASSES
+    """
+
+    def get_renderers(self):
+        renderer_classes = self.renderer_classes
+        if renderer_classes is APIView.renderer_classes:
+            renderer_classes = None
+        return [renderer() for renderer in get_renderer_classes(renderer_classes)]
@@ -1,31 +1,365 @@
+from operator import attrgetter
 from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import Field, SkipField, get_attribute
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField, PKOnlyObject
 from collections import OrderedDict
-from .utils import __NoneValue__
+from collections.abc import Mapping
+from .utils import LuLRUCache, __NoneValue__
 from .settings import lu_settings
-from django.db.models import QuerySet, Model
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db.models import Manager, QuerySet, Model, Prefetch
+from django.db.models.constants import LOOKUP_SEP
+from .history import LuHistory
+
+
+def get_response_fields(request):
+    """
+    获取lu_response_field中指定的字段，保持请求中的顺序
+    """
+    fields = request.query_params.get(lu_settings.RESPONSE_FIELD)
+    if not fields:
+        return ()
+    return tuple(OrderedDict.fromkeys(f for f in fields.split(lu_settings.RESPONSE_FIELD_DELIMITER) if f))
+
+
+def resolve_field_path(model, path):
+    """
+    解析字段路径，只允许经过外键、一对一的正向关联，如 author__name
+    :return: 路径经过的关联前缀，如 author__name -> ['author']；路径无效或经过多值关联时返回None
+    """
+    opts = model._meta
+    names = path.split(LOOKUP_SEP)
+    prefixes = []
+    for i, name in enumerate(names):
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return
+        if not field.concrete or field.many_to_many:
+            return
+        if i == len(names) - 1:
+            return prefixes
+        if not field.is_relation:
+            return
+        prefixes.append(LOOKUP_SEP.join(names[:i + 1]))
+        opts = field.related_model._meta
+    return
+
+
+def get_projection(model, fields, requires=None):
+    """
+    根据序列化器最终输出的字段计算需要查询的列
+    1、普通字段按source解析，source为*(如SerializerMethodField)的字段需在requires中声明依赖的字段路径
+    2、多对多等多值字段不占用列，嵌套的序列化器按关联字段整体查询
+    :param fields: 序列化器字段 {名称: field}
+    :param requires: {字段名: (字段路径, ...)}
+    :return: (only路径, select_related路径)，无法确定时返回None
+    """
+    requires = requires or {}
+    only, related = OrderedDict(), OrderedDict()
+    for name, field in fields.items():
+        if name in requires:
+            paths = requires[name]
+        elif isinstance(field, ManyRelatedField) or getattr(field, 'many', False):
+            continue
+        elif getattr(field, 'lu_expanded', False):
+            # lu_expand展开的外键由prefetch查询，只需要外键列
+            only[field.source] = None
+            continue
+        elif field.source == '*':
+            return
+        else:
+            paths = (field.source.replace('.', LOOKUP_SEP),)
+        for path in paths:
+            prefixes = resolve_field_path(model, path)
+            if prefixes is None:
+                return
+            if isinstance(field, serializers.BaseSerializer) and name not in requires:
+                prefixes = prefixes + [path]
+            only[path] = None
+            related.update(OrderedDict.fromkeys(prefixes))
+    only.update(related)
+    return tuple(only), tuple(related)
+
+
+class LuPathField(serializers.ReadOnlyField):
+    """
+    lu_response_field中跨外键的字段，如 author__name，关联为空时输出None
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        super().__init__(source=path.replace(LOOKUP_SEP, '.'), default=None, **kwargs)
+
+    def get_attribute(self, instance):
+        if isinstance(instance, Mapping):
+            return instance.get(self.path)
+        return super().get_attribute(instance)
+
+
+_EXPAND_SERIALIZERS = {}
+_LOADER_CACHE = '_lu_loader_cache'
+
+
+def _make_cache_key(func, args, kwargs):
+    key = (func, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return
+    return key
+
+
+def get_expand_tree(request, view):
+    """
+    解析lu_expand，如 author,author.books,tags -> {'author': {'books': {}}, 'tags': {}}
+    1、路径及其上级路径都需在视图的lu_expand_fields中声明
+    2、层级不能超过视图的lu_expand_max_depth或EXPAND_MAX_DEPTH
+    3、指定了lu_response_field时，只展开其中包含的字段，不输出的关联不展开、不查询
+    """
+    value = request.query_params.get(lu_settings.EXPAND_FIELD)
+    if not value:
+        return {}
+    allowed = getattr(view, 'lu_expand_fields', None) or {}
+    max_depth = getattr(view, 'lu_expand_max_depth', None) or lu_settings.EXPAND_MAX_DEPTH
+    tree = {}
+    for path in value.split(lu_settings.EXPAND_DELIMITER):
+        if not path:
+            continue
+        names = path.split('.')
+        if len(names) > max_depth:
+            raise ValidationError({lu_settings.EXPAND_FIELD: '{} 超过最大展开层级{}'.format(path, max_depth)})
+        node = tree
+        for i, name in enumerate(names):
+            sub_path = '.'.join(names[:i + 1])
+            if sub_path not in allowed:
+                raise ValidationError({lu_settings.EXPAND_FIELD: '{} 不允许展开'.format(sub_path)})
+            node = node.setdefault(name, {})
+    response_fields = get_response_fields(request)
+    if response_fields:
+        tree = {name: node for name, node in tree.items() if name in response_fields}
+    return tree
+
+
+def _get_relation(model, name):
+    """
+    :return: (关联字段, 实例上的属性名, 是否多值)
+    """
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        field = None
+    if field is None or not field.is_relation:
+        raise ValidationError({lu_settings.EXPAND_FIELD: '{} 不是关联字段'.format(name)})
+    accessor = field.name if field.concrete else field.get_accessor_name()
+    return field, accessor, field.many_to_many or field.one_to_many
+
+
+def get_expand_serializer_class(view, path, model):
+    """
+    展开所用的序列化器，lu_expand_fields中未指定时使用关联model除多对多外的全部字段
+    """
+    serializer_class = (getattr(view, 'lu_expand_fields', None) or {}).get(path)
+    if serializer_class is not None:
+        return serializer_class
+    serializer_class = _EXPAND_SERIALIZERS.get(model)
+    if serializer_class is None:
+        meta = type('Meta', (), {'model': model, 'fields': tuple(f.name for f in model._meta.concrete_fields)})
+        serializer_class = type('{}ExpandSerializer'.format(model.__name__), (LuModelSerializer,), {'Meta': meta})
+        _EXPAND_SERIALIZERS[model] = serializer_class
+    return serializer_class
+
+
+def build_expand_field(view, model, name, node, prefix=''):
+    """
+    生成展开后的嵌套序列化器，替换原有的主键字段
+    """
+    field, accessor, many = _get_relation(model, name)
+    path = prefix + name
+    serializer_class = get_expand_serializer_class(view, path, field.related_model)
+    kwargs = {'many': many, 'read_only': True}
+    if accessor != name:
+        kwargs['source'] = accessor
+    serializer = serializer_class(**kwargs)
+    serializer.lu_expanded = True
+    child = serializer.child if many else serializer
+    for sub_name, sub_node in node.items():
+        child.fields[sub_name] = build_expand_field(view, field.related_model, sub_name, sub_node, path + '.')
+    return serializer
+
+
+def build_expand_prefetches(view, model, tree, prefix='', lookup_prefix=''):
+    """
+    为展开的关联生成Prefetch，关联查询只查询展开的序列化器需要的列，只针对当前页的记录执行
+    """
+    prefetches = []
+    for name, node in tree.items():
+        field, accessor, many = _get_relation(model, name)
+        path = prefix + name
+        related_model = field.related_model
+        lookup = lookup_prefix + accessor
+        fields = OrderedDict(
+            (k, v) for k, v in get_expand_serializer_class(view, path, related_model)().fields.items() if k not in node
+        )
+        queryset = related_model._default_manager.all()
+        projection = get_projection(related_model, fields)
+        if projection is not None:
+            only, related = projection
+            # 下级外键、反向外键关联回上级的外键需要查询
+            only += tuple(n for n in node if not _get_relation(related_model, n)[2])
+            if field.one_to_many:
+                only += (field.field.name,)
+            if related:
+                queryset = queryset.select_related(*related)
+            queryset = queryset.only(*only)
+        prefetches.append(Prefetch(lookup, queryset=queryset))
+        prefetches.extend(build_expand_prefetches(view, related_model, node, path + '.', lookup + LOOKUP_SEP))
+    return prefetches
+
+
+# 对数据库取出的值，以下字段的to_representation与内置类型转换等价
+_BUILTIN_CONVERTERS = {
+    serializers.IntegerField: int,
+    serializers.CharField: str,
+    serializers.BooleanField: bool,
+    serializers.FloatField: float,
+}
+_COMPILED_PLANS = LuLRUCache(lu_settings.SERIALIZER_COMPILED_CACHE_SIZE)
+_MISSING = object()
+
+
+def _get_compiled_plan(serializer, model):
+    """
+    按序列化器类及输出字段缓存每个字段的取值方式，LRU缓存，数量由SERIALIZER_COMPILED_CACHE_SIZE指定
+    key中的字段按字段名排序，lu_response_field中字段相同、顺序不同的请求共用一个缓存项
+    :return: {字段名: (model实例的attname, 字典的key, 内置类型转换)}，attname为None表示走DRF的标准流程
+    """
+    fields = list(serializer._readable_fields)
+    key = (serializer.__class__, tuple(sorted((f.field_name, f.__class__, f.source) for f in fields)))
+    plan = _COMPILED_PLANS.get(key)
+    if plan is not None:
+        return plan
+
+    concrete = {f.name: f for f in model._meta.concrete_fields} if model is not None else {}
+    plan = {}
+    for field in fields:
+        attname = None
+        converter = None
+        model_field = concrete.get(field.source)
+        if model_field is not None and len(field.source_attrs) == 1:
+            if isinstance(field, PrimaryKeyRelatedField):
+                if field.pk_field is None and model_field.is_relation:
+                    attname = model_field.attname
+            elif type(field).get_attribute is Field.get_attribute and not model_field.is_relation:
+                attname = model_field.attname
+                converter = _BUILTIN_CONVERTERS.get(type(field))
+        plan[field.field_name] = (attname, field.source, converter)
+    _COMPILED_PLANS.set(key, plan)
+    return plan
+
+
+def compile_representation(serializer):
+    """
+    将序列化器的输出字段编译为逐条转换的函数，结果与to_representation一致
+    1、model的具体字段直接取值(外键取attname)，常用类型以内置类型转换，其余调用字段的to_representation
+    2、SerializerMethodField、嵌套序列化器、多对多等字段仍走DRF的标准流程
+    3、同时支持model实例和values()返回的字典
+    """
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    plan = _get_compiled_plan(serializer, model)
+    steps = []
+    for field in serializer._readable_fields:
+        name = field.field_name
+        attname, key, converter = plan[name]
+        getter = attrgetter(attname) if attname is not None else None
+        convert = converter or (None if isinstance(field, PrimaryKeyRelatedField) else field.to_representation)
+        steps.append((name, field, getter, key, convert))
+
+    def slow(ret, field, instance):
+        try:
+            attribute = field.get_attribute(instance)
+        except SkipField:
+            return
+        check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+        ret[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+
+    def to_representation(instance):
+        ret = OrderedDict()
+        is_mapping = isinstance(instance, Mapping)
+        for name, field, getter, key, convert in steps:
+            if getter is None:
+                slow(ret, field, instance)
+                continue
+            value = instance.get(key, _MISSING) if is_mapping else getter(instance)
+            if value is _MISSING:
+                slow(ret, field, instance)
+            elif value is None or convert is None:
+                ret[name] = value
+            else:
+                ret[name] = convert(value)
+        return ret
+
+    return to_representation
 
 
 class LuModelSerializer(serializers.ModelSerializer):
+    """
+    lu_compiled = True 或开启SERIALIZER_COMPILED时，输出使用compile_representation编译的转换函数
+    """
+    lu_compiled = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._filter_fields(kwargs['context']['request'])
+        # 嵌套的序列化器不传context，不按lu_response_field过滤
+        request = kwargs.get('context', {}).get('request')
+        if request is not None:
+            self._filter_fields(request)
+            self._expand_fields(request, kwargs['context'].get('view'))
         self.model_pks = self._get_model_pks()
+        self._nested_pks = None
         self._lazy_cache_result = {}
+        self._compiled_representation = None
+
+    def to_representation(self, instance):
+        if not (self.lu_compiled or lu_settings.SERIALIZER_COMPILED):
+            return super().to_representation(instance)
+        if self._compiled_representation is None:
+            self._compiled_representation = compile_representation(self)
+        return self._compiled_representation(instance)
 
     def _filter_fields(self, request):
-        fields = request.query_params.get(lu_settings.RESPONSE_FIELD)
-        fields_list = fields.split(',') if fields else []
+        """
+        只输出lu_response_field中指定的字段，跨外键的路径(如 author__name)以LuPathField输出
+        LuResponseFieldFilterBackend根据过滤后的字段计算查询的列，两者保持一致
+        """
+        fields_list = get_response_fields(request)
         if not fields_list:
             return
 
         serializer_fields = self.fields.fields
-        valid_fields = set(serializer_fields) & set(fields_list)
+        model = getattr(getattr(self, 'Meta', None), 'model', None)
         new_fields = OrderedDict()
-        for f in valid_fields:
-            new_fields[f] = serializer_fields[f]
+        for f in fields_list:
+            if f in serializer_fields:
+                new_fields[f] = serializer_fields[f]
+            elif LOOKUP_SEP in f and model is not None and resolve_field_path(model, f):
+                field = LuPathField(f)
+                field.bind(f, self)
+                new_fields[f] = field
         self.fields.fields = new_fields
 
+    def _expand_fields(self, request, view):
+        """
+        按lu_expand将关联字段替换为嵌套的序列化器，关联数据由LuExpandFilterBackend预先查询
+        """
+        tree = get_expand_tree(request, view)
+        model = getattr(getattr(self, 'Meta', None), 'model', None)
+        if not tree or model is None:
+            return
+        for name, node in tree.items():
+            self.fields[name] = build_expand_field(view, model, name, node)
+
     def get_attr(self, obj, attr):
         if isinstance(obj, Model):
             return getattr(obj, attr, None)
@@ -33,16 +367,62 @@ class LuModelSerializer(serializers.ModelSerializer):
             return obj.get(attr, None)
         return
 
-    def lazy_cache(self, func, *args, **kwargs):
-        func_name = func.__name__
-        value = self._lazy_cache_result.get(func_name, __NoneValue__)
+    def lazy_cache(self, func, *args, key=None, **kwargs):
+        """
+        缓存func(*args, **kwargs)的结果，按函数及参数区分，参数不可哈希时不缓存
+        :param key: 代替函数区分缓存，每次调用都创建新的lambda、闭包时需指定，否则不会命中缓存
+        """
+        key = _make_cache_key(func if key is None else key, args, kwargs)
+        if key is None:
+            return func(*args, **kwargs)
+        value = self._lazy_cache_result.get(key, __NoneValue__)
         if value is __NoneValue__:
             new_value = func(*args, **kwargs)
-            self._lazy_cache_result[func_name] = new_value
+            self._lazy_cache_result[key] = new_value
             return new_value
 
         return value
 
+    def _get_loader_cache(self):
+        """
+        批量加载的结果在整个请求内共享，没有请求时只在当前序列化器内有效
+        """
+        request = self.context.get('request')
+        if request is None:
+            return self._lazy_cache_result.setdefault(_LOADER_CACHE, {})
+        cache = getattr(request, _LOADER_CACHE, None)
+        if cache is None:
+            cache = {}
+            setattr(request, _LOADER_CACHE, cache)
+        return cache
+
+    def load(self, func, obj, *args, key=None, **kwargs):
+        """
+        批量加载，用于SerializerMethodField等需要逐条查询的字段
+        1、func(pks, *args, **kwargs)接收当前页所有记录的主键(model_pks)，返回 {主键: 值}
+        2、同一个func及参数在每页只调用一次，结果按函数及参数缓存至请求结束
+        3、嵌套序列化器中的记录不在model_pks中，从根序列化器的记录中取出当前页所有嵌套记录的主键一次加载
+        4、以上都找不到的记录(如SerializerMethodField中手动序列化的记录)单独加载
+        :param key: 同lazy_cache，代替函数区分缓存
+        :return: obj对应的值，不存在时为None
+        """
+        pk = self._get_pk(obj)
+        key = _make_cache_key(func if key is None else key, args, kwargs)
+        if key is None:
+            return func([pk], *args, **kwargs).get(pk)
+        cache = self._get_loader_cache()
+        loaded, result = cache.setdefault(key, (set(), {}))
+        if pk not in loaded:
+            if pk in self.model_pks:
+                pks = [p for p in self.model_pks if p not in loaded]
+            elif pk in self._get_nested_pks():
+                pks = [p for p in self._get_nested_pks() if p not in loaded]
+            else:
+                pks = [pk]
+            result.update(func(pks, *args, **kwargs))
+            loaded.update(pks)
+        return result.get(pk)
+
     def _get_pk(self, value):
         if isinstance(value, dict):
             pk = value.get(lu_settings.PRIMARY_KEY)
@@ -59,3 +439,57 @@ class LuModelSerializer(serializers.ModelSerializer):
             result = [self._get_pk(self.instance)]
 
         return tuple(result)
+
+    def _get_nested_pks(self):
+        """
+        嵌套序列化器的记录: 从根序列化器的记录出发，沿各层字段的source取出当前页所有嵌套记录的主键
+        多值关联只使用已预先查询(prefetch)的结果，未预先查询时不取，避免额外的查询
+        """
+        if self._nested_pks is not None:
+            return self._nested_pks
+        chain = []
+        node = self
+        while node.parent is not None:
+            if not isinstance(node.parent, serializers.ListSerializer):
+                chain.append(node.source_attrs)
+            node = node.parent
+        if not chain or node.instance is None:
+            self._nested_pks = {}
+            return self._nested_pks
+
+        rows = node.instance if isinstance(node.instance, (list, tuple, QuerySet)) else [node.instance]
+        for source_attrs in reversed(chain):
+            rows = [value for row in rows for value in _get_related_rows(row, source_attrs)]
+        # dict保持顺序且判断是否包含为O(1)
+        self._nested_pks = dict.fromkeys(pk for pk in map(self._get_pk, rows) if pk is not None)
+        return self._nested_pks
+
+
+def _get_related_rows(row, source_attrs):
+    """
+    :return: row沿source_attrs取出的关联记录列表，多值关联未预先查询时返回空列表
+    """
+    try:
+        value = get_attribute(row, source_attrs)
+    except (AttributeError, KeyError, ObjectDoesNotExist):
+        return []
+    if value is None:
+        return []
+    if isinstance(value, Manager):
+        value = value.all()
+        if value._result_cache is None:
+            return []
+    if isinstance(value, (list, tuple, QuerySet)):
+        return list(value)
+    return [value]
+
+
+class LuHistorySerializer(LuModelSerializer):
+    diff = serializers.SerializerMethodField()
+
+    class Meta:
+        model = LuHistory
+        fields = ('id', 'type', 'type_id', 'diff', 'operation', 'created_at', 'created_by')
+
+    def get_diff(self, obj):
+        return obj.get_diff()
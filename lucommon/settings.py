@@ -79,31 +79,99 @@ DEFAULT_ATTR = {
     'SEARCH_TYPE': LuConfig('lu_search_type', str, '查询类型'),
     'SEARCH_DELIMITER': LuConfig(',', str, '多个查询条件下字段、值、类型的分隔符'),
     'SEARCH_VALUE_DELIMITER': LuConfig('|', str, '查询值包含多个值的分隔符'),  # todo 这两个不能一样，运行时校验
+    'SEARCH_PLAN_CACHE_SIZE': LuConfig(1024, int, '查询计划缓存数量'),
 
     'FILTER_NULL_VALUE': LuConfig('__NULL_VALUE__', str, 'filter中所定义的空值'),
 
     'RESPONSE_FIELD': LuConfig('lu_response_field', str, '查询记录所显示字段'),
     'RESPONSE_FIELD_DELIMITER': LuConfig(',', str, '查询记录所显示字段分隔符'),
+    'EXPAND_FIELD': LuConfig('lu_expand', str, '展开关联字段，下级关联以.分隔，如 author.books'),
+    'EXPAND_DELIMITER': LuConfig(',', str, '多个展开字段的分隔符'),
+    'EXPAND_MAX_DEPTH': LuConfig(2, int, '最大展开层级'),
+    'SERIALIZER_COMPILED': LuConfig(False, bool, '所有LuModelSerializer输出时是否使用编译的转换函数，也可在序列化器中设置lu_compiled'),
+    'SERIALIZER_COMPILED_CACHE_SIZE': LuConfig(1024, int, '编译的字段取值方式按序列化器及输出字段缓存的数量'),
+    'RESPONSE_FIELD_VALUES': LuConfig(False, bool, '按显示字段查询时使用values()返回字典，默认使用only()返回model实例'),
 
     'PAGINATION_LIMIT_FIELD': LuConfig('lu_limit', str, '分页-每页记录条数'),
     'PAGINATION_OFFSET_FIELD': LuConfig('lu_offset', str, '分页-偏移量'),
+    'PAGINATION_CURSOR_FIELD': LuConfig('lu_cursor', str, '分页-游标，带有该参数时使用游标分页'),
     "PAGINATION_UN_LIMIT_VALUE": LuConfig("-1", str, "分页-展示所有数据"),
     'PAGINATION_DEFAULT_LIMIT': LuConfig(10, int, '分页-默认分页'),
     'PAGINATION_MAX_LIMIT': LuConfig(1000, int, '分页-最大分页'),
+    'PAGINATION_COUNT_MODE': LuConfig('exact', str, '分页-总数统计方式: exact、cached、estimate、none，视图可通过lu_count_mode指定'),
+    'PAGINATION_COUNT_CACHE_TTL': LuConfig(60, int, '分页-cached模式下总数缓存时间(秒)'),
+    'PAGINATION_DEFERRED_JOIN_OFFSET': LuConfig(0, int, '分页-偏移量超过该值时先按偏移量查询主键再按主键查询记录，0表示不启用'),
+    'PAGINATION_COUNT_ESTIMATE_MIN': LuConfig(10000, int, '分页-estimate模式下估算值小于该值时仍精确统计'),
+    'PAGINATION_UN_LIMIT_STREAM': LuConfig(False, bool, '分页-展示所有数据时是否以流的方式分批输出'),
+
+    'RENDERER_LU_JSON': LuConfig(True, bool, 'LuModelViewSet等视图是否将默认渲染器中的JSONRenderer替换为LuJSONRenderer'),
+    'RENDERER_GZIP': LuConfig(False, bool, 'LuJSONRenderer是否对较大的响应进行gzip压缩'),
+    'RENDERER_GZIP_MIN_SIZE': LuConfig(4096, int, '进行gzip压缩的最小响应长度(字节)'),
+    'RENDERER_GZIP_LEVEL': LuConfig(6, int, 'gzip压缩级别'),
+
+    'RESPONSE_CACHE': LuConfig(False, bool, '是否启用响应缓存，启用后写入时更新表的版本号，视图通过lu_cache_timeout开启缓存'),
+    'RESPONSE_CACHE_ALIAS': LuConfig('default', str, '响应缓存及表版本号使用的缓存(CACHES中的别名)'),
+
+    'EXPORT_FIELD': LuConfig('lu_export', str, '导出格式字段: json、ndjson、csv'),
+    'EXPORT_CHUNK_SIZE': LuConfig(1000, int, '导出、流式输出时每批读取的记录数'),
 
     "ORDER_FILED": LuConfig("lu_order_field", str, "排序字段"),
     "ORDER_FILED_DELIMITER": LuConfig(",", str, "排序字段分割符"),
 
+    'GROUP_BY_FIELD': LuConfig('lu_group_by', str, '分组字段'),
+    'AGGREGATE_FIELD': LuConfig('lu_aggregate', str, '统计字段，格式为 函数:字段，如 sum:price，count表示统计记录数'),
+    'AGGREGATE_DELIMITER': LuConfig(',', str, '多个分组、统计字段的分隔符'),
+    'AGGREGATE_FUNC_DELIMITER': LuConfig(':', str, '统计函数与字段的分隔符'),
+
     "DISTINCT_FIELD": LuConfig("lu_response_distinct", str, "是否去重字段"),
     "IS_DISTINCT_VALUE": LuConfig("1", str, "数据需要去重是所传的值"),
 
+    'QUERY_GUARD': LuConfig(False, bool, '未声明查询白名单的视图是否只允许使用索引的查询、排序，并禁止去重'),
+    'QUERY_GUARD_EXPLAIN_MAX_ROWS': LuConfig(0, int, '列表查询EXPLAIN估算扫描行数上限，0表示不检查'),
+    'QUERY_GUARD_EXPLAIN_ACTION': LuConfig('reject', str, '超过扫描行数上限时的处理方式: reject、downgrade'),
+    'QUERY_GUARD_EXPLAIN_CACHE_SIZE': LuConfig(1024, int, 'EXPLAIN估算结果按查询形状缓存的数量'),
+    'QUERY_GUARD_EXPLAIN_CACHE_TTL': LuConfig(300, int, 'EXPLAIN估算结果缓存时间（秒）'),
+
     'OPTIMISTIC_LOCK_CHECK': LuConfig(True, bool, '是否开启更新乐观锁检查'),
+    'OPTIMISTIC_LOCK_ATOMIC': LuConfig(False, bool, '是否通过条件UPDATE原子校验乐观锁'),
     'OPTIMISTIC_LOCK_FIELD': LuConfig('version', str, '乐观锁字段'),
     'CREATOR_FIELD': LuConfig('created_by', str, '字段-创建人'),
     'UPDATER_FIELD': LuConfig('updated_by', str, '字段-更信任'),
 
+    'ASYNC_VIEW': LuConfig(False, bool, 'LuModelViewSet是否为异步视图，list、retrieve在独立的线程池中执行'),
+    'ASYNC_EXECUTOR_WORKERS': LuConfig(10, int, '异步视图线程池的线程数'),
+    'ASYNC_EXECUTOR_QUEUE_SIZE': LuConfig(100, int, '异步视图线程池最大排队数，超出时返回503，0表示不限'),
+    'ASYNC_COUNT_WORKERS': LuConfig(10, int, '分页COUNT线程池的线程数'),
+    'ASYNC_COUNT_QUEUE_SIZE': LuConfig(100, int, '分页COUNT线程池最大排队数，超出时COUNT在视图线程中执行，0表示不限'),
+    'ASYNC_STREAM_QUEUE_SIZE': LuConfig(8, int, '异步视图流式响应等待发送的最大段数，超出时生成内容的线程等待'),
+    'ASYNC_QUEUE_WAIT_WARNING': LuConfig(1, (int, float), '线程池排队等待超过该时间(秒)时记录日志，0表示不记录'),
+    'ASYNC_PARALLEL_COUNT': LuConfig(True, bool, '异步视图中分页COUNT是否与分页查询并行执行'),
+
+    'TIMING_SAMPLE_RATE': LuConfig(1, (int, float), 'LuTimingMiddleware采样比例，0~1'),
+    'TIMING_HEADER': LuConfig(True, bool, '是否输出Server-Timing响应头'),
+    'TIMING_LOG': LuConfig(True, bool, '是否输出各阶段耗时的结构化日志'),
+    'TIMING_LOG_MIN_DURATION': LuConfig(0, (int, float), '请求耗时超过该值(毫秒)才输出日志'),
+
+    'QUERY_BUDGET_CHECK': LuConfig(False, bool, '是否统计LuModelViewSet执行的SQL，超出lu_query_budget或存在重复语句时记录日志'),
+    'QUERY_REPEAT_THRESHOLD': LuConfig(5, int, '同一查询语句重复执行达到该次数时视为N+1查询，写入语句不检查，0表示不检查'),
+
+    'BULK_MAX_SIZE': LuConfig(1000, int, '批量新增、修改、删除的最大条数'),
+    'BULK_BATCH_SIZE': LuConfig(200, int, '批量新增、修改每条SQL的最大记录数'),
+
     'SAVE_HISTORY': LuConfig(True, bool, '是否开启更新历史记录'),
     'HISTORY_TABLE': LuConfig('lu_history', str, '历史记录表名'),
+    'HISTORY_DATABASE': LuConfig('default', str, '历史记录表所在数据库'),
+    'HISTORY_ASYNC': LuConfig(False, bool, '是否在事务提交后异步批量写入历史记录'),
+    'HISTORY_BATCH_SIZE': LuConfig(500, int, '历史记录批量写入条数'),
+    'HISTORY_ASYNC_MAX_PENDING': LuConfig(5000, int, '异步模式下同一事务中等待提交的历史记录达到该条数时直接在事务内写入，0表示不限'),
+    'HISTORY_BULK_RECOVER_PK': LuConfig(False, bool, '数据库不返回批量插入主键时，是否通过最后插入id推算主键以记录历史，要求自增id连续分配'),
+    'HISTORY_FLUSH_INTERVAL': LuConfig(1, (int, float), '历史记录异步写入最长间隔（秒）'),
+    'HISTORY_DIFF_COMPACT': LuConfig(False, bool, '历史记录差异是否以字段序号紧凑存储'),
+    'HISTORY_DIFF_COMPRESS': LuConfig(False, bool, '历史记录差异是否压缩存储'),
+    'HISTORY_DIFF_COMPRESS_MIN_SIZE': LuConfig(512, int, '历史记录差异压缩的最小长度'),
+    'HISTORY_CHECKPOINT_INTERVAL': LuConfig(100, int, 'lu_history_checkpoint命令为自上一个检查点以来差异达到该条数的记录写入检查点，0表示不写入'),
+    'HISTORY_RETENTION_DAYS': LuConfig(180, int, '历史记录保留天数，超出部分由lu_history_archive归档'),
+    'HISTORY_ARCHIVE_DIR': LuConfig('lu_history_archive', str, '历史记录归档目录'),
 
     "PRIMARY_KEY": LuConfig("id", str, "数据表主键"),
 
@@ -0,0 +1,71 @@
+from copy import deepcopy
+from django.db.models import DEFERRED
+
+_SNAPSHOT_FIELDS = {}
+MUTABLE_TYPES = (dict, list, set)
+
+
+def get_snapshot_fields(model):
+    """
+    获取model中所有具体字段的attname，每个model只计算一次
+    :param model: model类或实例
+    :return: attname元组，快照中的值与之一一对应
+    """
+    model = model._meta.concrete_model
+    fields = _SNAPSHOT_FIELDS.get(model)
+    if fields is None:
+        fields = tuple(field.attname for field in model._meta.concrete_fields)
+        _SNAPSHOT_FIELDS[model] = fields
+    return fields
+
+
+def take_snapshot(obj, fields=None):
+    """
+    以元组形式记录model实例的字段值
+    1、只读取具体字段，不涉及_state、关联缓存等属性
+    2、字符串、二进制等不可变值直接引用，不做拷贝；仅对dict、list等可变值做拷贝
+    3、延迟加载(defer/only)且尚未读取的字段记为DEFERRED，不触发额外查询
+    :param obj: model实例
+    :param fields: attname元组，默认为model的所有具体字段
+    """
+    if fields is None:
+        fields = get_snapshot_fields(obj)
+    values = obj.__dict__
+    return tuple(_freeze(values.get(attname, DEFERRED)) for attname in fields)
+
+
+def _freeze(value):
+    if isinstance(value, MUTABLE_TYPES):
+        return deepcopy(value)
+    return value
+
+
+def calculate_diff(fields, new=None, old=None):
+    """
+    计算两个快照之间的差异
+    :param fields: attname元组
+    :param new: 新快照，None表示删除
+    :param old: 旧快照，None表示新增
+    :return: {attname: {'new': str, 'old': str}}
+    """
+    diff = {}
+    if old is None and new is None:
+        return diff
+    if old is None:
+        # insert
+        for attr, value in zip(fields, new):
+            if value is not DEFERRED:
+                diff[attr] = {'new': str(value), 'old': None}
+    elif new is None:
+        # delete
+        for attr, value in zip(fields, old):
+            if value is not DEFERRED:
+                diff[attr] = {'new': None, 'old': str(value)}
+    else:
+        # update
+        for attr, new_value, old_value in zip(fields, new, old):
+            if new_value is DEFERRED or old_value is DEFERRED:
+                continue
+            if new_value != old_value:
+                diff[attr] = {'new': str(new_value), 'old': str(old_value)}
+    return diff
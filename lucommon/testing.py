@@ -0,0 +1,38 @@
+from contextlib import contextmanager
+from .budgets import LuQueryCollector, check_query_budget
+
+
+class LuQueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def assert_query_budget(view, action, repeat_threshold=None):
+    """
+    断言代码块执行的SQL不超过视图lu_query_budget中action的预算，且没有重复执行的语句(N+1)
+    只统计当前线程执行的SQL，测试异步视图(ASYNC_VIEW)时请使用同步的测试客户端
+    with assert_query_budget(BookViewSet, 'list'):
+        client.get('/books/')
+    :param view: 视图类或实例
+    :param repeat_threshold: 同一语句重复执行的次数上限，默认为QUERY_REPEAT_THRESHOLD，0表示不检查
+    """
+    collector = LuQueryCollector()
+    with collector.track():
+        yield collector
+    problems = check_query_budget(view, action, collector, repeat_threshold)
+    if problems:
+        name = view.__name__ if isinstance(view, type) else view.__class__.__name__
+        raise LuQueryBudgetExceeded('{}.{} {}\n{}'.format(name, action, '；'.join(problems), collector.report()))
+
+
+class LuQueryBudgetTestMixin:
+    """
+    TestCase混入类
+    class BookTests(LuQueryBudgetTestMixin, APITestCase):
+        def test_list(self):
+            with self.assertQueryBudget(BookViewSet, 'list'):
+                self.client.get('/books/')
+    """
+
+    def assertQueryBudget(self, view, action, repeat_threshold=None):
+        return assert_query_budget(view, action, repeat_threshold)
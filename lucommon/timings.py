@@ -0,0 +1,150 @@
+import json
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+from .logger import lu_logger
+from .settings import lu_settings
+from .utils import get_cur_request
+
+
+class LuTimer:
+    """
+    记录一个请求各阶段的耗时、SQL条数及SQL耗时(毫秒)
+    1、阶段可嵌套，耗时包含内层阶段；SQL只计入当前线程最内层的阶段
+    2、同名阶段多次执行时累加
+    3、阶段可在其他线程中执行(如并行的COUNT)，各线程分别记录当前阶段
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages.setdefault(name, {'dur': 0.0, 'queries': 0, 'sql': 0.0})
+        return stage
+
+    def _execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                stage = self._get_stage(self._local.stack[-1])
+                stage['queries'] += 1
+                stage['sql'] += elapsed
+
+    @contextmanager
+    def stage(self, name):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        with ExitStack() as wrappers:
+            if not stack:
+                # 当前线程的最外层阶段为所有数据库连接安装execute_wrapper
+                for connection in connections.all():
+                    wrappers.enter_context(connection.execute_wrapper(self._execute))
+            stack.append(name)
+            with self._lock:
+                # 按开始顺序输出
+                self._get_stage(name)
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                stack.pop()
+                with self._lock:
+                    self._get_stage(name)['dur'] += elapsed
+
+    def add(self, name, dur):
+        with self._lock:
+            self._get_stage(name)['dur'] += dur
+
+    @property
+    def total(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def server_timing(self, total):
+        metrics = [
+            '{};dur={:.2f};desc="{} sql {:.2f}ms"'.format(name, stage['dur'], stage['queries'], stage['sql'])
+            for name, stage in self.stages.items()
+        ]
+        metrics.append('total;dur={:.2f}'.format(total))
+        return ', '.join(metrics)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def get_timer():
+    """
+    当前请求的LuTimer，未采样或不在请求中时返回None
+    """
+    return getattr(get_cur_request(), 'lu_timer', None)
+
+
+def timing(name):
+    """
+    记录当前请求中一个阶段的耗时及SQL，未开启采样时为空操作
+    with timing('serialize'):
+        data = serializer.data
+    """
+    timer = get_timer()
+    if timer is None:
+        return _null_stage
+    return timer.stage(name)
+
+
+class LuTimingMiddleware(MiddlewareMixin):
+    """
+    按TIMING_SAMPLE_RATE采样请求，记录LuModelViewSet各阶段的耗时及SQL
+    1、阶段: queue(异步视图线程池排队)、view、filter、count、fetch、serialize、render、history(历史记录写入)
+    2、TIMING_HEADER开启时输出Server-Timing响应头
+    3、TIMING_LOG开启时，耗时超过TIMING_LOG_MIN_DURATION(毫秒)的请求通过lu_logger输出一行json
+    各阶段通过crum获取当前请求，需同时启用crum.CurrentRequestUserMiddleware
+    """
+
+    def process_request(self, request):
+        rate = lu_settings.TIMING_SAMPLE_RATE
+        if rate >= 1 or (rate > 0 and random.random() < rate):
+            request.lu_timer = LuTimer()
+
+    def process_response(self, request, response):
+        timer = getattr(request, 'lu_timer', None)
+        if timer is None:
+            return response
+        queue_wait = getattr(request, 'lu_queue_wait', None)
+        if queue_wait is not None:
+            timer.add('queue', queue_wait * 1000)
+        total = timer.total
+        if lu_settings.TIMING_HEADER:
+            response['Server-Timing'] = timer.server_timing(total)
+        if lu_settings.TIMING_LOG and total >= lu_settings.TIMING_LOG_MIN_DURATION:
+            lu_logger.info('lu timing {}'.format(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'total': round(total, 2),
+                'queries': sum(stage['queries'] for stage in timer.stages.values()),
+                'stages': {
+                    name: {'dur': round(stage['dur'], 2), 'queries': stage['queries'], 'sql': round(stage['sql'], 2)}
+                    for name, stage in timer.stages.items()
+                },
+            }, separators=(',', ':'))))
+        return response
@@ -1,3 +1,6 @@
+import threading
+import time
+from collections import OrderedDict
 from crum import get_current_request as __get_current_request
 
 __NoneValue__ = "__LU_COMMON_NONE_VALUE__"
@@ -14,3 +17,40 @@ def get_cur_user():
 
 def get_cur_request():
     return __get_current_request()
+
+
+class LuLRUCache:
+    """
+    线程安全的LRU缓存，超过maxsize时淘汰最久未使用的项；ttl(秒)大于0时，超过ttl的项视为不存在
+    """
+
+    def __init__(self, maxsize, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if self.ttl and time.monotonic() - item[1] > self.ttl:
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
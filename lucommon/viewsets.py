@@ -1,15 +1,195 @@
-from rest_framework.viewsets import ModelViewSet
-from .filters import LuSearchFilterBackend, LuOrderFilterBackend, LuDistinctFilterBackend, LuResponseFieldFilterBackend
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .filters import LuSearchFilterBackend, LuOrderFilterBackend, LuDistinctFilterBackend, LuResponseFieldFilterBackend, \
+    LuAggregateFilterBackend, LuExpandFilterBackend
 from django_filters.rest_framework.backends import DjangoFilterBackend
 from .paginations import LuPagination
+from .history import LuHistory, get_object_history, get_user_history, get_state_as_of
+from .serializers import LuHistorySerializer
+from .settings import lu_settings
+from .guards import check_explain
+from .exports import export_response
+from .renderers import LuRendererMixin
+from .caches import cache_response
+from .bulk import bulk_create, bulk_update, bulk_delete, get_bulk_action
+from .executors import as_async_view, has_atomic_requests
+from .timings import timing
+from .budgets import query_budget_guard
 
 
-class LuModelViewSet(ModelViewSet):
+class LuModelViewSet(LuRendererMixin, ModelViewSet):
+    """
+    查询开销控制(见guards)，可在视图中定义
+    lu_search_fields = {字段: (查找方式, ...)}  允许查询的字段及查找方式，查找方式为None表示不限
+    lu_order_fields = (字段, ...)  允许排序的字段
+    lu_distinct_allowed = True  是否允许去重
+    lu_explain_max_rows = 100000  列表查询EXPLAIN估算扫描行数上限
+    lu_group_by_fields = (字段, ...)  允许分组的字段(见LuAggregateFilterBackend)
+    lu_aggregate_fields = {字段: (函数, ...)}  允许统计的字段及函数
+    lu_expand_fields = {路径: 序列化器}  允许展开的关联(见LuExpandFilterBackend)
+    lu_expand_max_depth = 2  最大展开层级
+    lu_cache_timeout = 300  list、retrieve响应缓存时间(秒)，需开启RESPONSE_CACHE(见caches)
+    lu_cache_tables = (表名, ...)  响应额外依赖的表，如SerializerMethodField中查询的表
+    lu_cache_scope = 'user'  缓存按用户区分，'global'表示所有用户共享
+    lu_bulk_actions = ('create', 'update', 'delete')  开启的批量操作，默认不开启(见bulk)
+    lu_bulk_max_size = 1000  批量操作的最大条数，默认BULK_MAX_SIZE
+    lu_query_budget = {'list': 3, 'retrieve': 2}  各action的SQL条数上限(见budgets)，为整数时所有action相同
+
+    列表查询带有lu_export参数(json、ndjson、csv)时以流的方式导出全部数据；
+    PAGINATION_UN_LIMIT_STREAM开启时，lu_limit=-1同样以流的方式输出，响应格式不变
+    bulk/ 接口在同一事务内批量新增(POST)、修改(PUT、PATCH)、删除(DELETE)，返回每条记录的结果，需在lu_bulk_actions中开启
+    开启ASYNC_VIEW时视图为异步视图，list、retrieve在独立的线程池中执行，COUNT与分页查询并行(见executors)
+    """
     filter_backends = (
         DjangoFilterBackend,
         LuSearchFilterBackend,
+        LuAggregateFilterBackend,
         LuOrderFilterBackend,
         LuDistinctFilterBackend,
-        LuResponseFieldFilterBackend
+        LuResponseFieldFilterBackend,
+        LuExpandFilterBackend
     )
     pagination_class = LuPagination
+    lu_aggregated = False
+    lu_async = False
+    lu_bulk_actions = ()
+    lu_query_collector = None
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super().as_view(actions, **initkwargs)
+        if not lu_settings.ASYNC_VIEW or has_atomic_requests():
+            return view
+        return as_async_view(view, super().as_view(actions, lu_async=True, **initkwargs), actions)
+
+    def dispatch(self, request, *args, **kwargs):
+        with timing('view'), query_budget_guard(self):
+            return super().dispatch(request, *args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        with timing('filter'):
+            queryset = super().filter_queryset(queryset)
+            if self.action == 'list':
+                queryset = check_explain(self, queryset)
+            return queryset
+
+    def list(self, request, *args, **kwargs):
+        return cache_response(self, request, lambda: self._list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        # 先取出记录并检查对象权限，命中缓存时同样生效
+        instance = self.get_object()
+        return cache_response(self, request, lambda: self._retrieve(instance))
+
+    def _retrieve(self, instance):
+        serializer = self.get_serializer(instance)
+        with timing('serialize'):
+            return Response(serializer.data)
+
+    @action(detail=False, methods=['post', 'put', 'patch', 'delete'])
+    def bulk(self, request, *args, **kwargs):
+        # 以对应的单条操作校验权限，按action判断的权限类、get_serializer_class同样生效
+        self.action = get_bulk_action(self, request)
+        try:
+            self.check_permissions(request)
+            if request.method == 'POST':
+                return bulk_create(self, request)
+            if request.method == 'DELETE':
+                return bulk_delete(self, request)
+            return bulk_update(self, request, partial=request.method == 'PATCH')
+        finally:
+            self.action = 'bulk'
+
+    def _list(self, request, *args, **kwargs):
+        params = request.query_params
+        export_format = params.get(lu_settings.EXPORT_FIELD)
+        if export_format:
+            return export_response(self, self.filter_queryset(self.get_queryset()), export_format)
+        if lu_settings.PAGINATION_UN_LIMIT_STREAM and \
+                params.get(lu_settings.PAGINATION_LIMIT_FIELD) == lu_settings.PAGINATION_UN_LIMIT_VALUE and \
+                lu_settings.PAGINATION_CURSOR_FIELD not in params:
+            offset = self.paginator.get_offset(request)
+            return export_response(self, self.filter_queryset(self.get_queryset()), 'paginated', offset)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.lu_aggregated:
+            # 分组统计的结果不经过序列化器
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(page)
+            with timing('fetch'):
+                return Response(list(queryset))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            with timing('serialize'):
+                data = serializer.data
+            return self.get_paginated_response(data)
+        serializer = self.get_serializer(queryset, many=True)
+        with timing('serialize'):
+            return Response(serializer.data)
+
+
+class LuHistoryViewSet(LuRendererMixin, ReadOnlyModelViewSet):
+    """
+    历史记录查询接口
+    1、list: 必须指定 type(表名) + type_id，或 created_by，分别命中对应索引；可通过 since、until 指定时间范围
+    2、as_of: 还原 type + type_id 对应记录在 at 时间的状态，at 默认为当前时间
+    """
+    serializer_class = LuHistorySerializer
+    pagination_class = LuPagination
+    filter_backends = ()
+
+    def _get_datetime(self, param):
+        value = self.request.query_params.get(param)
+        if not value:
+            return
+        try:
+            result = parse_datetime(value)
+        except ValueError:
+            result = None
+        if result is None:
+            raise ValidationError({param: '时间格式错误'})
+        if timezone.is_naive(result) and timezone.is_aware(timezone.now()):
+            result = timezone.make_aware(result)
+        return result
+
+    def _get_type_id(self):
+        type_id = self.request.query_params.get('type_id')
+        if not type_id:
+            return
+        try:
+            return int(type_id)
+        except ValueError:
+            raise ValidationError({'type_id': '必须为整数'})
+
+    def get_queryset(self):
+        if self.action == 'retrieve':
+            return LuHistory.objects.using(lu_settings.HISTORY_DATABASE).all()
+
+        params = self.request.query_params
+        since, until = self._get_datetime('since'), self._get_datetime('until')
+        type_id = self._get_type_id()
+        if params.get('type') and type_id is not None:
+            return get_object_history(params['type'], type_id, since, until)
+        if params.get('created_by'):
+            return get_user_history(params['created_by'], since, until)
+        raise ValidationError('必须指定type和type_id，或created_by')
+
+    @action(detail=False, methods=['get'])
+    def as_of(self, request, *args, **kwargs):
+        db_table = request.query_params.get('type')
+        type_id = self._get_type_id()
+        if not db_table or type_id is None:
+            raise ValidationError('必须指定type和type_id')
+        at = self._get_datetime('at') or timezone.now()
+        return Response({
+            'type': db_table,
+            'type_id': type_id,
+            'at': at,
+            'state': get_state_as_of(db_table, type_id, at)
+        })
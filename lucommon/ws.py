@@ -5,6 +5,7 @@ import json
 import asyncio
 import uuid
 import warnings
+from asgiref.sync import sync_to_async
 from django.core.handlers.asgi import ASGIHandler
 from django.urls import resolve, Resolver404
 from collections import OrderedDict
@@ -152,8 +153,78 @@ class LuASGIHandler(ASGIHandler):
                 await ws_view(ws_conn, *args, **kwargs)
 
         else:
+            # 流式响应在线程中迭代，见send_response
+            scope['lu_sync_streaming'] = True
             await super().__call__(scope, receive, send)
 
+    async def get_response_async(self, request):
+        """
+        异步视图的流式响应(见executors.as_async_view)经过响应中间件后:
+        1、仍是视图返回的响应时(中间件可能替换了streaming_content)，交给send_response发送
+        2、被中间件替换为其他响应时，停止迭代视图返回的响应
+        """
+        try:
+            response = await super().get_response_async(request)
+        except BaseException:
+            self._stop_stream(request, None)
+            raise
+        self._stop_stream(request, response)
+        return response
+
+    @staticmethod
+    def _stop_stream(request, response):
+        parts = getattr(request, 'lu_stream_parts', None)
+        if parts is None:
+            return
+        if response is not None and response is parts.response.result():
+            response.lu_stream_parts = parts
+        else:
+            parts.stop()
+
+    async def send_response(self, response, send):
+        """
+        django 3.2在事件循环中迭代流式响应，生成内容时查询数据库会抛出SynchronousOnlyOperation
+        1、异步视图的流式响应由视图线程池中的任务迭代，这里只从有界队列中读取并发送
+        2、其他流式响应的每段内容改为在同步线程中生成，其余与ASGIHandler相同
+        """
+        if not response.streaming:
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append((b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+
+        parts = getattr(response, 'lu_stream_parts', None)
+        if parts is not None:
+            # 异步视图的流式响应在视图线程池中迭代并关闭(见executors.LuStreamParts)，发送结束或失败时停止迭代
+            try:
+                await send({'type': 'http.response.start', 'status': response.status_code, 'headers': response_headers})
+                parts.start()
+                async for part in parts:
+                    for chunk, _ in self.chunk_bytes(part):
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body'})
+            finally:
+                parts.stop()
+            return
+
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': response_headers})
+        iterator = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=True)
+        while True:
+            part = await next_part(iterator, None)
+            if part is None:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
 
 def get_asgi_with_ws_application():
     django.setup(set_prefix=False)
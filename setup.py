@@ -14,6 +14,6 @@ setup(
     name="lucommon",
     version="1.0.4",
     install_requires=require,
-    packages=find_packages(),
+    packages=find_packages(exclude=("tests", "tests.*")),
     zip_safe=True
 )
@@ -0,0 +1,10 @@
+import os
+import django
+
+
+def pytest_configure():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
+    from django.core.management import call_command
+    # 内存数据库，lucommon及测试model没有迁移文件，通过syncdb建表
+    call_command('migrate', run_syncdb=True, verbosity=0)
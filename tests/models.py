@@ -0,0 +1,21 @@
+from django.db import models
+from lucommon.models import LuModel
+
+
+class Author(LuModel):
+    name = models.CharField(max_length=50)
+
+
+class Tag(LuModel):
+    name = models.CharField(max_length=50)
+
+
+class Book(LuModel):
+    title = models.CharField(max_length=100, db_index=True)
+    status = models.IntegerField(default=0)
+    body = models.TextField(default='')
+    author = models.ForeignKey(Author, null=True, on_delete=models.CASCADE, related_name='books')
+    tags = models.ManyToManyField(Tag, related_name='books')
+    version = models.IntegerField(default=0)
+    created_by = models.CharField(max_length=50, default='')
+    updated_by = models.CharField(max_length=50, default='')
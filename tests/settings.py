@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+SECRET_KEY = 'lucommon-tests'
+DEBUG = False
+USE_TZ = True
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'rest_framework',
+    'lucommon',
+    'tests',
+]
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('LU_TEST_DB', ':memory:'),
+    }
+}
+MIDDLEWARE = [
+    'django.middleware.common.CommonMiddleware',
+    'crum.CurrentRequestUserMiddleware',
+]
+ROOT_URLCONF = 'tests.urls'
+ALLOWED_HOSTS = ['*']
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+LU_COMMON = {'LOG_DIR': os.path.join(tempfile.gettempdir(), 'lucommon_tests')}
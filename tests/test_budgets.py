@@ -0,0 +1,78 @@
+from django.db.models import Count
+from django.test import TestCase
+from rest_framework import serializers
+from rest_framework.test import APIRequestFactory
+from lucommon.serializers import LuModelSerializer
+from lucommon.testing import LuQueryBudgetExceeded, assert_query_budget
+from lucommon.viewsets import LuModelViewSet
+from .models import Book, Tag
+
+
+def _tag_counts(pks):
+    return dict(Book.objects.filter(pk__in=pks).annotate(n=Count('tags')).values_list('pk', 'n'))
+
+
+class _NPlusOneSerializer(LuModelSerializer):
+    tag_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Book
+        fields = ('id', 'title', 'tag_count')
+
+    def get_tag_count(self, obj):
+        return obj.tags.count()
+
+
+class _BatchedSerializer(_NPlusOneSerializer):
+    def get_tag_count(self, obj):
+        return self.load(_tag_counts, obj)
+
+
+class _BookSerializer(LuModelSerializer):
+    class Meta:
+        model = Book
+        fields = ('id', 'title')
+
+
+class _NPlusOneViewSet(LuModelViewSet):
+    queryset = Book.objects.order_by('id')
+    serializer_class = _NPlusOneSerializer
+    lu_query_budget = {'list': 3}
+
+
+class _BatchedViewSet(_NPlusOneViewSet):
+    serializer_class = _BatchedSerializer
+
+
+class _BulkViewSet(LuModelViewSet):
+    queryset = Book.objects.all()
+    serializer_class = _BookSerializer
+    lu_bulk_actions = ('create',)
+
+
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        tag = Tag.objects.create(name='t')
+        for i in range(10):
+            Book.objects.create(title='b{}'.format(i)).tags.set([tag])
+
+    def _list(self, view_class):
+        return view_class.as_view({'get': 'list'})(APIRequestFactory().get('/', {'lu_limit': 10}))
+
+    def test_n_plus_one_fails(self):
+        with self.assertRaises(LuQueryBudgetExceeded) as cm:
+            with assert_query_budget(_NPlusOneViewSet, 'list'):
+                self._list(_NPlusOneViewSet)
+        self.assertIn('N+1', str(cm.exception))
+
+    def test_batched_within_budget(self):
+        with assert_query_budget(_BatchedViewSet, 'list') as collector:
+            self.assertEqual(self._list(_BatchedViewSet).status_code, 200)
+        self.assertEqual(collector.count, 3)
+
+    def test_bulk_writes_not_flagged(self):
+        request = APIRequestFactory().post('/', [{'title': 'n{}'.format(i)} for i in range(20)], format='json')
+        with assert_query_budget(_BulkViewSet, 'bulk') as collector:
+            self.assertEqual(_BulkViewSet.as_view({'post': 'bulk'})(request).status_code, 201)
+        self.assertGreaterEqual(collector.count, 20)
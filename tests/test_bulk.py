@@ -0,0 +1,122 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.permissions import BasePermission
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from lucommon.serializers import LuModelSerializer
+from lucommon.viewsets import LuModelViewSet
+from .models import Book, Tag
+
+
+class _BookSerializer(LuModelSerializer):
+    class Meta:
+        model = Book
+        fields = ('id', 'title', 'tags', 'version')
+
+
+class _BookViewSet(LuModelViewSet):
+    queryset = Book.objects.all()
+    serializer_class = _BookSerializer
+    lu_bulk_actions = ('create', 'update', 'delete')
+
+
+class _AuditedBookViewSet(_BookViewSet):
+    def perform_create(self, serializer):
+        serializer.save(created_by='audit')
+
+    def perform_update(self, serializer):
+        serializer.save(updated_by='audit')
+
+
+class _SoftDeleteBookViewSet(_BookViewSet):
+    def perform_destroy(self, instance):
+        instance.status = -1
+        instance.save()
+
+
+class _CustomDestroyBookViewSet(_BookViewSet):
+    def destroy(self, request, *args, **kwargs):
+        return Response(status=403)
+
+
+class _NoDestroyPermission(BasePermission):
+    def has_permission(self, request, view):
+        return view.action != 'destroy'
+
+
+class _ProtectedBookViewSet(_BookViewSet):
+    permission_classes = (_NoDestroyPermission,)
+
+
+class BulkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.tags = [Tag.objects.create(name='t{}'.format(i)) for i in range(3)]
+
+    def _bulk(self, method, payload, view_class=_BookViewSet):
+        request = getattr(APIRequestFactory(), method)('/', payload, format='json')
+        return view_class.as_view({method: 'bulk'})(request)
+
+    def _tags(self, book_id):
+        return sorted(Book.objects.get(pk=book_id).tags.values_list('pk', flat=True))
+
+    def test_create_returns_pks_and_sets_tags(self):
+        t0, t1, t2 = (tag.pk for tag in self.tags)
+        payload = [{'title': 'b{}'.format(i), 'tags': [t0, t1] if i % 2 else [t2]} for i in range(4)]
+        response = self._bulk('post', payload)
+        self.assertEqual(response.status_code, 201)
+        for item, result in zip(payload, response.data['data']):
+            self.assertEqual(Book.objects.get(pk=result['id']).title, item['title'])
+            self.assertEqual(self._tags(result['id']), sorted(item['tags']))
+
+    def test_update_replaces_tags(self):
+        t0, t1, t2 = (tag.pk for tag in self.tags)
+        books = [Book.objects.create(title='b{}'.format(i)) for i in range(3)]
+        for book in books:
+            book.tags.set([t0, t1])
+        response = self._bulk('patch', [{'id': book.pk, 'tags': [t1, t2]} for book in books])
+        self.assertEqual(response.status_code, 200)
+        for book in books:
+            self.assertEqual(self._tags(book.pk), [t1, t2])
+
+    def test_tags_set_in_batches(self):
+        payload = [{'title': 'b{}'.format(i), 'tags': [tag.pk for tag in self.tags]} for i in range(10)]
+        with CaptureQueriesContext(connection) as queries:
+            self._bulk('post', payload)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "tests_book_tags"')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_custom_perform_called_per_item(self):
+        response = self._bulk('post', [{'title': t, 'tags': [self.tags[0].pk]} for t in 'ab'], _AuditedBookViewSet)
+        self.assertEqual(response.status_code, 201, response.data)
+        ids = [result['id'] for result in response.data['data']]
+        self.assertEqual(set(Book.objects.filter(pk__in=ids).values_list('created_by', flat=True)), {'audit'})
+        response = self._bulk('patch', [{'id': pk, 'title': 'c'} for pk in ids], _AuditedBookViewSet)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(Book.objects.filter(pk__in=ids).values_list('updated_by', flat=True)), {'audit'})
+
+    def test_opt_in_per_action(self):
+        book = Book.objects.create(title='b')
+        view_class = type('_CreateOnlyBookViewSet', (_BookViewSet,), {'lu_bulk_actions': ('create',)})
+        self.assertEqual(self._bulk('delete', [book.pk], view_class).status_code, 405)
+        self.assertEqual(self._bulk('delete', [book.pk], LuModelViewSet).status_code, 405)
+        self.assertTrue(Book.objects.filter(pk=book.pk).exists())
+
+    def test_overridden_single_action_refused(self):
+        book = Book.objects.create(title='b')
+        self.assertEqual(self._bulk('delete', [book.pk], _CustomDestroyBookViewSet).status_code, 405)
+        self.assertTrue(Book.objects.filter(pk=book.pk).exists())
+
+    def test_single_action_permissions(self):
+        book = Book.objects.create(title='b')
+        self.assertEqual(self._bulk('delete', [book.pk], _ProtectedBookViewSet).status_code, 403)
+        self.assertTrue(Book.objects.filter(pk=book.pk).exists())
+        self.assertEqual(self._bulk('patch', [{'id': book.pk, 'title': 'c'}], _ProtectedBookViewSet).status_code, 200)
+
+    def test_custom_perform_destroy_called_per_item(self):
+        books = [Book.objects.create(title='b{}'.format(i)) for i in range(2)]
+        response = self._bulk('delete', [book.pk for book in books], _SoftDeleteBookViewSet)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Book.objects.filter(pk__in=[b.pk for b in books]).values_list('status', flat=True)),
+                         [-1, -1])
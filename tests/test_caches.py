@@ -0,0 +1,94 @@
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from rest_framework.permissions import BasePermission
+from rest_framework.test import APIRequestFactory, force_authenticate
+from lucommon.serializers import LuModelSerializer
+from lucommon.settings import lu_settings
+from lucommon.viewsets import LuModelViewSet
+from .models import Author, Book
+
+
+class _BookSerializer(LuModelSerializer):
+    class Meta:
+        model = Book
+        fields = ('id', 'title', 'author')
+
+
+class _OwnerOnly(BasePermission):
+    def has_object_permission(self, request, view, obj):
+        return obj.created_by == request.user.username
+
+
+class _BookViewSet(LuModelViewSet):
+    queryset = Book.objects.all()
+    serializer_class = _BookSerializer
+    permission_classes = (_OwnerOnly,)
+    lu_cache_timeout = 60
+    lu_expand_fields = {'author': None}
+
+
+class _GlobalBookViewSet(_BookViewSet):
+    lu_cache_scope = 'global'
+
+
+class ResponseCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice')
+        cls.bob = User.objects.create(username='bob')
+        cls.book = Book.objects.create(title='b', created_by='alice')
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(lu_settings, 'RESPONSE_CACHE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get(self, action, user=None, view_class=_BookViewSet, **params):
+        request = APIRequestFactory().get('/', params)
+        if user is not None:
+            force_authenticate(request, user=user)
+        kwargs = {'pk': self.book.pk} if action == 'retrieve' else {}
+        response = view_class.as_view({'get': action})(request, **kwargs)
+        # 缓存命中时返回的HttpResponse不需要渲染
+        return response.render() if hasattr(response, 'render') else response
+
+    def test_anonymous_not_cached(self):
+        self._get('list')
+        with self.assertNumQueries(2):
+            self._get('list')
+
+    def test_users_do_not_share_entries(self):
+        self.assertEqual(self._get('list', self.alice).status_code, 200)
+        with self.assertNumQueries(0):
+            self._get('list', self.alice)
+        with self.assertNumQueries(2):
+            self._get('list', self.bob)
+
+    def test_retrieve_checks_object_permissions_on_hit(self):
+        self.assertEqual(self._get('retrieve', self.alice, _GlobalBookViewSet).status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get('retrieve', self.alice, _GlobalBookViewSet).status_code, 200)
+        self.assertEqual(self._get('retrieve', self.bob, _GlobalBookViewSet).status_code, 403)
+
+    def test_hit_reads_cache_once_without_serializer(self):
+        self._get('list', self.alice, lu_expand='author')
+        with mock.patch.object(_BookViewSet, 'get_serializer') as get_serializer, \
+                mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many, \
+                mock.patch.object(cache, 'get', wraps=cache.get) as get:
+            self.assertEqual(self._get('list', self.alice, lu_expand='author').status_code, 200)
+        get_serializer.assert_not_called()
+        self.assertEqual(get_many.call_count, 1)
+        # LocMemCache的get_many逐个调用get
+        self.assertEqual(get.call_count, len(get_many.call_args[0][0]))
+
+    def test_related_write_invalidates(self):
+        author = Author.objects.create(name='a')
+        Book.objects.filter(pk=self.book.pk).update(author=author)
+        self._get('list', self.alice, lu_expand='author')
+        with self.captureOnCommitCallbacks(execute=True):
+            Author.objects.filter(pk=author.pk).update(name='a2')
+        response = self._get('list', self.alice, lu_expand='author')
+        self.assertIn(b'a2', response.content)
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase
+from lucommon import executors
+from lucommon.executors import LuStreamParts, get_count_executor
+from lucommon.settings import lu_settings
+
+
+class StreamPartsTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(executors, '_STREAM_POLL_INTERVAL', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self, consume, parts, queue_size=2, middleware=None):
+        produced = []
+        closed = []
+
+        def generate():
+            for part in parts:
+                produced.append(threading.current_thread().name)
+                yield part
+
+        async def main():
+            with mock.patch.object(lu_settings, 'ASYNC_STREAM_QUEUE_SIZE', queue_size):
+                stream = LuStreamParts(asyncio.get_running_loop())
+            response = StreamingHttpResponse(generate())
+            response._resource_closers.append(lambda: closed.append(True))
+            with ThreadPoolExecutor(1, thread_name_prefix='lu_test') as pool:
+                future = asyncio.wrap_future(pool.submit(stream.drain, response))
+                response = await stream.response
+                # 响应中间件在开始发送前执行
+                await asyncio.sleep(0.05)
+                self.assertEqual(produced, [])
+                if middleware is not None:
+                    middleware(response, stream)
+                received = await consume(stream)
+                stream.stop()
+                await asyncio.wait_for(future, 5)
+            return response, received
+
+        result = asyncio.run(main())
+        self.assertEqual(closed, [True])
+        return result, produced
+
+    def test_parts_generated_in_executor(self):
+        async def consume(stream):
+            stream.start()
+            received = []
+            async for part in stream:
+                self.assertLessEqual(stream.queue.qsize(), 2)
+                received.append(part)
+            return received
+
+        (response, received), produced = self._run(consume, ['a', 'b', 'c', 'd'])
+        self.assertTrue(response.streaming)
+        self.assertEqual(received, [b'a', b'b', b'c', b'd'])
+        self.assertTrue(all(name.startswith('lu_test') for name in produced))
+
+    def test_stop_releases_producer(self):
+        async def consume(stream):
+            stream.start()
+            async for part in stream:
+                stream.stop()
+                return [part]
+
+        (_, received), produced = self._run(consume, [str(i) for i in range(100)], queue_size=1)
+        self.assertEqual(received, [b'0'])
+        self.assertLess(len(produced), 100)
+
+    def test_streaming_content_replaced_by_middleware(self):
+        def middleware(response, stream):
+            response.streaming_content = (part.upper() for part in response.streaming_content)
+
+        async def consume(stream):
+            stream.start()
+            return [part async for part in stream]
+
+        (_, received), _ = self._run(consume, ['a', 'b'], middleware=middleware)
+        self.assertEqual(received, [b'A', b'B'])
+
+    def test_stop_before_start(self):
+        # 响应被中间件替换，不再迭代
+        async def consume(stream):
+            stream.stop()
+            return []
+
+        _, produced = self._run(consume, ['a', 'b'])
+        self.assertEqual(produced, [])
+
+
+class CountExecutorTests(SimpleTestCase):
+    def test_count_executor_bounded(self):
+        executor = get_count_executor()
+        self.assertEqual(executor.max_workers, lu_settings.ASYNC_COUNT_WORKERS)
+        self.assertEqual(executor.max_queue, lu_settings.ASYNC_COUNT_QUEUE_SIZE)
@@ -0,0 +1,26 @@
+from django.db.models import Count
+from django.test import TestCase
+from lucommon.exports import iterate_chunks
+from .models import Book
+
+
+class IterateChunksTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(25):
+            Book.objects.create(title='b{}'.format(i % 7), status=i % 3)
+
+    def assertSameRows(self, queryset, chunk_size=4):
+        chunks = list(iterate_chunks(queryset, chunk_size))
+        self.assertTrue(all(len(chunk) <= chunk_size for chunk in chunks))
+        self.assertEqual([row for chunk in chunks for row in chunk], list(queryset))
+
+    def test_ordered_instances(self):
+        self.assertSameRows(Book.objects.order_by('title', 'pk'))
+
+    def test_distinct_values_are_chunked(self):
+        self.assertSameRows(Book.objects.values('title').distinct().order_by('-title'))
+        self.assertSameRows(Book.objects.values('title', 'status').distinct().order_by('status', 'title'))
+
+    def test_aggregated_values_are_chunked(self):
+        self.assertSameRows(Book.objects.values('status').annotate(n=Count('id')).order_by('-n', 'status'), 2)
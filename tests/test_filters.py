@@ -0,0 +1,112 @@
+import random
+from django.test import TestCase
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from lucommon.filters import LuAggregateFilterBackend, LuOrderFilterBackend, LuSearchFilterBackend
+from .models import Author, Book, Tag
+
+
+def _exclude_one_by_one(queryset, filters_lookups, excludes_lookups):
+    # 合并前的实现: filter之后逐个exclude
+    queryset = queryset.filter(**filters_lookups) if filters_lookups else queryset
+    for lookup_name, value in excludes_lookups.items():
+        queryset = queryset.exclude(**{lookup_name: value})
+    return queryset
+
+
+def _count_subqueries(queryset):
+    return str(queryset.query).count('SELECT') - 1
+
+
+class BuildExcludeQTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rand = random.Random(1)
+        tags = [Tag.objects.create(name='t{}'.format(i)) for i in range(5)]
+        authors = [Author.objects.create(name='a{}'.format(i)) for i in range(3)]
+        for i in range(60):
+            book = Book.objects.create(title='b{}'.format(i % 7), status=i % 3, author=rand.choice(authors + [None]))
+            book.tags.set(rand.sample(tags, rand.randint(0, 3)))
+
+    def setUp(self):
+        self.backend = LuSearchFilterBackend()
+        self.factory = APIRequestFactory()
+
+    def _search(self, fields, values, types):
+        request = Request(self.factory.get('/', {
+            'lu_search_field': fields, 'lu_search_value': values, 'lu_search_type': types
+        }))
+        queryset = self.backend.filter_queryset(request, Book.objects.all(), None)
+        plan, values = self.backend._get_search_plan(request, Book.objects.all())
+        filters_lookups, excludes_lookups = plan.bind(values, self.backend.SearchValueDelimiter)
+        return queryset, _exclude_one_by_one(Book.objects.all(), filters_lookups, excludes_lookups)
+
+    def assertSameRows(self, queryset, expected):
+        self.assertEqual(sorted(queryset.values_list('pk', flat=True)), sorted(expected.values_list('pk', flat=True)))
+
+    def test_same_results_as_chained_excludes(self):
+        cases = [
+            ('tags__name,tags__name,status,title', 't1,t2,1,b1', '4,6,6,5'),
+            ('tags__name,tags__name,tags__name,author__name', 't1,t2,t3,a1', '6,6,9,6'),
+            ('tags__name,author__books__tags__name,status', 't1,t2,0', '6,6,2'),
+            ('tags__name,tags__name,tags__name', 't1,t2,t4', '2,6,6'),
+        ]
+        for case in cases:
+            with self.subTest(case=case):
+                queryset, expected = self._search(*case)
+                self.assertSameRows(queryset, expected)
+
+    def test_null_and_empty_values_keep_their_own_exclude(self):
+        for case in [
+            ('tags__name,tags__name,author', 't1,__NULL_VALUE__,__NULL_VALUE__', '6,6,6'),
+            ('tags__name,tags__name', 't1|t2,', '9,9'),
+        ]:
+            with self.subTest(case=case):
+                queryset, expected = self._search(*case)
+                self.assertSameRows(queryset, expected)
+
+    def test_multi_valued_excludes_share_one_subquery(self):
+        queryset, expected = self._search('tags__name,tags__name,tags__name,author__name', 't1,t2,t3,a1', '6,6,9,6')
+        self.assertSameRows(queryset, expected)
+        self.assertEqual(_count_subqueries(queryset), 1)
+        self.assertGreater(_count_subqueries(expected), _count_subqueries(queryset))
+
+    def test_single_exclude_is_unchanged(self):
+        queryset, expected = self._search('tags__name', 't1', '6')
+        self.assertSameRows(queryset, expected)
+        self.assertEqual(_count_subqueries(queryset), _count_subqueries(expected))
+
+
+class _AggregateView:
+    lu_aggregated = False
+    lu_group_by_fields = ('status',)
+    lu_aggregate_fields = {'id': ('max',)}
+    lu_order_fields = ('title',)
+
+
+class OrderWithAggregateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(6):
+            Book.objects.create(title='b{}'.format(i), status=i % 3)
+
+    def _filter(self, params, queryset):
+        view = _AggregateView()
+        request = Request(APIRequestFactory().get('/', params))
+        for backend in (LuAggregateFilterBackend, LuOrderFilterBackend):
+            queryset = backend().filter_queryset(request, queryset, view)
+        return queryset
+
+    def test_no_order_field_keeps_ordering(self):
+        queryset = self._filter({}, Book.objects.order_by('-title'))
+        self.assertEqual(queryset.query.order_by, ('-title',))
+
+    def test_group_ordering_kept(self):
+        queryset = self._filter({'lu_group_by': 'status'}, Book.objects.all())
+        self.assertEqual([row['status'] for row in queryset], [0, 1, 2])
+
+    def test_aggregate_alias_ordering_not_checked_against_model(self):
+        queryset = self._filter({
+            'lu_group_by': 'status', 'lu_aggregate': 'max:id', 'lu_order_field': '-id__max'
+        }, Book.objects.all())
+        self.assertEqual([row['status'] for row in queryset], [2, 1, 0])
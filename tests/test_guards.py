@@ -0,0 +1,140 @@
+from unittest import mock
+from django.test import TestCase
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from lucommon import guards
+from lucommon.exceptions import LuQueryGuardError
+from lucommon.filters import LuDistinctFilterBackend, LuOrderFilterBackend, LuSearchFilterBackend
+from lucommon.guards import check_explain
+from lucommon.settings import lu_settings
+from .models import Book
+
+
+class _View:
+    def __init__(self, request=None, **attrs):
+        self.request = request
+        self.__dict__.update(attrs)
+
+
+def _request(**params):
+    return Request(APIRequestFactory().get('/', params))
+
+
+class GuardTestCase(TestCase):
+    def guard(self, enabled=True):
+        patcher = mock.patch.object(lu_settings, 'QUERY_GUARD', enabled)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class CheckSearchTests(GuardTestCase):
+    def _search(self, view, fields, values, types):
+        request = _request(lu_search_field=fields, lu_search_value=values, lu_search_type=types)
+        return LuSearchFilterBackend().filter_queryset(request, Book.objects.all(), view)
+
+    def test_guard_off_allows_everything(self):
+        self._search(_View(), 'body', 'x', '0')
+
+    def test_guard_rejects_unindexed_and_expensive(self):
+        self.guard()
+        self._search(_View(), 'title,author,author__books__title', 'b,1,b', '2,2,1')
+        for fields, types in [('status', '2'), ('title', '0'), ('author__name', '2')]:
+            with self.subTest(fields=fields, types=types), self.assertRaises(LuQueryGuardError):
+                self._search(_View(), fields, 'x', types)
+
+    def test_declared_fields_and_lookups(self):
+        view = _View(lu_search_fields={'status': None, 'title': ('exact', 'startswith')})
+        self._search(view, 'status,title', '1,b', '0,1')
+        for fields, types in [('title', '0'), ('body', '2')]:
+            with self.subTest(fields=fields, types=types), self.assertRaises(LuQueryGuardError):
+                self._search(view, fields, 'x', types)
+
+
+class CheckOrderTests(GuardTestCase):
+    def _order(self, view, fields):
+        return LuOrderFilterBackend().filter_queryset(_request(lu_order_field=fields), Book.objects.all(), view)
+
+    def test_guard_rejects_unindexed(self):
+        self._order(_View(), 'body')
+        self.guard()
+        self._order(_View(), '-title,author,id')
+        for fields in ['status', '?', 'author__name', 'created_at__date']:
+            with self.subTest(fields=fields), self.assertRaises(LuQueryGuardError):
+                self._order(_View(), fields)
+
+    def test_declared_fields(self):
+        view = _View(lu_order_fields=('status',))
+        self._order(view, '-status')
+        with self.assertRaises(LuQueryGuardError):
+            self._order(view, 'title')
+
+
+class CheckDistinctTests(GuardTestCase):
+    def _distinct(self, view):
+        return LuDistinctFilterBackend().filter_queryset(_request(lu_response_distinct='1'), Book.objects.all(), view)
+
+    def test_distinct(self):
+        self._distinct(_View())
+        self._distinct(_View(lu_distinct_allowed=True))
+        with self.assertRaises(LuQueryGuardError):
+            self._distinct(_View(lu_distinct_allowed=False))
+        self.guard()
+        with self.assertRaises(LuQueryGuardError):
+            self._distinct(_View())
+        self.assertTrue(self._distinct(_View(lu_distinct_allowed=True)).query.distinct)
+
+
+class CheckExplainTests(TestCase):
+    """
+    sqlite不支持估算扫描行数，以排序的有无模拟EXPLAIN的结果
+    """
+
+    def setUp(self):
+        guards._EXPLAIN_CACHE.clear()
+        self.addCleanup(guards._EXPLAIN_CACHE.clear)
+        self.explained = []
+        for patcher in [
+            mock.patch.object(guards, 'EXPLAIN_VENDORS', ('sqlite',)),
+            mock.patch.object(guards, 'estimate_rows', self._estimate_rows),
+            mock.patch.object(lu_settings, 'QUERY_GUARD_EXPLAIN_MAX_ROWS', 100),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _estimate_rows(self, queryset):
+        self.explained.append(str(queryset.query))
+        return 1000 if queryset.query.order_by or queryset.query.distinct else 10
+
+    def _action(self, action):
+        patcher = mock.patch.object(lu_settings, 'QUERY_GUARD_EXPLAIN_ACTION', action)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_within_limit(self):
+        queryset = Book.objects.filter(status=1)
+        self.assertIs(check_explain(_View(_request()), queryset), queryset)
+
+    def test_reject(self):
+        with self.assertRaises(LuQueryGuardError):
+            check_explain(_View(_request()), Book.objects.order_by('status'))
+        view = _View(_request(), lu_explain_max_rows=10000)
+        check_explain(view, Book.objects.order_by('status'))
+
+    def test_downgrade_default_ordering(self):
+        self._action('downgrade')
+        queryset = check_explain(_View(_request()), Book.objects.order_by('status').distinct())
+        self.assertEqual(queryset.query.order_by, ())
+        self.assertFalse(queryset.query.distinct)
+
+    def test_client_ordering_is_not_downgraded(self):
+        self._action('downgrade')
+        for params in [{'lu_order_field': 'status'}, {'lu_response_distinct': '1'}]:
+            with self.subTest(params=params), self.assertRaises(LuQueryGuardError):
+                check_explain(_View(_request(**params)), Book.objects.order_by('status'))
+
+    def test_verdict_cached_per_shape(self):
+        check_explain(_View(_request()), Book.objects.filter(status=1))
+        check_explain(_View(_request()), Book.objects.filter(status=2))
+        self.assertEqual(len(self.explained), 1)
+        check_explain(_View(_request()), Book.objects.filter(title='x'))
+        self.assertEqual(len(self.explained), 2)
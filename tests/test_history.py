@@ -0,0 +1,186 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from lucommon import history
+from lucommon.history import (
+    CHECKPOINT, FIELDS, LuHistory, LuHistoryWriter, encode_diff, get_state_as_of, save_checkpoint
+)
+from lucommon.settings import lu_settings
+
+
+def _history(type_id):
+    return LuHistory(type='tests_book', type_id=type_id, diff='{}', operation='create', created_by='tester')
+
+
+class HistoryWriterTests(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(lu_settings, 'HISTORY_ASYNC', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = LuHistoryWriter(batch_size=100, flush_interval=60)
+        self.addCleanup(self.writer.close)
+
+    def _written(self):
+        return sorted(LuHistory.objects.values_list('type_id', flat=True))
+
+    def test_rollback_discards(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.writer.save([_history(1)])
+                raise ValueError
+        self.assertEqual(self.writer.queue_depth, 0)
+        self.writer.flush()
+        self.assertEqual(self._written(), [])
+
+    def test_written_after_commit(self):
+        with transaction.atomic():
+            self.writer.save([_history(1), _history(2)])
+            self.assertEqual(self.writer.queue_depth, 0)
+        self.assertEqual(self.writer.queue_depth, 2)
+        self.assertEqual(self._written(), [])
+        self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(self._written(), [1, 2])
+
+    def test_savepoint_rollback_discards_only_its_rows(self):
+        with transaction.atomic():
+            self.writer.save([_history(1)])
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    self.writer.save([_history(2)])
+                    raise ValueError
+            with transaction.atomic():
+                self.writer.save([_history(3)])
+        self.writer.flush()
+        self.assertEqual(self._written(), [1, 3])
+
+    def _record_flushes(self):
+        # 后台线程使用各自的数据库连接，这里只记录写入的批次
+        flushed = []
+        self.writer._bulk_create = lambda histories: flushed.append([h.type_id for h in histories]) or len(histories)
+        return flushed
+
+    def _wait_flushed(self, flushed, expected, timeout=5):
+        deadline = time.monotonic() + timeout
+        while flushed != expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(flushed, expected)
+
+    def test_flush_at_batch_size(self):
+        flushed = self._record_flushes()
+        self.writer.batch_size = 3
+        self.writer.save([_history(1), _history(2)])
+        time.sleep(0.05)
+        self.assertEqual(flushed, [])
+        self.writer.save([_history(3)])
+        self._wait_flushed(flushed, [[1, 2, 3]])
+
+    def test_flush_at_interval(self):
+        flushed = self._record_flushes()
+        self.writer.flush_interval = 0.05
+        self.writer.save([_history(1)])
+        self._wait_flushed(flushed, [[1]])
+
+
+class AsOfReplayTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(lu_settings, 'HISTORY_DIFF_COMPACT', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(history._FIELD_MAPS.clear)
+        history._FIELD_MAPS.clear()
+        self.now = timezone.now()
+
+    def _at(self, days):
+        return self.now - timedelta(days=days)
+
+    def _change(self, operation, days, diff=None, **values):
+        if diff is None:
+            diff = encode_diff('tests_book', {attr: {'new': value, 'old': None} for attr, value in values.items()})
+        return LuHistory.objects.create(type='tests_book', type_id=1, operation=operation, created_by='tester',
+                                        diff=diff, created_at=self._at(days))
+
+    def test_replay_compact_diffs(self):
+        created = self._change('create', 10, title='a', status='0')
+        self._change('update', 8, title='b')
+        self._change('update', 6, status='1')
+        self.assertTrue(created.diff.startswith('['))
+
+        self.assertIsNone(get_state_as_of('tests_book', 1, self._at(11)))
+        self.assertEqual(get_state_as_of('tests_book', 1, self._at(9)), {'title': 'a', 'status': '0'})
+        self.assertEqual(get_state_as_of('tests_book', 1, self._at(7)), {'title': 'b', 'status': '0'})
+        self.assertEqual(get_state_as_of('tests_book', 1, self.now), {'title': 'b', 'status': '1'})
+
+        self._change('delete', 4)
+        self.assertIsNone(get_state_as_of('tests_book', 1, self.now))
+        self.assertEqual(get_state_as_of('tests_book', 1, self._at(5)), {'title': 'b', 'status': '1'})
+
+    def test_replay_from_checkpoint(self):
+        self._change('create', 10, title='a', status='0')
+        self._change('update', 8, title='b')
+        self.assertIsNone(save_checkpoint('tests_book', 1, at=self._at(7), min_changes=3))
+        checkpoint = save_checkpoint('tests_book', 1, at=self._at(7), min_changes=2)
+        self.assertEqual(checkpoint.created_at, self._at(8))
+        self._change('update', 6, status='1')
+
+        # 检查点之前的差异不再参与回放
+        LuHistory.objects.filter(created_at__lt=self._at(8)).delete()
+        self.assertEqual(get_state_as_of('tests_book', 1, self._at(7)), {'title': 'b', 'status': '0'})
+        self.assertEqual(get_state_as_of('tests_book', 1, self.now), {'title': 'b', 'status': '1'})
+        # 回放差异不足时不写入新的检查点
+        self.assertIsNone(save_checkpoint('tests_book', 1, min_changes=2))
+        self.assertEqual(LuHistory.objects.filter(operation=CHECKPOINT).count(), 1)
+
+    def test_replay_across_field_map_change(self):
+        # 旧版本model字段为(id, name, status)，字段映射保存在历史记录表中
+        LuHistory.objects.create(type='tests_book', type_id=7, operation=FIELDS, created_by='',
+                                 diff=json.dumps(['id', 'name', 'status']))
+        self._change('create', 10, diff=json.dumps([7, [1, 'a', None], [2, '0', None]]))
+        # 字段映射缺失的旧记录以"#序号"表示
+        self._change('update', 9, diff=json.dumps([8, [3, 'x', None]]))
+        self._change('update', 8, title='b', status='1')
+
+        self.assertEqual(get_state_as_of('tests_book', 1, self._at(9)), {'name': 'a', 'status': '0', '#3': 'x'})
+        self.assertEqual(get_state_as_of('tests_book', 1, self.now),
+                         {'name': 'a', 'status': '1', '#3': 'x', 'title': 'b'})
+        checkpoint = save_checkpoint('tests_book', 1, min_changes=0)
+        self.assertEqual(checkpoint.get_diff()['name'], {'new': 'a', 'old': None})
+
+
+class HistoryArchiveTests(TestCase):
+    def _change(self, type_id, operation, days, **values):
+        return LuHistory.objects.create(
+            type='tests_book', type_id=type_id, operation=operation, created_by='tester',
+            diff=json.dumps({attr: {'new': value, 'old': None} for attr, value in values.items()}),
+            created_at=timezone.now() - timedelta(days=days)
+        )
+
+    def test_archive_checkpoints_each_object_once(self):
+        self._change(1, 'create', 10, title='a', status='0')
+        self._change(2, 'create', 10, title='x', status='0')
+        self._change(1, 'update', 9, title='b')
+        self._change(1, 'update', 8, status='1')
+        self._change(1, 'update', 1, title='c')
+
+        archive_dir = tempfile.mkdtemp()
+        call_command('lu_history_archive', days=5, dir=archive_dir, batch_size=1, stdout=StringIO())
+
+        checkpoints = LuHistory.objects.filter(operation=CHECKPOINT)
+        self.assertEqual(sorted(checkpoints.values_list('type_id', flat=True)), [1, 2])
+        self.assertEqual(LuHistory.objects.exclude(operation=CHECKPOINT).count(), 1)
+        self.assertEqual(get_state_as_of('tests_book', 1, timezone.now()), {'title': 'c', 'status': '1'})
+        self.assertEqual(get_state_as_of('tests_book', 2, timezone.now()), {'title': 'x', 'status': '0'})
+
+        file_name, = os.listdir(archive_dir)
+        with gzip.open(os.path.join(archive_dir, file_name), 'rt', encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([(row['type_id'], row['operation']) for row in rows],
+                         [(1, 'create'), (1, 'update'), (1, 'update'), (2, 'create')])
@@ -0,0 +1,90 @@
+from urllib.parse import parse_qsl, urlparse
+from django.core.cache import cache
+from django.test import TestCase
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from lucommon.paginations import LuPagination
+from .models import Book
+
+
+class CursorPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(6):
+            Book.objects.create(title='b{}'.format(i % 2), status=i % 3)
+
+    def _paginate(self, queryset, **params):
+        request = Request(APIRequestFactory().get('/', dict({'lu_cursor': ''}, **params)))
+        return LuPagination().paginate_queryset(queryset, request)
+
+    def _page(self, queryset, link):
+        params = {'lu_cursor': ''} if link is None else dict(parse_qsl(urlparse(link).query))
+        paginator = LuPagination()
+        rows = paginator.paginate_queryset(queryset, Request(APIRequestFactory().get('/', dict(params, lu_limit=2))))
+        return [row.pk for row in rows], paginator.get_next_link(), paginator.get_previous_link()
+
+    def test_cursor_pages_follow_ordering(self):
+        rows = self._paginate(Book.objects.order_by('title'), lu_limit=4)
+        self.assertEqual([row.title for row in rows], ['b0', 'b0', 'b0', 'b1'])
+
+    def test_walk_next_then_previous_with_duplicate_values(self):
+        for ordering in [('title',), ('-title',), ('status', '-title')]:
+            with self.subTest(ordering=ordering):
+                queryset = Book.objects.order_by(*ordering)
+                # 主键按最后一个排序字段的方向追加
+                pk = '-pk' if ordering[-1].startswith('-') else 'pk'
+                expected = list(queryset.order_by(*ordering, pk).values_list('pk', flat=True))
+
+                pages = []
+                pks, next_link, previous_link = self._page(queryset, None)
+                self.assertIsNone(previous_link)
+                pages.append(pks)
+                while next_link:
+                    pks, next_link, previous_link = self._page(queryset, next_link)
+                    pages.append(pks)
+                self.assertEqual(sum(pages, []), expected)
+                self.assertEqual(len(pages), 3)
+
+                backward = [pages[-1]]
+                while previous_link:
+                    pks, _, previous_link = self._page(queryset, previous_link)
+                    backward.append(pks)
+                self.assertEqual(backward, pages[::-1])
+
+    def test_distinct_values_rejected(self):
+        with self.assertRaises(ValidationError):
+            self._paginate(Book.objects.values('title').distinct().order_by('title'))
+
+    def test_distinct_instances_allowed(self):
+        rows = self._paginate(Book.objects.distinct().order_by('title'), lu_limit=10)
+        self.assertEqual(len(rows), 6)
+
+
+class CountModeTests(TestCase):
+    class View:
+        lu_count_mode = 'cached'
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        for i in range(3):
+            Book.objects.create(title='b{}'.format(i))
+
+    def _paginate(self, **params):
+        paginator = LuPagination()
+        rows = paginator.paginate_queryset(Book.objects.order_by('pk'), Request(APIRequestFactory().get('/', params)),
+                                           self.View())
+        return paginator, rows
+
+    def test_un_limit_ignores_cached_count(self):
+        paginator, _ = self._paginate(lu_limit=2)
+        self.assertEqual(paginator.count, 3)
+        for i in range(2):
+            Book.objects.create(title='c{}'.format(i))
+        paginator, _ = self._paginate(lu_limit=2)
+        self.assertEqual(paginator.count, 3)
+
+        paginator, rows = self._paginate(lu_limit=-1)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(paginator.count, 5)
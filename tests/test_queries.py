@@ -0,0 +1,72 @@
+from unittest import mock
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction
+from lucommon import queries
+from lucommon.exceptions import LuLockError
+from lucommon.history import LuHistory
+from lucommon.settings import lu_settings
+from .models import Book
+
+
+class AtomicOptimisticLockTests(TestCase):
+    def setUp(self):
+        for patcher in (mock.patch.object(lu_settings, 'OPTIMISTIC_LOCK_ATOMIC', True),
+                        mock.patch.object(queries, 'IS_ATOMIC_LOCK', True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pk = Book.objects.create(title='a', status=0).pk
+
+    def _last_diff(self):
+        return LuHistory.objects.filter(type='tests_book', type_id=self.pk, operation='update').latest('id').get_diff()
+
+    def test_conflict_raises(self):
+        first, second = Book.objects.get(pk=self.pk), Book.objects.get(pk=self.pk)
+        first.title = 'b'
+        first.save()
+        self.assertEqual(first.version, 1)
+        second.title = 'c'
+        with self.assertRaises(LuLockError), transaction.atomic():
+            second.save()
+        book = Book.objects.get(pk=self.pk)
+        self.assertEqual((book.title, book.version), ('b', 1))
+
+    def test_loaded_values_used_as_old_values(self):
+        book = Book.objects.get(pk=self.pk)
+        book.title = 'b'
+        with CaptureQueriesContext(connection) as captured:
+            book.save()
+        # 不需要更新前查询旧值
+        self.assertFalse(any(q['sql'].startswith('SELECT') and 'tests_book' in q['sql'] for q in captured))
+        self.assertEqual(self._last_diff()['title'], {'new': 'b', 'old': 'a'})
+        book.title = 'c'
+        book.save()
+        self.assertEqual(self._last_diff()['title'], {'new': 'c', 'old': 'b'})
+
+    def test_update_fields(self):
+        first, second = Book.objects.get(pk=self.pk), Book.objects.get(pk=self.pk)
+        first.title, first.status = 'b', 5
+        first.save(update_fields=['title', 'version'])
+        book = Book.objects.get(pk=self.pk)
+        self.assertEqual((book.title, book.status, book.version), ('b', 0, 1))
+        self.assertNotIn('status', self._last_diff())
+        second.status = 3
+        with self.assertRaises(LuLockError), transaction.atomic():
+            second.save(update_fields=['status', 'version'])
+
+    def test_deferred_instance_reads_old_values(self):
+        book = Book.objects.only('title', 'version').get(pk=self.pk)
+        book.status = 2
+        with CaptureQueriesContext(connection) as captured:
+            book.save(update_fields=['status', 'version'])
+        self.assertTrue(any(q['sql'].startswith('SELECT') for q in captured))
+        self.assertEqual(self._last_diff()['status'], {'new': '2', 'old': '0'})
+        self.assertEqual(Book.objects.get(pk=self.pk).version, 1)
+
+    def test_deferred_stale_instance_conflicts(self):
+        stale = Book.objects.only('title', 'version').get(pk=self.pk)
+        Book.objects.get(pk=self.pk).save()
+        stale.status = 2
+        with self.assertRaises(LuLockError), transaction.atomic():
+            stale.save(update_fields=['status', 'version'])
+        self.assertEqual(Book.objects.get(pk=self.pk).status, 0)
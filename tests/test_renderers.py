@@ -0,0 +1,44 @@
+import json
+from unittest import mock
+from django.test import SimpleTestCase
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from lucommon.renderers import LuJSONRenderer, LuPage, get_renderer_classes
+from lucommon.settings import lu_settings
+
+
+class _JSONRenderer(JSONRenderer):
+    pass
+
+
+class LuPageTests(SimpleTestCase):
+    def setUp(self):
+        self.page = LuPage([{'id': 1}], None, 'http://testserver/?lu_offset=0', 3)
+
+    def test_same_output_as_dict(self):
+        expected = {'data': [{'id': 1}], 'pagination': {
+            'next': None, 'previous': 'http://testserver/?lu_offset=0', 'count': 3
+        }}
+        self.assertEqual(dict(self.page), expected)
+        self.assertEqual(json.loads(LuJSONRenderer().render(self.page)), expected)
+        self.assertEqual(json.loads(JSONRenderer().render(self.page)), expected)
+        self.assertEqual(json.loads(LuJSONRenderer().render(self.page, 'application/json; indent=2')), expected)
+
+    def test_mutable(self):
+        self.page['extra'] = 1
+        self.page['pagination']['count'] = 4
+        rendered = json.loads(LuJSONRenderer().render(self.page))
+        self.assertEqual(rendered['extra'], 1)
+        self.assertEqual(rendered['pagination']['count'], 4)
+
+
+class RendererClassesTests(SimpleTestCase):
+    def test_unchanged_when_disabled(self):
+        classes = (BrowsableAPIRenderer, JSONRenderer)
+        with mock.patch.object(lu_settings, 'RENDERER_LU_JSON', False):
+            self.assertEqual(get_renderer_classes(classes), classes)
+
+    def test_json_renderer_replaced_in_place(self):
+        with mock.patch.object(lu_settings, 'RENDERER_LU_JSON', True):
+            self.assertEqual(get_renderer_classes((BrowsableAPIRenderer, JSONRenderer)),
+                             (BrowsableAPIRenderer, LuJSONRenderer))
+            self.assertEqual(get_renderer_classes((_JSONRenderer,)), (_JSONRenderer,))
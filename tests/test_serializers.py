@@ -0,0 +1,112 @@
+from django.db.models import Count
+from django.test import SimpleTestCase, TestCase
+from rest_framework import serializers
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from lucommon import serializers as lu_serializers
+from lucommon.serializers import LuModelSerializer, get_expand_tree
+from .models import Author, Book, Tag
+
+
+class _ExpandView:
+    lu_expand_fields = ('author', 'author.books', 'tags')
+    lu_expand_max_depth = None
+
+
+class ExpandTreeTests(SimpleTestCase):
+    def _tree(self, **params):
+        return get_expand_tree(Request(APIRequestFactory().get('/', params)), _ExpandView())
+
+    def test_expand_tree(self):
+        self.assertEqual(self._tree(lu_expand='author.books,tags'), {'author': {'books': {}}, 'tags': {}})
+
+    def test_response_fields_limit_expand(self):
+        self.assertEqual(self._tree(lu_expand='author.books,tags', lu_response_field='id,author'),
+                         {'author': {'books': {}}})
+        self.assertEqual(self._tree(lu_expand='author,tags', lu_response_field='id,title'), {})
+
+
+def _tag_counts(pks):
+    return dict(Book.objects.filter(pk__in=pks).annotate(n=Count('tags')).values_list('pk', 'n'))
+
+
+class _BookSerializer(LuModelSerializer):
+    tag_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Book
+        fields = ('id', 'tag_count')
+
+    def get_tag_count(self, obj):
+        return self.load(_tag_counts, obj)
+
+
+class _AuthorSerializer(LuModelSerializer):
+    books = _BookSerializer(many=True)
+
+    class Meta:
+        model = Author
+        fields = ('id', 'books')
+
+
+class NestedLoadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        tags = [Tag.objects.create(name='t{}'.format(i)) for i in range(3)]
+        for i in range(3):
+            author = Author.objects.create(name='a{}'.format(i))
+            for j in range(3):
+                Book.objects.create(title='b{}'.format(j), author=author).tags.set(tags[:j])
+
+    def test_nested_rows_loaded_in_one_call(self):
+        authors = Author.objects.prefetch_related('books').order_by('id')
+        request = Request(APIRequestFactory().get('/'))
+        with self.assertNumQueries(3):
+            data = _AuthorSerializer(authors, many=True, context={'request': request}).data
+        self.assertEqual([[book['tag_count'] for book in author['books']] for author in data], [[0, 1, 2]] * 3)
+
+
+class LazyCacheTests(SimpleTestCase):
+    def test_key_for_fresh_callables(self):
+        serializer = _BookSerializer()
+        calls = []
+        for _ in range(3):
+            serializer.lazy_cache(lambda: calls.append('lambda'))
+            serializer.lazy_cache(lambda value: calls.append(value), 'keyed', key='keyed')
+        self.assertEqual(calls, ['lambda', 'keyed', 'lambda', 'lambda'])
+
+
+class _PlainBookSerializer(LuModelSerializer):
+    class Meta:
+        model = Book
+        fields = ('id', 'title', 'status', 'author')
+
+
+class _CompiledBookSerializer(_PlainBookSerializer):
+    lu_compiled = True
+
+
+class CompiledRepresentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(name='a')
+        for i in range(3):
+            Book.objects.create(title='b{}'.format(i), status=i, author=author if i else None)
+
+    def _data(self, serializer_class, rows, **params):
+        request = Request(APIRequestFactory().get('/', params))
+        return serializer_class(rows, many=True, context={'request': request}).data
+
+    def test_same_output_as_drf(self):
+        for rows in (list(Book.objects.order_by('id')), list(Book.objects.order_by('id').values())):
+            with self.subTest(rows=type(rows[0])):
+                self.assertEqual(self._data(_CompiledBookSerializer, rows), self._data(_PlainBookSerializer, rows))
+
+    def test_plan_shared_by_field_order(self):
+        lu_serializers._COMPILED_PLANS.clear()
+        rows = list(Book.objects.order_by('id'))
+        data = self._data(_CompiledBookSerializer, rows, lu_response_field='title,id')
+        self.assertEqual(list(data[0]), ['title', 'id'])
+        data = self._data(_CompiledBookSerializer, rows, lu_response_field='id,title')
+        self.assertEqual(list(data[0]), ['id', 'title'])
+        self.assertEqual(len(lu_serializers._COMPILED_PLANS), 1)